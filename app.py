@@ -1,34 +1,62 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, request, jsonify, render_template, redirect, url_for, session
+# 環境変数の読み込み（.envの値を、読み込み時に設定を参照するモジュールとロギングの設定より先に反映する）
+from dotenv import load_dotenv
+load_dotenv()
+
+from flask import Flask, request, jsonify, render_template, redirect, url_for, session, Response
+from flask.json.provider import DefaultJSONProvider
 import requests
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin, urlparse
-import re
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import base64
 import os
 import json
+import queue
+import threading
+import time
 from datetime import datetime, timedelta
 from functools import wraps
 import hashlib
 import redis
 from limits.storage import RedisStorage, MemoryStorage
-from dotenv import load_dotenv
-import sys
 import logging
+from crawler import CrawlBudget, create_engine
+from distributed import CrawlHelper, create_coordinator, distributed_enabled, get_redis_client
+from jobs import JobQueue
+from page_cache import get_page_cache
+from document_store import get_document_store
+from search_index import SearchIndex, get_search_index
+from sitemap import default_sitemap_url, fetch_sitemaps, lastmods
+from robots import create_policy
+from matcher import get_matcher, highlight, non_overlapping
+from snippets import PageResult, json_default, match_document
+from extraction import extract_document
+from parse_pool import get_parse_pool, parse_and_match
+from history_store import get_history_store
+from result_cache import get_result_cache, result_key
+from frontier import LinkScorer, frontier_strategy, match_density
+from urls import canonicalize
+from metrics import REGISTRY, SEARCHES, SEARCHES_IN_PROGRESS, STAGE_SECONDS, StageTimings
+from logs import configure_logging, page_logger, search_context
 
-# ロギングの設定
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+# ロギングの設定（キュー経由でバックグラウンドのスレッドが書き出す。LOG_LEVEL・LOG_LEVELS・LOG_FORMAT）
+configure_logging()
+logger = logging.getLogger(__name__)
+page_log = page_logger(__name__ + '.pages')
 
-# 環境変数の読み込み
-load_dotenv()
+class RecordJSONProvider(DefaultJSONProvider):
+    """検索結果のPageResultもjsonifyでそのままJSONにする（辞書にコピーしない）"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, PageResult):
+            return o.to_json()
+        return DefaultJSONProvider.default(o)
 
 app = Flask(__name__)
+app.json = RecordJSONProvider(app)
 app.secret_key = os.environ.get('SECRET_KEY', os.urandom(24))
 
 # デバッグモードの設定
@@ -114,17 +142,56 @@ def index():
 @app.route('/history')
 @login_required
 def history():
-    """検索履歴ページを表示"""
+    """検索履歴ページを表示（qを指定するとクロール済みページを索引から検索）"""
+    # 履歴は新しい順にページ単位で取得
+    page, per_page = _page_params()
+    history, total = get_history_store().recent(page, per_page)
+    
+    query = request.args.get('q', '').strip()
+    index_results = None
+    search_index = get_search_index()
+    if query and search_index is not None:
+        index_results = _index_search(search_index, query, request.args.get('base_url'))
+    
+    return render_template('history.html', history=history, query=query, index_results=index_results,
+                           index_enabled=search_index is not None, page=page, per_page=per_page, total=total)
+
+def _page_params():
+    """クエリ文字列からページ番号と1ページの件数を取得"""
     try:
-        with open('search_history.json', 'r', encoding='utf-8') as f:
-            history = json.load(f)
-    except FileNotFoundError:
-        history = []
+        page = max(int(request.args.get('page', 1)), 1)
+        per_page = min(max(int(request.args.get('per_page', 10)), 1), 100)
+    except ValueError:
+        page, per_page = 1, 10
+    return page, per_page
+
+def _index_search(search_index, query, base_url=None):
+    """索引の検索結果にフィールドごとの一致数を付ける"""
+    pages = search_index.search(query, url_prefix=base_url or None)
+    for page in pages:
+        page['matches'] = {field: len(positions) for field, positions in page['positions'].items()}
+    return pages
+
+@app.route('/index/search', methods=['GET'])
+@login_required
+def index_search():
+    """クロール済みページを転置インデックスから検索（一致位置付き）"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '検索テキストを入力してください。'})
     
-    # 履歴を日時でソート（新しい順）
-    history.sort(key=lambda x: x.get('last_updated', ''), reverse=True)
+    search_index = get_search_index()
+    if search_index is None:
+        return jsonify({'error': '検索インデックスが無効です。'})
     
-    return render_template('history.html', history=history)
+    pages = _index_search(search_index, query, request.args.get('base_url'))
+    return jsonify({
+        'success': True,
+        'search_text': query,
+        'length': len(query),
+        'results': pages,
+        'total_results': len(pages)
+    })
 
 class WebTextSearcher:
     def __init__(self):
@@ -132,33 +199,49 @@ class WebTextSearcher:
         self.visited_urls = set()
         self.max_depth = 3
         self.max_pages = 100
+        self.max_workers = int(os.environ.get('CRAWL_WORKERS', 8))
+        # フェッチバックエンド（'thread' または 'async'）とホストごとの同時接続数
+        self.fetch_backend = os.environ.get('FETCH_BACKEND', 'thread')
+        self.per_host_limit = int(os.environ.get('CRAWL_PER_HOST', 8))
+        # フロンティア（'bfs'は幅優先、'best'は検索語に関係がありそうなリンクから取得する最良優先）
+        self.frontier = frontier_strategy()
+        # クロールの上限（経過秒数・一致したページ数・受信したバイト数。0なら無制限）。
+        # 上限に達したらそこまでの結果を返す
+        self.deadline = float(os.environ.get('CRAWL_DEADLINE', 0))
+        self.max_matches = int(os.environ.get('CRAWL_MAX_MATCHES', 0))
+        self.max_bytes = int(os.environ.get('CRAWL_MAX_BYTES', 0))
         self.session = requests.Session()
         self.session.headers.update({
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
         })
-        self.history_file = 'search_history.json'
-        self.load_history()
-
-    def load_history(self):
-        """検索履歴を読み込む"""
-        if os.path.exists(self.history_file):
-            try:
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    self.search_history = json.load(f)
-            except:
-                self.search_history = {}
-        else:
-            self.search_history = {}
+        # 並列ワーカー数に合わせてコネクションプールを広げる
+        adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # ページキャッシュ（PAGE_CACHE_PATHが空なら無効）
+        self.page_cache = get_page_cache()
+        # 抽出済み文書のストア（DOCUMENT_STORE_PATHが空なら保存しない）
+        self.document_store = get_document_store()
+        # 転置インデックス（SEARCH_INDEX_PATHが空なら使わない）
+        self.search_index = get_search_index()
+        # 検索履歴（検索テキストごとの検索済みURLもここに記録する）
+        self.history_store = get_history_store()
+        # 段階（取得・解析・検索・保存・履歴など）ごとの所要時間
+        self.timings = StageTimings()
 
-    def save_history(self):
-        """検索履歴を保存"""
-        with open(self.history_file, 'w', encoding='utf-8') as f:
-            json.dump(self.search_history, f, ensure_ascii=False, indent=2)
+    def set_limits(self, limits=None):
+        """リクエストで指定された上限（{'deadline', 'max_matches', 'max_bytes', 'max_depth', 'max_pages'}）を設定する
 
-    def _highlight_text(self, text, search_text):
-        """検索テキストをハイライト表示"""
-        pattern = re.compile(re.escape(search_text), re.IGNORECASE)
-        return pattern.sub(lambda m: f'<mark>{m.group()}</mark>', text)
+        環境変数で上限が設定されていれば、それより緩い値は指定できない。深さ・ページ数は
+        常に上限があるので、設定より小さい値だけを使う。
+        """
+        for name, value in (limits or {}).items():
+            configured = getattr(self, name)
+            if name in ('max_depth', 'max_pages'):
+                if value < configured:
+                    setattr(self, name, value)
+            elif value and (not configured or value < configured):
+                setattr(self, name, value)
 
     def _is_same_domain(self, url, base_url):
         """同じドメインかチェック"""
@@ -167,243 +250,482 @@ class WebTextSearcher:
         except:
             return False
 
-    def search(self, url, search_text, auth=None, skip_visited=True):
-        """指定されたURLから検索を開始"""
-        print(f"検索開始: URL={url}, 検索テキスト={search_text}")
+    def search(self, url, search_text, auth=None, skip_visited=True, progress_callback=None, previous=None):
+        """指定されたURLから検索を開始
+
+        progress_callback(message, page_result)はページを検索するたびに呼ばれる
+        （page_resultはマッチが無ければNone）。previousに同じ検索の履歴（crawl_idと
+        整形済みの結果）を渡すと、変更されたページだけを取得・検索する差分クロールになる。
+        """
+        logger.info("検索開始: URL=%s, 検索テキスト=%s", url, search_text)
         self.visited_urls = set()
-        results = []
         
         # 検索履歴から既に検索済みのURLを取得
-        if skip_visited and search_text in self.search_history:
-            self.visited_urls.update(self.search_history[search_text]['urls'])
-            print(f"既に検索済みのURL数: {len(self.visited_urls)}")
+        if skip_visited and search_text:
+            self.visited_urls.update(self.history_store.visited_urls(search_text))
+            logger.info("既に検索済みのURL数: %d", len(self.visited_urls))
+        previous_urls = set(self.visited_urls)
         
         try:
-            self._search_page(url, search_text, depth=0, results=results, auth=auth)
-            
-            # 検索履歴を更新
-            if search_text not in self.search_history:
-                self.search_history[search_text] = {
-                    'urls': [],
-                    'results': [],
-                    'last_updated': datetime.now().isoformat()
+            on_page = None
+            if progress_callback:
+                on_page = lambda message, page_matches: progress_callback(message, page_matches.get(search_text))
+            if previous is not None and previous.get('crawl_id') is not None and search_text:
+                previous = {
+                    'crawl_id': previous['crawl_id'],
+                    'results': {search_text: {result['url']: result for result in previous.get('results', [])}}
                 }
+            else:
+                previous = None
+            crawl = self._crawl(url, [search_text] if search_text else [], auth, on_page, previous)
+            results = crawl['results'].get(search_text, [])
             
-            # 新しい結果を追加
-            self.search_history[search_text]['urls'].extend(list(self.visited_urls))
-            self.search_history[search_text]['results'].extend(results)
-            self.search_history[search_text]['last_updated'] = datetime.now().isoformat()
-            
-            # 重複を除去
-            self.search_history[search_text]['urls'] = list(set(self.search_history[search_text]['urls']))
+            if not search_text:
+                return dict(crawl, success=True, results=[])
             
-            self.save_history()
+            # 今回新たに検索したURLだけを追記する
+            self.history_store.add_visited(search_text, self.visited_urls - previous_urls)
             
+            return dict(crawl, success=True, results=results)
+        except Exception as e:
+            logger.exception("検索中にエラー: %s", e)
             return {
-                'success': True,
-                'results': results,
-                'total_pages': len(self.visited_urls)
+                'success': False,
+                'error': str(e)
             }
+
+    def search_many(self, url, search_texts, auth=None, progress_callback=None):
+        """1回のクロールで複数の検索語を検索し、{検索語: 検索結果のリスト}を返す
+
+        progress_callback(message, page_matches)はページを検索するたびに
+        {検索語: 検索結果}とともに呼ばれる。
+        """
+        logger.info("検索開始: URL=%s, 検索テキスト数=%d", url, len(search_texts))
+        self.visited_urls = set()
+        try:
+            return dict(self._crawl(url, search_texts, auth, progress_callback), success=True)
         except Exception as e:
-            print(f"検索中にエラー: {str(e)}")
+            logger.exception("検索中にエラー: %s", e)
             return {
                 'success': False,
                 'error': str(e)
             }
 
-    def _search_page(self, url, search_text, depth=0, results=None, auth=None):
-        """ページを検索し、結果を追加"""
-        if results is None:
-            results = []
-            
-        if (url in self.visited_urls or 
-            depth > self.max_depth or 
-            len(self.visited_urls) >= self.max_pages):
-            return
-            
-        self.visited_urls.add(url)
-        print(f"ページを検索中: {url} (深さ: {depth})")
+    def _crawl(self, url, search_texts, auth=None, progress_callback=None, previous=None):
+        """クロールしながら各ページを検索語で検索する
+
+        previous（{'crawl_id', 'results': {検索語: {URL: 検索結果}}}）を渡すと差分クロールになり、
+        前回から変わっていないページは保存済みの文書と検索結果をそのまま使う。
+        上限（deadline・max_matches・max_bytes）に達したら取得待ちのページを取り消し、
+        そこまでの結果をstop_reason（上限の種類。最後までクロールしたら'completed'）とともに返す。
+        """
+        results = {search_text: [] for search_text in search_texts}
+        budget = CrawlBudget(self.deadline, self.max_matches, self.max_bytes)
+        headers = self._request_headers(auth)
+        # robots.txtの禁止・Crawl-delayを守り、サイトマップのURLもクロール対象に加える
+        policy = create_policy(self.session, self.timeout, headers)
+        if previous is not None and self.document_store is None:
+            previous = None
+        # 抽出した文書を保存しておき、別の検索語では再クロールせずに検索できるようにする
+        crawl_id = None
+        if self.document_store is not None:
+            crawl_id = self.document_store.create_crawl(url, self.max_depth, self.max_pages)
+            # 古いクロールの文書を削除し、どのクロールにも残っていないページは索引からも削除する
+            removed = self.document_store.prune()
+            if self.search_index is not None:
+                self.search_index.remove_pages(removed)
+        coordinator = None
+        if distributed_enabled() and auth:
+            # 認証情報は共有の設定（Redis）に保存しないので、認証付きのクロールはこのワーカーだけで行う
+            logger.info("Basic認証付きのクロールは協調クロールにしない: %s", url)
+        elif distributed_enabled():
+            # 他のワーカーはこの設定でページを検索する（差分クロールの前回の結果・認証情報は渡さない）
+            coordinator = create_coordinator(max_pages=self.max_pages, spec={
+                'url': url,
+                'search_texts': search_texts,
+                'crawl_id': crawl_id,
+                'max_depth': self.max_depth
+            })
+        engine = create_engine(self.fetch_backend, self.max_depth, self.max_pages,
+                               self.max_workers, self.timeout, self.per_host_limit,
+                               session=self.session, cache=self.page_cache, policy=policy,
+                               coordinator=coordinator,
+                               prepare=self._prepare_stage(search_texts, previous is not None),
+                               frontier=self.frontier, budget=budget)
+        engine.fetcher.timings = self.timings
+        seeds = policy.seeds(url) if policy is not None else None
+        changes = None
+        if previous is not None:
+            changes = {'new': 0, 'changed': 0, 'unchanged': 0}
+            # サイトマップのlastmodが前回の取得より古いページはリクエストせずにキャッシュを使う
+            if policy is not None:
+                engine.fetcher.lastmod = policy.lastmods(url)
+            else:
+                engine.fetcher.lastmod = lastmods(fetch_sitemaps(self.session, [default_sitemap_url(url)],
+                                                                 self.timeout, headers))
+        # 最良優先では、リンクテキスト・URL・リンク元の一致の密度からリンクの優先度を計算する
+        scorer = LinkScorer(search_texts) if self.frontier == 'best' and search_texts else None
+        process = lambda page_url, depth, page: self._search_page(page_url, search_texts, depth, page, crawl_id,
+                                                                  previous, changes, scorer)
+        crawl = engine.run(url, process, self.visited_urls, headers, seeds)
+        processed = set()
+        stop_reason = None
+        try:
+            for page_url, depth, page_matches in crawl:
+                # 上限に達した後に取得しなかったページ（結果がNone）は訪問済みにしない
+                if page_matches is not None or not budget.stop_reason():
+                    processed.add(canonicalize(page_url))
+                page_matches = page_matches or {}
+                for search_text, page_results in page_matches.items():
+                    results[search_text].append(page_results)
+                if progress_callback:
+                    progress_callback(f"検索済み: {page_url} (深さ: {depth})", page_matches)
+                if page_matches:
+                    budget.add_match()
+                stop_reason = budget.exhausted()
+                if stop_reason:
+                    logger.info("クロールの上限に達したので終了: %s (%s)", url, stop_reason)
+                    break
+        finally:
+            # 途中で終えた場合も、取得待ちのページを取り消してワーカーを止める
+            crawl.close()
+        # エンジンが上限に達して取得をやめた場合も、理由を返す
+        stop_reason = stop_reason or budget.stop_reason()
+        if stop_reason:
+            # 取り消して検索しなかったページは訪問済みにしない
+            self.visited_urls.intersection_update(processed)
+        if crawl_id is not None:
+            self.document_store.finish_crawl(crawl_id, len(self.visited_urls))
+        
+        return {
+            'results': results,
+            'total_pages': len(self.visited_urls),
+            'crawl_id': crawl_id,
+            'cache': engine.fetcher.cache_stats.to_dict(),
+            'changes': changes,
+            'stop_reason': stop_reason or 'completed'
+        }
+
+    def assist(self, coordinator):
+        """他のワーカーが始めた協調クロールを手伝う（結果はジョブを始めたワーカーが集める）"""
+        spec = coordinator.spec()
+        headers = self._request_headers()
+        self.max_depth = spec.get('max_depth', self.max_depth)
+        policy = create_policy(self.session, self.timeout, headers)
+        engine = create_engine(self.fetch_backend, self.max_depth, self.max_pages,
+                               self.max_workers, self.timeout, self.per_host_limit,
+                               session=self.session, cache=self.page_cache, policy=policy,
+                               coordinator=coordinator, prepare=self._prepare_stage(spec['search_texts']))
+        engine.fetcher.timings = self.timings
+        process = lambda page_url, depth, page: self._search_page(page_url, spec['search_texts'], depth, page,
+                                                                  spec.get('crawl_id'))
+        engine.work(process, headers)
+
+    def crawl(self, url, auth=None, progress_callback=None):
+        """検索せずにクロールだけ行い、抽出した文書を文書ストアに保存する"""
+        return self.search(url, None, auth=auth, skip_visited=False,
+                           progress_callback=progress_callback)
+
+    def _request_headers(self, auth=None):
+        """リクエストヘッダーを作成（Basic認証を含む）"""
+        headers = {
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+        }
+        if auth:
+            auth_str = f"{auth['username']}:{auth['password']}"
+            auth_bytes = auth_str.encode('ascii')
+            base64_bytes = base64.b64encode(auth_bytes)
+            headers['Authorization'] = f"Basic {base64_bytes.decode('ascii')}"
+        return headers
+
+    def _search_page(self, url, search_texts, depth, page, crawl_id=None, previous=None, changes=None,
+                     scorer=None):
+        """取得済みのページを検索し、({検索語: 検索結果}, 次の階層のリンク)を返す
+
+        取得・訪問済み・深さ・ページ数の判定はクロールエンジンが行うため、
+        ここでは1ページ分の解析と検索だけを行う。crawl_idを渡すと抽出した
+        文書を文書ストアに保存する。差分クロールでは前回から変わっていない
+        ページの解析・検索を省き、前回の検索結果を返す。scorer（LinkScorer）を
+        渡すと、リンクを(URL, 優先度)で返す。
+        """
+        page_matches = {}
+        links = []
+        page_log.debug("ページを検索中: %s (深さ: %d)", url, depth)
         
         try:
-            # ページを取得
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            if auth:
-                auth_str = f"{auth['username']}:{auth['password']}"
-                auth_bytes = auth_str.encode('ascii')
-                base64_bytes = base64.b64encode(auth_bytes)
-                headers['Authorization'] = f"Basic {base64_bytes.decode('ascii')}"
+            stored = None
+            if previous is not None:
+                with self.timings.stage('store'):
+                    stored = self.document_store.get_document(previous['crawl_id'], url)
+            with self.timings.stage('parse'):
+                prepared = self._prepared(url, page)
+                if stored is not None and page.not_modified:
+                    # 304・サイトマップで未更新と分かったページは解析しない
+                    document = dict(stored, depth=depth)
+                elif prepared is not None:
+                    document = prepared[0]
+                else:
+                    document = extract_document(url, depth, page)
+            unchanged = (stored is not None and
+                         SearchIndex.content_hash(document) == SearchIndex.content_hash(stored))
+            if changes is not None:
+                changes['unchanged' if unchanged else 'changed' if stored is not None else 'new'] += 1
             
-            response = self.session.get(url, timeout=self.timeout, headers=headers)
-            response.raise_for_status()
-            soup = BeautifulSoup(response.text, 'html.parser')
+            with self.timings.stage('store'):
+                if crawl_id is not None:
+                    self.document_store.add_document(crawl_id, document)
+                if self.search_index is not None and not unchanged:
+                    self.search_index.add_document(document)
             
-            # ページの検索結果を格納
-            page_results = {
-                'url': url,
-                'title': soup.find('title').get_text() if soup.find('title') else url,
-                'depth': depth,
-                'body_matches': [],
-                'head_matches': [],
-                'href_matches': []
-            }
-            
-            # 本文の検索
-            text = soup.get_text()
-            clean_text = ' '.join(text.split())
-            if search_text.lower() in clean_text.lower():
-                highlighted_text = self._highlight_text(clean_text, search_text)
-                page_results['body_matches'] = [highlighted_text]
-            
-            # headタグ内の検索
-            head = soup.find('head')
-            if head:
-                head_text = head.get_text()
-                if search_text.lower() in head_text.lower():
-                    highlighted_text = self._highlight_text(head_text, search_text)
-                    page_results['head_matches'] = [highlighted_text]
-            
-            # href属性の検索
-            for link in soup.find_all('a', href=True):
-                href = link['href']
-                link_text = link.get_text().strip()
-                
-                try:
-                    # 相対URLを絶対URLに変換
-                    full_url = urljoin(url, href)
-                    normalized_url = full_url.rstrip('/')
-                    
-                    # 検索テキストが数字の場合の特別な処理
-                    if search_text.isdigit():
-                        if f"/journal/{search_text}" in normalized_url:
-                            highlighted_url = self._highlight_text(full_url, search_text)
-                            highlighted_text = self._highlight_text(link_text, search_text) if link_text else highlighted_url
-                            page_results['href_matches'].append({
-                                'text': highlighted_text,
-                                'href': highlighted_url,
-                                'original_url': full_url,
-                                'page_url': url
-                            })
-                    # 通常のテキスト検索
-                    elif search_text.lower() in normalized_url.lower() or search_text.lower() in link_text.lower():
-                        highlighted_url = self._highlight_text(full_url, search_text)
-                        highlighted_text = self._highlight_text(link_text, search_text) if link_text else highlighted_url
-                        page_results['href_matches'].append({
-                            'text': highlighted_text,
-                            'href': highlighted_url,
-                            'original_url': full_url,
-                            'page_url': url
-                        })
-                except Exception as e:
-                    print(f"リンクの処理中にエラー: {href} - {str(e)}")
-                    continue
-            
-            # マッチがある場合のみ結果に追加
-            if any([page_results['body_matches'], page_results['head_matches'], page_results['href_matches']]):
-                # 同じURLの結果が既に存在する場合は、より深い階層の結果を優先
-                existing_result = next((r for r in results if r['url'] == url), None)
-                if existing_result is None or existing_result['depth'] > depth:
-                    if existing_result is not None:
-                        results.remove(existing_result)
-                    results.append(page_results)
+            if search_texts and unchanged:
+                # 内容が同じなら前回の検索結果を使う（深さだけ今回のクロールに合わせる）
+                for search_text in search_texts:
+                    result = previous['results'].get(search_text, {}).get(url)
+                    if result is not None:
+                        page_matches[search_text] = PageResult.from_json(result)
+                        page_matches[search_text].depth = depth
+            elif search_texts and prepared is not None:
+                page_matches = prepared[1]
+            elif search_texts:
+                with self.timings.stage('match'):
+                    page_matches = self._match_document(document, search_texts)
             
             # 次の階層のリンクを取得
             if depth < self.max_depth:
-                for link in soup.find_all('a', href=True):
-                    href = link['href']
-                    try:
-                        full_url = urljoin(url, href)
-                        if self._is_same_domain(full_url, url) and full_url not in self.visited_urls:
-                            self._search_page(full_url, search_text, depth + 1, results, auth)
-                    except Exception as e:
-                        print(f"リンクの処理中にエラー: {href} - {str(e)}")
-                        continue
+                links = [(full_url, text) for full_url, text in document['links']
+                         if self._is_same_domain(full_url, url)]
+                if scorer is not None:
+                    match_count = sum(result.matches for result in page_matches.values())
+                    links = scorer.score_links(links, match_density(match_count, len(document['body_text'])), url)
+                else:
+                    links = [full_url for full_url, _ in links]
                         
         except Exception as e:
-            print(f"ページの検索中にエラー: {url} - {str(e)}")
+            logger.warning("ページの検索中にエラー: %s - %s", url, e)
+        
+        return page_matches, links
 
-@app.route('/search', methods=['POST'])
-@login_required
-@limiter.limit("10 per minute")
-def search():
-    """検索を実行"""
-    url = request.form.get('url')
-    search_text = request.form.get('search_text')
-    is_research = request.form.get('is_research') == 'true'
-    
-    if not url or not search_text:
-        return jsonify({'error': 'URLと検索テキストを入力してください。'})
+    def _prepare_stage(self, search_texts, incremental=False):
+        """解析プール（PARSE_WORKERS）があれば、取得したページの解析・検索をワーカープロセスに投入する関数
+
+        差分クロールでは、保存済みの文書を使う未更新のページは投入しない。
+        """
+        parse_pool = get_parse_pool()
+        if parse_pool is None:
+            return None
+        def prepare(url, depth, page):
+            if incremental and page.not_modified:
+                return None
+            return parse_pool.submit(parse_and_match, url, page, depth, search_texts)
+        return prepare
+
+    def _prepared(self, url, page):
+        """ワーカープロセスで解析・検索済みなら(文書, {検索語: 検索結果})を返す（無いか失敗したらNone）"""
+        if page.prepared is None:
+            return None
+        try:
+            return page.prepared.result()
+        except Exception as e:
+            logger.warning("ワーカープロセスでの解析中にエラー: %s - %s", url, e)
+            return None
+
+    def _match_document(self, document, search_texts):
+        """抽出済みの文書を検索し、{検索語: 検索結果}を返す（マッチした検索語のみ）"""
+        return match_document(document, search_texts)
+
+    def search_documents(self, crawl_id, search_texts):
+        """保存済みのクロールから複数の検索語を検索（ネットワークアクセス・HTML解析なし）
+
+        {検索語: 検索結果のリスト}を返す。
+        """
+        results = {search_text: [] for search_text in search_texts}
+        
+        # 転置インデックスで検索語を含むページを先に絞り込む
+        hits = None
+        if self.search_index is not None:
+            hits = {search_text: {page['url'] for page in self.search_index.search(search_text)}
+                    for search_text in search_texts}
+            indexed = self.search_index.page_hashes()
+        
+        for document in self.document_store.iter_documents(crawl_id):
+            # 索引が文書と同じ内容のときだけ絞り込みを使う（再クロールで内容が変わった場合など）
+            use_index = (hits is not None and
+                         indexed.get(document['url']) == self.search_index.content_hash(document))
+            candidates = [search_text for search_text in search_texts
+                          if not use_index or document['url'] in hits[search_text]]
+            if not candidates:
+                continue
+            for search_text, page_results in self._match_document(document, candidates).items():
+                results[search_text].append(page_results)
+        return results
+
+    def highlight_document(self, document, search_text):
+        """保存済みの1ページについて、本文・head全体のハイライトを返す（検索結果はスニペットのみのため）"""
+        hits = {}
+        length = len(search_text)
+        for field, text in (('body', document['body_text']), ('head', document['head_text'])):
+            offsets = non_overlapping(get_matcher([search_text]).scan(text).get(search_text, []), length)
+            hits[field] = {'count': len(offsets), 'html': highlight(text, offsets, length)}
+        return {
+            'url': document['url'],
+            'title': document['title'],
+            'depth': document['depth'],
+            'body': hits['body'],
+            'head': hits['head']
+        }
+
+def format_result(result):
+    """1ページ分の検索結果をレスポンス用のPageResultにする
+
+    PageResultはそのまま返し（コピーしない）、辞書（前回の検索結果など）は変換する。
+    レスポンス・履歴に書き出すときにPageResult.to_json()の形のJSONになる。
+    """
+    if isinstance(result, PageResult):
+        return result
+    return PageResult.from_json(result)
+
+def format_searches(results, search_texts):
+    """複数の検索語の検索結果を検索語ごとに整形"""
+    searches = []
+    for search_text in search_texts:
+        formatted_results = [format_result(result) for result in results.get(search_text, [])]
+        searches.append({
+            'search_text': search_text,
+            'results': formatted_results,
+            'total_results': len(formatted_results),
+            'total_matches': sum(r.matches for r in formatted_results)
+        })
+    return searches
+
+def run_batch_search(url, search_texts, limits=None):
+    """1回のクロールで複数の検索語を検索し、レスポンス用の辞書を返す"""
+    try:
+        searcher = WebTextSearcher()
+        searcher.set_limits(limits)
+        with search_context():
+            results = searcher.search_many(url, search_texts)
+        if not results['success']:
+            return {'error': results['error']}
+        return {
+            'success': True,
+            'searches': format_searches(results['results'], search_texts),
+            'total_pages': results.get('total_pages', 0),
+            'crawl_id': results.get('crawl_id'),
+            'cache': results.get('cache'),
+            'stop_reason': results.get('stop_reason'),
+            'partial': results.get('stop_reason') != 'completed'
+        }
+    except Exception as e:
+        return {'error': str(e)}
+
+def run_search(url, search_text, is_research=False, progress_callback=None, include_metrics=False,
+               limits=None):
+    """検索を実行して履歴に保存し、レスポンス用の辞書を返す
+
+    progress_callback(event_type, data)を渡すと、ページごとの進捗（'progress'）と
+    マッチしたページの整形済み結果（'result'）を通知する。include_metricsがTrueなら
+    段階ごとの所要時間（timings）をレスポンスに含める。limits（{'deadline', 'max_matches',
+    'max_bytes'}）に達したら、そこまでの結果をpartialとstop_reasonを付けて返す。
+    """
+    SEARCHES_IN_PROGRESS.inc()
+    searcher = WebTextSearcher()
+    searcher.set_limits(limits)
+    try:
+        # この検索で記録するログには全てsearch_idを付ける
+        with search_context() as search_id, searcher.timings.stage('search'):
+            response = _cached_search(searcher, url, search_text, is_research, progress_callback)
+            logger.info("検索終了: URL=%s, 検索テキスト=%s", url, search_text,
+                        extra={'total_pages': response.get('total_pages'),
+                               'total_results': response.get('total_results'),
+                               'error': response.get('error')})
+    finally:
+        SEARCHES_IN_PROGRESS.dec()
+    response['search_id'] = search_id
+    SEARCHES.inc(status='failed' if response.get('error') else 'success')
+    if include_metrics:
+        response['timings'] = searcher.timings.to_dict()
+    return response
+
+def _cached_search(searcher, url, search_text, is_research, progress_callback):
+    """検索結果のキャッシュを使って検索する
+
+    同じベースURL・検索語・クロールの設定の検索はTTLの間キャッシュから返し、同時に
+    実行中なら1回のクロールの結果を共有する。再検索は常にクロールしてキャッシュを置き換える。
+    """
+    cache = get_result_cache()
+    if cache is None:
+        return _run_search(searcher, url, search_text, is_research, progress_callback)
+    # 上限が違う検索は結果が違いうるので、上限もキーに含める
+    key = result_key(url, search_text, searcher.max_depth, searcher.max_pages,
+                     searcher.deadline, searcher.max_matches, searcher.max_bytes)
+    if is_research:
+        response = _run_search(searcher, url, search_text, is_research, progress_callback)
+        cache.put(key, url, response)
+        return response
     
+    response, computed = cache.get_or_compute(
+        key, url, lambda: _run_search(searcher, url, search_text, is_research, progress_callback))
+    if not computed:
+        response['cached'] = True
+        # キャッシュや他の検索から受け取った結果も、ページごとの結果として通知する
+        if progress_callback:
+            for result in response.get('results', []):
+                progress_callback('result', result)
+        if response.get('success'):
+            with searcher.timings.stage('history'):
+                _add_cached_history(url, search_text, response)
+    return response
+
+def _add_cached_history(url, search_text, response):
+    """キャッシュや他の検索から受け取った結果を、この検索の履歴として記録する
+
+    クロールはしていないので、検索済みのURLには結果のページのURLだけを追記する。
+    """
+    history_store = get_history_store()
+    results = response.get('results', [])
+    history_store.add({
+        'search_text': search_text,
+        'base_url': url,
+        'results': results,
+        'total_urls': response.get('total_pages', 0),
+        'total_results': len(results),
+        'last_updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'is_research': False,
+        'crawl_id': response.get('crawl_id'),
+        'changes': response.get('changes'),
+        'stop_reason': response.get('stop_reason'),
+        'cached': True
+    })
+    history_store.add_visited(search_text, {_result_url(result) for result in results})
+
+def _result_url(result):
+    """整形済みの結果（PageResult、またはキャッシュから読み込んだ辞書）のURL"""
+    return result['url'] if isinstance(result, dict) else result.url
+
+def _run_search(searcher, url, search_text, is_research, progress_callback):
     try:
-        # 検索履歴を読み込む
-        history = []
-        try:
-            with open('search_history.json', 'r', encoding='utf-8') as f:
-                history = json.load(f)
-                if not isinstance(history, list):
-                    history = []
-        except (FileNotFoundError, json.JSONDecodeError):
-            history = []
+        history_store = get_history_store()
         
-        # 前回の検索結果を取得
+        # 前回の検索結果を取得（同じ検索テキスト・URLの最新の履歴）
         previous_results = None
-        if is_research and history and len(history) > 0:
-            try:
-                previous_results = history[0]  # 最新の検索結果
-            except (IndexError, TypeError):
-                previous_results = None
+        if is_research:
+            with searcher.timings.stage('history'):
+                previous_results = history_store.latest(search_text=search_text, base_url=url)
         
-        # 検索を実行
-        searcher = WebTextSearcher()
-        results = searcher.search(url, search_text)
+        def on_page(message, page_result=None):
+            progress_callback('progress', {'message': message})
+            if page_result:
+                progress_callback('result', format_result(page_result))
+        
+        # 検索を実行（再検索は前回から変更・追加されたページだけを取得・検索する差分クロール）
+        results = searcher.search(url, search_text, skip_visited=False,
+                                  progress_callback=on_page if progress_callback else None,
+                                  previous=previous_results)
         
         if results['success']:
             # 検索結果を整形
-            formatted_results = []
-            for result in results.get('results', []):
-                match_count = 0
-                body_matches = result.get('body_matches', [])
-                head_matches = result.get('head_matches', [])
-                href_matches = result.get('href_matches', [])
-                
-                if body_matches:
-                    match_count += len(body_matches)
-                if head_matches:
-                    match_count += len(head_matches)
-                if href_matches:
-                    match_count += len(href_matches)
-                
-                snippets = []
-                if body_matches:
-                    snippets.extend(body_matches)
-                if head_matches:
-                    snippets.extend(head_matches)
-                
-                # href_matchesの各要素が辞書であることを保証し、リンクテキストとURLをセット
-                href_snippets = []
-                for h in href_matches:
-                    try:
-                        if isinstance(h, dict):
-                            text = h.get('text', '')
-                            url = h.get('original_url', h.get('href', ''))
-                            href_snippets.append({'text': text, 'url': url})
-                        elif isinstance(h, str):
-                            href_snippets.append({'text': h, 'url': h})
-                    except Exception as e:
-                        print(f"href_matchの処理中にエラー: {str(e)}")
-                        continue
-                
-                formatted_results.append({
-                    'url': result.get('url', ''),
-                    'title': result.get('title', '') or result.get('url', ''),
-                    'depth': result.get('depth', 0),  # 階層情報を追加
-                    'matches': match_count,
-                    'body_matches': body_matches,
-                    'head_matches': head_matches,
-                    'href_matches': href_snippets,
-                    'snippets': snippets
-                })
+            with searcher.timings.stage('format'):
+                formatted_results = [format_result(result) for result in results.get('results', [])]
             
             # 検索履歴に追加
             history_entry = {
@@ -413,56 +735,304 @@ def search():
                 'total_urls': results.get('total_pages', 0),
                 'total_results': len(formatted_results),
                 'last_updated': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                'is_research': is_research
+                'is_research': is_research,
+                'crawl_id': results.get('crawl_id'),
+                'changes': results.get('changes'),
+                'stop_reason': results.get('stop_reason')
             }
             
-            # 前回の検索結果がある場合、未検索のURLを追加
+            # 前回の検索結果がある場合、今回の結果に含まれなくなったURLを追加
             if is_research and previous_results:
                 previous_urls = {result['url'] for result in previous_results['results']}
-                new_urls = {result['url'] for result in formatted_results}
+                new_urls = {result.url for result in formatted_results}
                 skipped_urls = previous_urls - new_urls
                 
                 if skipped_urls:
                     history_entry['skipped_urls'] = list(skipped_urls)
                     history_entry['skipped_count'] = len(skipped_urls)
             
-            # 履歴を更新
-            history.insert(0, history_entry)
-            
-            # 履歴を保存（最新の10件のみ保持）
-            with open('search_history.json', 'w', encoding='utf-8') as f:
-                json.dump(history[:10], f, ensure_ascii=False, indent=2)
+            # 履歴に追記（古い履歴はストアがHISTORY_MAX_ENTRIES件を超えた分を削除）
+            with searcher.timings.stage('history'):
+                history_store.add(history_entry)
             
-            return jsonify({
+            return {
                 'success': True,
                 'results': formatted_results,
                 'total_pages': results.get('total_pages', 0),
                 'total_results': len(formatted_results),
                 'is_research': is_research,
                 'skipped_urls': history_entry.get('skipped_urls', []),
-                'skipped_count': history_entry.get('skipped_count', 0)
-            })
+                'skipped_count': history_entry.get('skipped_count', 0),
+                'crawl_id': results.get('crawl_id'),
+                'cache': results.get('cache'),
+                'changes': results.get('changes'),
+                'stop_reason': results.get('stop_reason'),
+                'partial': results.get('stop_reason') != 'completed'
+            }
         else:
-            return jsonify({'error': results['error']})
+            return {'error': results['error']}
     
     except Exception as e:
-        return jsonify({'error': str(e)})
+        return {'error': str(e)}
+
+def stream_search(url, search_text, is_research=False, include_metrics=False, limits=None):
+    """検索を別のスレッドで実行し、レスポンスのNDJSONの行を順に返すジェネレーター
+
+    マッチしたページごとに{'type': 'result', 'data': 整形済みの結果}を、検索したページが
+    見つかった順にすぐ返し、最後に結果のリストを除いたrun_searchのレスポンスを
+    {'type': 'summary', 'data': ...}として返す。クライアントが切断したら以降の結果は捨てる。
+    """
+    records = queue.Queue()
+    closed = threading.Event()
+    
+    def on_event(event_type, data):
+        if event_type == 'result' and not closed.is_set():
+            records.put({'type': 'result', 'data': data})
+    
+    def run():
+        try:
+            response = run_search(url, search_text, is_research, on_event, include_metrics, limits)
+        except Exception as e:
+            response = {'error': str(e)}
+        response.pop('results', None)
+        records.put({'type': 'summary', 'data': response})
+    
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            record = records.get()
+            yield json.dumps(record, ensure_ascii=False, default=json_default) + '\n'
+            if record['type'] == 'summary':
+                break
+    finally:
+        closed.set()
+
+def _search_params():
+    """フォームから検索パラメータを取得"""
+    return {
+        'url': request.form.get('url'),
+        'search_text': request.form.get('search_text'),
+        'is_research': request.form.get('is_research') == 'true',
+        'include_metrics': request.form.get('include_metrics') == 'true',
+        'limits': _search_limits()
+    }
+
+def _search_limits():
+    """フォームからクロールの上限（deadline秒・max_matches・max_bytes・max_depth・max_pages）を取得
+    （指定されたものだけ）
+
+    数でないか負の値ならValueError。
+    """
+    limits = {}
+    for name, convert in (('deadline', float), ('max_matches', int), ('max_bytes', int),
+                          ('max_depth', int), ('max_pages', int)):
+        value = request.form.get(name)
+        if value:
+            limits[name] = convert(value)
+            if limits[name] < 0:
+                raise ValueError(name)
+    return limits
+
+def _wants_stream():
+    """結果をNDJSONで逐次返すか（stream=true または Accept: application/x-ndjson）"""
+    if request.form.get('stream') == 'true':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+def _search_texts():
+    """フォームから検索テキストのリストを取得（複数指定・改行区切り）"""
+    search_texts = []
+    for value in request.form.getlist('search_text'):
+        for line in value.splitlines():
+            if line.strip() and line.strip() not in search_texts:
+                search_texts.append(line.strip())
+    return search_texts
+
+# 検索ジョブのキュー（ワーカー数は環境変数で変更可能）
+job_queue = JobQueue(
+    lambda params, progress_callback: run_search(progress_callback=progress_callback, **params),
+    max_workers=int(os.environ.get('SEARCH_JOB_WORKERS', 2))
+)
+
+@app.route('/search', methods=['POST'])
+@login_required
+@limiter.limit("10 per minute")
+def search():
+    """検索を実行（検索テキストを複数指定すると1回のクロールでまとめて検索）
+
+    stream=true（またはAccept: application/x-ndjson）なら、マッチしたページの結果を
+    1行1件のNDJSONで見つかった順に返し、最後の行にサマリーを返す（検索語が1つの場合）。
+    """
+    try:
+        params = _search_params()
+    except ValueError:
+        return jsonify({'error': '上限（deadline・max_matches・max_bytes・max_depth・max_pages）には0以上の数を指定してください。'})
+    
+    if not params['url'] or not params['search_text']:
+        return jsonify({'error': 'URLと検索テキストを入力してください。'})
+    
+    search_texts = _search_texts()
+    if len(search_texts) > 1:
+        return jsonify(run_batch_search(params['url'], search_texts, params['limits']))
+    
+    if _wants_stream():
+        return Response(stream_search(**params), mimetype='application/x-ndjson',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    
+    result = run_search(**params)
+    started = time.perf_counter()
+    response = jsonify(result)
+    STAGE_SECONDS.observe(time.perf_counter() - started, stage='serialize')
+    return response
+
+@app.route('/search/jobs', methods=['POST'])
+@login_required
+@limiter.limit("10 per minute")
+def submit_search_job():
+    """検索をジョブとして登録し、ジョブIDをすぐに返す"""
+    try:
+        params = _search_params()
+    except ValueError:
+        return jsonify({'error': '上限（deadline・max_matches・max_bytes・max_depth・max_pages）には0以上の数を指定してください。'})
+    
+    if not params['url'] or not params['search_text']:
+        return jsonify({'error': 'URLと検索テキストを入力してください。'})
+    
+    job = job_queue.submit(params)
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': url_for('search_job_status', job_id=job.id),
+        'events_url': url_for('search_job_events', job_id=job.id)
+    }), 202
+
+@app.route('/search/jobs/<job_id>', methods=['GET'])
+@login_required
+def search_job_status(job_id):
+    """ジョブの状態と（部分）結果を取得"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません。'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/search/jobs/<job_id>/events', methods=['GET'])
+@login_required
+def search_job_events(job_id):
+    """ジョブの進捗と部分結果をServer-Sent Eventsで配信"""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'ジョブが見つかりません。'}), 404
+    
+    def stream():
+        index = 0
+        while True:
+            events = job.wait_events(index)
+            if not events:
+                if job.finished:
+                    break
+                yield ': keep-alive\n\n'
+                continue
+            for event in events:
+                yield f"event: {event['type']}\ndata: {json.dumps(event['data'], ensure_ascii=False, default=json_default)}\n\n"
+            index += len(events)
+            if job.finished and index >= len(job.events):
+                break
+    
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/crawls', methods=['POST'])
+@login_required
+@limiter.limit("10 per minute")
+def create_crawl():
+    """検索せずにクロールだけ行い、文書ストアに保存する"""
+    url = request.form.get('url')
+    if not url:
+        return jsonify({'error': 'URLを入力してください。'})
+    
+    searcher = WebTextSearcher()
+    if searcher.document_store is None:
+        return jsonify({'error': '文書ストアが無効です。'})
+    
+    results = searcher.crawl(url)
+    if not results['success']:
+        return jsonify({'error': results['error']})
+    return jsonify({
+        'success': True,
+        'crawl_id': results['crawl_id'],
+        'total_pages': results['total_pages'],
+        'cache': results.get('cache')
+    })
+
+@app.route('/crawls/<int:crawl_id>/search', methods=['POST'])
+@login_required
+def search_crawl(crawl_id):
+    """保存済みのクロールを検索（検索テキストは複数指定・改行区切りも可）"""
+    search_texts = _search_texts()
+    if not search_texts:
+        return jsonify({'error': '検索テキストを入力してください。'})
+    
+    searcher = WebTextSearcher()
+    if searcher.document_store is None:
+        return jsonify({'error': '文書ストアが無効です。'})
+    crawl = searcher.document_store.get_crawl(crawl_id)
+    if crawl is None:
+        return jsonify({'error': 'クロールが見つかりません。'}), 404
+    
+    results = searcher.search_documents(crawl_id, search_texts)
+    return jsonify({
+        'success': True,
+        'crawl_id': crawl_id,
+        'base_url': crawl['base_url'],
+        'total_pages': crawl['total_pages'],
+        'searches': format_searches(results, search_texts)
+    })
+
+@app.route('/crawls/<int:crawl_id>/highlights', methods=['GET'])
+@login_required
+def crawl_highlights(crawl_id):
+    """保存済みのクロールから1ページ分の全文ハイライトを取得（url・search_textを指定）"""
+    page_url = request.args.get('url')
+    search_text = request.args.get('search_text', '').strip()
+    if not page_url or not search_text:
+        return jsonify({'error': 'URLと検索テキストを入力してください。'})
+    
+    searcher = WebTextSearcher()
+    if searcher.document_store is None:
+        return jsonify({'error': '文書ストアが無効です。'})
+    document = searcher.document_store.get_document(crawl_id, page_url)
+    if document is None:
+        return jsonify({'error': 'ページが見つかりません。'}), 404
+    
+    return jsonify(dict(searcher.highlight_document(document, search_text),
+                        success=True, crawl_id=crawl_id, search_text=search_text))
+
+@app.route('/search/cache', methods=['DELETE'])
+@login_required
+def invalidate_search_cache():
+    """検索結果のキャッシュを削除（base_urlを指定するとそのサイトの結果だけ）"""
+    cache = get_result_cache()
+    if cache is None:
+        return jsonify({'success': True, 'invalidated': 0})
+    return jsonify({'success': True, 'invalidated': cache.invalidate(request.args.get('base_url') or None)})
 
 @app.route('/search_history', methods=['GET'])
 @login_required
 def get_search_history():
-    """検索履歴を取得"""
+    """検索履歴を取得（page・per_page・search_text・base_urlで絞り込み）"""
     try:
-        if os.path.exists('search_history.json'):
-            with open('search_history.json', 'r', encoding='utf-8') as f:
-                history = json.load(f)
-            return jsonify({
-                'success': True,
-                'history': history
-            })
+        page, per_page = _page_params()
+        history, total = get_history_store().recent(
+            page, per_page,
+            search_text=request.args.get('search_text') or None,
+            base_url=request.args.get('base_url') or None
+        )
         return jsonify({
             'success': True,
-            'history': []
+            'history': history,
+            'page': page,
+            'per_page': per_page,
+            'total': total
         })
     except Exception as e:
         return jsonify({
@@ -482,6 +1052,23 @@ def internal_error(error):
     logging.error(f"Internal Server Error: {str(error)}")
     return jsonify({'error': 'Internal Server Error', 'details': str(error)}), 500
 
+# 協調クロール（DISTRIBUTED_CRAWL=1）では、他のワーカーが始めたクロールもこのワーカーで手伝う
+if distributed_enabled() and get_redis_client() is not None:
+    CrawlHelper(get_redis_client(), lambda coordinator: WebTextSearcher().assist(coordinator)).start()
+
+# 検索ジョブの状態ごとの数（キューの深さ）
+REGISTRY.gauge('search_jobs', '検索ジョブの数（状態ごと）',
+               lambda: {(('status', status),): count for status, count in job_queue.counts().items()})
+
+@app.route('/metrics')
+@limiter.exempt
+def metrics():
+    """Prometheusのテキスト形式のメトリクス（METRICS_TOKENを設定するとBearerトークンが必要）"""
+    token = os.environ.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/health')
 def health_check():
     return jsonify({'status': 'healthy'}), 200
@@ -0,0 +1,380 @@
+# -*- coding: utf-8 -*-
+"""ローカルの合成サイトに対するクロール・検索のベンチマーク
+
+    python benchmark.py --pages 500 --fanout 5 --latency 0.02 --output bench_results.json
+    python benchmark.py --compare bench_before.json bench_results.json
+
+app.WebTextSearcher.search・web_seacher.WebTextSearcher.search・/searchエンドポイントを
+それぞれ別のプロセスで実行し、ページ/秒・ページごとのレイテンシ（p50/p99）・最大RSS・
+転送バイト数をJSONに書き出す。ページごとのレイテンシは、合成サイトがリクエストを
+受けてから検索側がそのページを処理し終えるまでの時間。
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+EN_WORDS = ('search', 'crawler', 'document', 'journal', 'research', 'paper', 'index', 'network',
+            'library', 'archive', 'article', 'report', 'science', 'history', 'system', 'data')
+JA_WORDS = ('日本語', '検索', '文書', '論文', '研究', '図書館', '東京', '大学', '資料', '記事',
+            '報告', '科学', '歴史', 'データ', 'システム', 'ネットワーク')
+SEARCH_TERMS = {'en': 'needle', 'ja': '検索語'}
+TARGETS = ('app', 'web_seacher', 'endpoint')
+URL_RE = re.compile(r'https?://\S+')
+
+
+class SyntheticSite:
+    """決定的に生成する合成サイト
+
+    ページiはi*fanout+1〜i*fanout+fanoutのページ（pages未満）と、トップ・親ページに
+    リンクする木構造。depthを指定すると、その深さのページからは子ページにリンクしない
+    （0なら深さはページ数だけで決まる）。match_everyページごとに検索語を含める。latency秒だけ遅らせて
+    応答し、受けたリクエスト数・送ったバイト数・各ページへの最初のリクエスト時刻を記録する。
+    """
+
+    def __init__(self, pages=200, fanout=5, page_size=8192, latency=0.0, language='en',
+                 match_every=5, seed=0, depth=0):
+        self.pages = pages
+        self.fanout = fanout
+        self.depth = depth
+        self.page_size = page_size
+        self.latency = latency
+        self.language = language
+        self.match_every = match_every
+        self.seed = seed
+        self._lock = threading.Lock()
+        self._server = None
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.requested_at = {}
+
+    def page_depth(self, index):
+        """トップページからページindexまでの深さ"""
+        depth = 0
+        while index:
+            index = (index - 1) // self.fanout
+            depth += 1
+        return depth
+
+    def page(self, index):
+        """ページindexのHTML（同じ設定なら常に同じ内容）"""
+        rng = random.Random(self.seed * 1000003 + index)
+        words = JA_WORDS if self.language == 'ja' else EN_WORDS
+        separator = '' if self.language == 'ja' else ' '
+        children = range(index * self.fanout + 1, min(index * self.fanout + self.fanout + 1, self.pages))
+        if self.depth and self.page_depth(index) >= self.depth:
+            children = range(0)
+        # 子ページへのリンクは本文に、トップ・親ページへのリンクはナビゲーションに置く
+        links = [f'<a href="/p/{child}">{words[child % len(words)]} {child}</a>' for child in children]
+        navigation = ['<a href="/p/0">top</a>']
+        if index:
+            navigation.append(f'<a href="/p/{(index - 1) // self.fanout}">parent</a>')
+
+        paragraphs = []
+        size = 0
+        while size < self.page_size:
+            paragraph = separator.join(rng.choice(words) for _ in range(40))
+            paragraphs.append(f'<p>{paragraph}</p>')
+            size += len(paragraph.encode('utf-8')) + 7
+        if self.match_every and index % self.match_every == 0:
+            paragraphs.insert(rng.randrange(len(paragraphs) + 1), f'<p>{SEARCH_TERMS[self.language]}</p>')
+
+        return (f'<html><head><meta charset="utf-8"><title>Page {index}</title></head><body>'
+                f'<nav>{"".join(navigation)}</nav><main>{"".join(paragraphs)}{"".join(links)}</main>'
+                f'</body></html>').encode('utf-8')
+
+    def start(self, port=0):
+        """バックグラウンドのスレッドで配信を始め、トップページのURLを返す"""
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                path = self.path.split('?', 1)[0]
+                with site._lock:
+                    site.requests += 1
+                    site.requested_at.setdefault(path, time.time())
+                if site.latency:
+                    time.sleep(site.latency)
+                index = None
+                if path == '/':
+                    index = 0
+                elif path.startswith('/p/') and path[3:].isdigit():
+                    index = int(path[3:])
+                if index is None or index >= site.pages or (site.depth and site.page_depth(index) > site.depth):
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                body = site.page(index)
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with site._lock:
+                    site.bytes_sent += len(body)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_address[1]}/p/0"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+def percentile(values, q):
+    """最近傍順位法によるパーセンタイル（値が無ければNone）"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(q / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def _isolate_stores(directory):
+    """ベンチマーク用の一時ディレクトリにストアを置き、ページキャッシュは使わない"""
+    os.environ['PAGE_CACHE_PATH'] = ''
+    os.environ['SKETCH_STORE_PATH'] = ''
+    os.environ['DOCUMENT_STORE_PATH'] = os.path.join(directory, 'documents.sqlite3')
+    # 検索インデックスは設定されている場合だけ作る（既定では無効）
+    if os.environ.get('SEARCH_INDEX_PATH'):
+        os.environ['SEARCH_INDEX_PATH'] = os.path.join(directory, 'search_index.sqlite3')
+    os.environ['HISTORY_DB_PATH'] = os.path.join(directory, 'search_history.sqlite3')
+    os.environ.pop('REDIS_URL', None)
+
+
+def _run_target(target, url, search_text, max_depth, max_pages, results):
+    """子プロセスで1つの対象を実行し、計測結果をresults（Queue）に入れる
+
+    アプリの読み込みなどで例外が起きた場合も、エラーの記録を入れて親プロセスに知らせる。
+    """
+    try:
+        measured = _measure_target(target, url, search_text, max_depth, max_pages)
+    except BaseException as e:
+        measured = _error_record(f"{type(e).__name__}: {e}")
+    results.put(measured)
+
+
+def _error_record(error):
+    """計測できなかった対象の記録"""
+    return {'elapsed': None, 'total_pages': 0, 'matches': 0, 'error': error, 'processed_at': {},
+            'host_rate': None, 'peak_rss_mb': None}
+
+
+def _receive(process, results, timeout):
+    """子プロセスの計測結果を待つ。結果を返さずに終了・タイムアウトした場合はエラーの記録"""
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            pass
+        if process.exitcode is not None:
+            # 終了の直前に入れた結果がまだ届いていない場合に備えて、もう一度だけ待つ
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                return _error_record(f"子プロセスが結果を返さずに終了しました（終了コード{process.exitcode}）")
+        if time.time() >= deadline:
+            process.terminate()
+            return _error_record(f"{timeout}秒以内に終わりませんでした")
+
+
+def _measure_target(target, url, search_text, max_depth, max_pages):
+    """1つの対象で検索を実行して計測する"""
+    with tempfile.TemporaryDirectory() as directory:
+        _isolate_stores(directory)
+        processed_at = {}
+
+        def record(message, *args):
+            match = URL_RE.search(message)
+            if match:
+                processed_at.setdefault(match.group(0), time.time())
+
+        # 読み込みの時間は計測に含めない
+        if target == 'web_seacher':
+            import web_seacher
+        else:
+            import app
+        from robots import get_host_scheduler
+        # 本番と同じ既定値（または環境変数）で計測し、実際に使ったホストごとの間隔を記録する
+        host_rate = get_host_scheduler().default_rate
+
+        started = time.time()
+        if target == 'app':
+            searcher = app.WebTextSearcher()
+            searcher.max_depth = max_depth
+            searcher.max_pages = max_pages
+            response = searcher.search(url, search_text, skip_visited=False, progress_callback=record)
+            total_pages, matches = response.get('total_pages', 0), len(response.get('results', []))
+        elif target == 'web_seacher':
+            searcher = web_seacher.WebTextSearcher()
+            searcher.max_depth = max_depth
+            searcher.max_urls = max_pages
+            response = searcher.search(url, search_text, progress_callback=record)
+            total_pages, matches = response.get('total_pages', 0), len(response.get('results', []))
+        else:
+            client = app.app.test_client()
+            with client.session_transaction() as session:
+                session['user'] = 'benchmark'
+            # 他の対象と同じ深さ・ページ数でクロールさせる
+            response = client.post('/search', data={'url': url, 'search_text': search_text,
+                                                    'max_depth': max_depth, 'max_pages': max_pages}).get_json()
+            total_pages, matches = response.get('total_pages', 0), response.get('total_results', 0)
+        elapsed = time.time() - started
+
+    return {
+        'elapsed': elapsed,
+        'total_pages': total_pages,
+        'matches': matches,
+        'error': response.get('error'),
+        'processed_at': processed_at,
+        'host_rate': host_rate,
+        # Linuxではキロバイト、macOSではバイト
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    }
+
+
+def run_benchmark(site, targets, max_depth, max_pages, repeat=1, timeout=600):
+    """対象ごとに子プロセスで検索を実行し、{対象: 計測結果}を返す
+
+    timeout秒以内に終わらない対象は子プロセスを止め、エラーとして記録する。
+    """
+    url = site.start()
+    search_text = SEARCH_TERMS[site.language]
+    context = multiprocessing.get_context('spawn')
+    report = {}
+    try:
+        for target in targets:
+            runs = []
+            for _ in range(repeat):
+                site.reset()
+                results = context.Queue()
+                process = context.Process(target=_run_target,
+                                          args=(target, url, search_text, max_depth, max_pages, results))
+                process.start()
+                measured = _receive(process, results, timeout)
+                process.join()
+                latencies = []
+                for page_url, processed in measured.pop('processed_at').items():
+                    requested = site.requested_at.get(urlsplit(page_url).path)
+                    if requested is not None:
+                        latencies.append(processed - requested)
+                runs.append(dict(
+                    measured,
+                    requests=site.requests,
+                    bytes_transferred=site.bytes_sent,
+                    pages_per_sec=measured['total_pages'] / measured['elapsed'] if measured['elapsed'] else None,
+                    latency_p50_ms=_ms(percentile(latencies, 50)),
+                    latency_p99_ms=_ms(percentile(latencies, 99)),
+                ))
+            # 繰り返した場合はページ/秒が中央値の回を使う
+            runs.sort(key=lambda run: run['pages_per_sec'] or 0)
+            report[target] = runs[len(runs) // 2]
+            print(f"{target}: {_summary(report[target])}")
+    finally:
+        site.stop()
+    return report
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def _summary(metrics):
+    if metrics.get('error'):
+        return f"エラー: {metrics['error']}"
+    latency = ''
+    if metrics['latency_p50_ms'] is not None:
+        latency = f"p50={metrics['latency_p50_ms']}ms p99={metrics['latency_p99_ms']}ms "
+    return (f"{metrics['total_pages']}ページ {metrics['pages_per_sec']:.1f}ページ/秒 {latency}"
+            f"RSS={metrics['peak_rss_mb']:.1f}MB 転送={metrics['bytes_transferred'] / 1024:.0f}KB "
+            + (f"ホストごとの上限={metrics['host_rate']}件/秒" if metrics['host_rate'] else "ホストごとの上限なし"))
+
+
+COMPARED_METRICS = (('pages_per_sec', True), ('latency_p50_ms', False), ('latency_p99_ms', False),
+                    ('peak_rss_mb', False), ('bytes_transferred', False))
+
+
+def compare(before, after):
+    """2つの結果ファイルの指標の変化を表示する（改善は+、悪化は-の割合）"""
+    print(f"{'対象':<12} {'指標':<18} {'前':>12} {'後':>12} {'変化':>8}")
+    for target, metrics in after['results'].items():
+        previous = before['results'].get(target)
+        if previous is None:
+            continue
+        for name, higher_is_better in COMPARED_METRICS:
+            old, new = previous.get(name), metrics.get(name)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * (1 if higher_is_better else -1) * 100
+            print(f"{target:<12} {name:<18} {old:>12.2f} {new:>12.2f} {change:>+7.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='合成サイトに対するクロール・検索のベンチマーク')
+    parser.add_argument('--pages', type=int, default=200, help='合成サイトのページ数')
+    parser.add_argument('--fanout', type=int, default=5, help='1ページあたりの子ページへのリンク数')
+    parser.add_argument('--site-depth', type=int, default=0,
+                        help='合成サイトの深さ（この深さのページは子ページにリンクしない。0なら制限なし）')
+    parser.add_argument('--depth', type=int, default=3, help='クロールする深さ（max_depth）')
+    parser.add_argument('--max-pages', type=int, default=100, help='クロールするページ数の上限（max_pages）')
+    parser.add_argument('--page-size', type=int, default=8192, help='1ページの本文のおおよそのバイト数')
+    parser.add_argument('--latency', type=float, default=0.0, help='1リクエストごとに遅らせる秒数')
+    parser.add_argument('--language', choices=sorted(SEARCH_TERMS), default='en', help='本文の言語')
+    parser.add_argument('--match-every', type=int, default=5, help='検索語を含めるページの間隔')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='対象ごとの実行回数（中央値の回を記録）')
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=list(TARGETS))
+    parser.add_argument('--timeout', type=float, default=600, help='対象ごとの1回の実行の上限秒数')
+    parser.add_argument('--output', default='bench_results.json', help='結果を書き出すJSONファイル')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='2つの結果ファイルを比較する')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0], encoding='utf-8') as f:
+            before = json.load(f)
+        with open(args.compare[1], encoding='utf-8') as f:
+            after = json.load(f)
+        compare(before, after)
+        return
+
+    site = SyntheticSite(args.pages, args.fanout, args.page_size, args.latency, args.language,
+                         args.match_every, args.seed, args.site_depth)
+    config = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+    report = {
+        'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'config': config,
+        'results': run_benchmark(site, args.targets, args.depth, args.max_pages, args.repeat,
+                                 args.timeout)
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を{args.output}に保存しました")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from distributed import DistributedCrawlEngine
+from fetchers import RequestsFetcher, AsyncFetcher
+from frontier import PriorityFrontier, split_link
+from logs import in_current_context
+from metrics import FETCH_ERRORS
+from urls import SeenSet, canonicalize
+
+logger = logging.getLogger(__name__)
+
+
+class CrawlBudget:
+    """1回のクロールの上限（経過秒数・一致したページ数・受信したバイト数）
+
+    上限は0なら無制限。上限に達するとexhausted()がその理由（'deadline'・
+    'max_matches'・'max_bytes'）を返し、エンジンは以降のページを取得しない。
+    受信したバイト数はフェッチのワーカーから、一致数は検索側から記録する。
+    """
+
+    def __init__(self, deadline=0, max_matches=0, max_bytes=0):
+        self.deadline = deadline
+        self.max_matches = max_matches
+        self.max_bytes = max_bytes
+        self.started = time.monotonic()
+        self.matches = 0
+        self.bytes = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+
+    @property
+    def expires_at(self):
+        """期限（time.monotonic()の値。期限が無ければNone）"""
+        return self.started + self.deadline if self.deadline else None
+
+    def remaining(self):
+        """期限までの秒数（期限が無ければNone）"""
+        return self.expires_at - time.monotonic() if self.deadline else None
+
+    def add_bytes(self, size):
+        with self._lock:
+            self.bytes += size
+
+    def add_match(self):
+        with self._lock:
+            self.matches += 1
+
+    def skip(self):
+        """ホストの間隔のために期限までに取得を始められず、取得しなかったページを数える"""
+        with self._lock:
+            self.skipped += 1
+
+    def exhausted(self):
+        if self.max_matches and self.matches >= self.max_matches:
+            return 'max_matches'
+        if self.max_bytes and self.bytes >= self.max_bytes:
+            return 'max_bytes'
+        if self.deadline and time.monotonic() >= self.started + self.deadline:
+            return 'deadline'
+        return None
+
+    def stop_reason(self):
+        """上限で終えた理由（期限までに取得できなかったページがあれば'deadline'）"""
+        return self.exhausted() or ('deadline' if self.skipped else None)
+
+
+class CrawlEngine:
+    """幅優先のURLフロンティアと並列フェッチワーカーでクロールするエンジン
+
+    フェッチはワーカースレッドで並列に実行し、process(url, depth, page)による
+    解析・検索は呼び出し元のスレッドで投入順に行う。そのため検索側の状態を
+    ロックなしで更新でき、同じサイトに対して常に同じ結果集合・同じ深さが得られる。
+    policy（robots.CrawlPolicy）を渡すと、robots.txtで禁止されたURLを取得せず、
+    ホストごとの間隔（Crawl-delay）を守って取得する。一度積んだURLは正規化した
+    URLのフィンガープリントの集合で除き、取得はリンクに書かれたURLのまま行う
+    （末尾のスラッシュなどを変えると、相対リンクの基準やサーバーの応答が変わるため）。
+    prepare(url, depth, page)を渡すと、取得したスレッドで呼び出して戻り値を
+    page.preparedに入れる（解析プールに投入して、解析を次のフェッチと並行させる）。
+    frontierが'best'なら階層ごとではなく、リンクの優先度の高い順にmax_workers件ずつ
+    取得する（最良優先。ページ数の上限までに検索語に一致するページを多く見つける）。
+    budget（CrawlBudget）を渡すと、上限に達した後は新しいページを取得せずに終える
+    （各リクエストのタイムアウトも期限までに縮める）。
+    """
+
+    def __init__(self, fetcher=None, max_depth=3, max_pages=100, max_workers=8, policy=None,
+                 prepare=None, frontier='bfs', budget=None):
+        self.fetcher = fetcher or RequestsFetcher(max_connections=max_workers)
+        self.budget = budget
+        if budget is not None:
+            self.fetcher.deadline = budget.expires_at
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.max_workers = max_workers
+        self.policy = policy
+        self.prepare = prepare
+        if frontier not in ('bfs', 'best'):
+            raise ValueError(f"不明なフロンティア: {frontier}")
+        self.frontier = frontier
+
+    def run(self, start_url, process, visited=None, headers=None, seeds=None):
+        """start_urlから幅優先でクロールし、(url, depth, result)を順に返す
+
+        process(url, depth, page)は(result, links)を返す関数。linksの要素はURLか
+        (URL, 優先度)で、優先度は最良優先のときだけ使う。seeds（サイトマップの
+        URLなど）は開始ページのリンクと同じ階層（深さ1）に加える。visitedには
+        取得したURLを正規化したものが入る。
+        """
+        if visited is None:
+            visited = set()
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            if self.frontier == 'best':
+                fetch = in_current_context(lambda item: self._prepare(item[0], item[1], self._fetch(item[0], headers)))
+                yield from self._run_best_first(start_url, process, visited, seeds,
+                                                lambda batch: executor.map(fetch, batch))
+                return
+            seen, frontier = self._start(start_url, visited)
+            depth = 0
+            while frontier and depth <= self.max_depth and not self._exhausted():
+                level = self._admit(frontier, visited)
+                # ワーカースレッドのログにも検索のsearch_idを付ける
+                fetch = in_current_context(lambda url, depth=depth: self._prepare(url, depth, self._fetch(url, headers)))
+                pages = executor.map(fetch, level)
+                frontier = []
+                yield from self._process_level(level, depth, pages, process, seen, frontier)
+                if depth == 0 and seeds:
+                    self._enqueue(seeds, seen, frontier)
+                depth += 1
+        finally:
+            # 呼び出し元が途中でやめた場合は、まだ始まっていない取得を取り消す
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _start(self, start_url, visited):
+        """積んだURLの集合（取得済みのURLも含む）と最初のフロンティアを作る"""
+        seen = SeenSet(canonicalize(url) for url in visited)
+        frontier = []
+        self._enqueue([start_url], seen, frontier)
+        return seen, frontier
+
+    def _enqueue(self, urls, seen, frontier):
+        """正規化したURLでまだ積んでいないものだけを、元のURLのままフロンティアに積む"""
+        for link in urls:
+            url = split_link(link)[0]
+            if seen.add(canonicalize(url)):
+                frontier.append(url)
+
+    def _run_best_first(self, start_url, process, visited, seeds, fetch_batch):
+        """優先度の高いURLからmax_workers件ずつfetch_batch([(url, depth)])で取得し、
+        (url, depth, result)を順に返す（深さの上限・ページ数の上限は幅優先と同じ）"""
+        seen = SeenSet(canonicalize(url) for url in visited)
+        frontier = PriorityFrontier()
+        self._push(frontier, seen, [start_url], 0)
+        while frontier and len(visited) < self.max_pages and not self._exhausted():
+            batch = []
+            while frontier and len(batch) < self.max_workers:
+                url, depth = frontier.pop()
+                if self._admit([url], visited):
+                    batch.append((url, depth))
+            for (url, depth), page in zip(batch, fetch_batch(batch)):
+                if page is None:
+                    yield url, depth, None
+                else:
+                    result, links = process(url, depth, page)
+                    yield url, depth, result
+                    if depth < self.max_depth:
+                        self._push(frontier, seen, links, depth + 1)
+                if depth == 0 and seeds and self.max_depth > 0:
+                    self._push(frontier, seen, seeds, 1)
+
+    def _push(self, frontier, seen, links, depth):
+        """リンクを優先度つきでフロンティアに積む（正規化したURLで積んだことがあれば深さ・優先度を更新）"""
+        for link in links:
+            url, priority = split_link(link)
+            if seen.add(canonicalize(url)):
+                frontier.push(url, depth, priority)
+            else:
+                frontier.update(url, depth, priority)
+
+    def _admit(self, frontier, visited):
+        """フロンティアから今回取得するURLを確定させる（訪問済み・ページ数上限の判定）"""
+        level = []
+        for url in frontier:
+            if len(visited) >= self.max_pages:
+                break
+            key = canonicalize(url)
+            if key in visited:
+                continue
+            if self.policy is not None and not self.policy.allowed(url):
+                continue
+            visited.add(key)
+            level.append(url)
+        return level
+
+    def _process_level(self, level, depth, pages, process, seen, next_frontier):
+        """取得済みページを投入順に解析し、次の階層のリンクをnext_frontierに積む"""
+        for url, page in zip(level, pages):
+            if page is None:
+                yield url, depth, None
+                continue
+            result, links = process(url, depth, page)
+            yield url, depth, result
+            if depth < self.max_depth:
+                self._enqueue(links, seen, next_frontier)
+
+    def _exhausted(self):
+        return self.budget is not None and self.budget.exhausted() is not None
+
+    def _received(self, page):
+        """受信したバイト数を予算に記録する（304・キャッシュの本文は数えない）"""
+        if page is not None and self.budget is not None and not page.not_modified:
+            self.budget.add_bytes(len(page.content))
+        return page
+
+    def _delay(self, url):
+        """ホストの間隔（Crawl-delay）で待つ秒数（期限までに取得を始められなければNone）"""
+        if self.policy is None:
+            return 0
+        delay = self.policy.delay(url, self.budget.remaining() if self.budget is not None else None)
+        if delay is None:
+            # 期限を過ぎるまで待つ必要があるページは取得しない（結果は期限で打ち切ったものになる）
+            self.budget.skip()
+        return delay
+
+    def _fetch(self, url, headers):
+        try:
+            delay = self._delay(url)
+            if delay is None:
+                return None
+            time.sleep(delay)
+            # 待っている間に上限に達したら取得しない
+            if self._exhausted():
+                return None
+            return self._received(self.fetcher.fetch(url, headers=headers))
+        except Exception as e:
+            if self._exhausted():
+                # 期限で打ち切ったリクエストはエラーとして数えない
+                return None
+            FETCH_ERRORS.inc(type=type(e).__name__)
+            logger.warning("ページの取得中にエラー: %s - %s", url, e)
+            return None
+
+    def _prepare(self, url, depth, page):
+        if page is not None and self.prepare is not None:
+            try:
+                page.prepared = self.prepare(url, depth, page)
+            except Exception as e:
+                # 解析プールが使えなくてもprocessで解析できるので続ける
+                logger.warning("ページの解析の投入中にエラー: %s - %s", url, e)
+        return page
+
+
+class AsyncCrawlEngine(CrawlEngine):
+    """asyncioのイベントループ上で同じ幅優先クロールを行うエンジン
+
+    ページごとにスレッドを作らず、1つのイベントループからAsyncFetcherで
+    多数のリクエストを同時に投げる。同時実行数はmax_workersで、ホストごとの
+    上限はAsyncFetcherのコネクタで制限する。
+    """
+
+    def __init__(self, fetcher=None, max_depth=3, max_pages=100, max_workers=100, policy=None,
+                 prepare=None, frontier='bfs', budget=None):
+        super().__init__(fetcher or AsyncFetcher(max_connections=max_workers),
+                         max_depth, max_pages, max_workers, policy, prepare, frontier, budget)
+
+    def run(self, start_url, process, visited=None, headers=None, seeds=None):
+        if visited is None:
+            visited = set()
+
+        loop = asyncio.new_event_loop()
+        try:
+            if self.frontier == 'best':
+                yield from self._run_best_first(
+                    start_url, process, visited, seeds,
+                    lambda batch: loop.run_until_complete(self._fetch_items(batch, headers)))
+                return
+            seen, frontier = self._start(start_url, visited)
+            depth = 0
+            while frontier and depth <= self.max_depth and not self._exhausted():
+                level = self._admit(frontier, visited)
+                pages = loop.run_until_complete(self._fetch_level(level, depth, headers))
+                frontier = []
+                yield from self._process_level(level, depth, pages, process, seen, frontier)
+                if depth == 0 and seeds:
+                    self._enqueue(seeds, seen, frontier)
+                depth += 1
+        finally:
+            loop.run_until_complete(self.fetcher.close())
+            loop.close()
+
+    async def _fetch_level(self, level, depth, headers):
+        return await self._fetch_items([(url, depth) for url in level], headers)
+
+    async def _fetch_items(self, items, headers):
+        # セマフォはイベントループ上で作る（Python 3.9ではループに束縛されるため）
+        semaphore = asyncio.Semaphore(self.max_workers)
+        return await asyncio.gather(*[self._fetch_async(url, depth, headers, semaphore) for url, depth in items])
+
+    async def _fetch_async(self, url, depth, headers, semaphore):
+        delay = self._delay(url)
+        if delay is None:
+            return None
+        # 待つ間は同時実行数の枠を使わない
+        await asyncio.sleep(delay)
+        async with semaphore:
+            if self._exhausted():
+                return None
+            try:
+                page = self._received(await self.fetcher.fetch(url, headers=headers))
+            except Exception as e:
+                if self._exhausted():
+                    return None
+                FETCH_ERRORS.inc(type=type(e).__name__)
+                logger.warning("ページの取得中にエラー: %s - %s", url, e)
+                return None
+        return self._prepare(url, depth, page)
+
+
+def create_engine(backend='thread', max_depth=3, max_pages=100, max_workers=8,
+                  timeout=10, per_host_limit=8, session=None, cache=None, policy=None,
+                  coordinator=None, prepare=None, frontier='bfs', budget=None):
+    """バックエンド名（'thread' または 'async'）からクロールエンジンを作る
+
+    coordinator（distributed.create_coordinatorの戻り値）を渡すと、フロンティアを
+    他のワーカーと共有するDistributedCrawlEngineになる（フェッチはスレッドのみで、
+    共有のフロンティアは常に幅優先）。frontierは'bfs'（幅優先）か'best'（最良優先）。
+    budget（CrawlBudget）を渡すと、上限に達したところで取得をやめる。
+    """
+    if coordinator is not None:
+        fetcher = RequestsFetcher(timeout=timeout, max_connections=max_workers, session=session,
+                                  cache=cache)
+        return DistributedCrawlEngine(coordinator, fetcher, max_depth, max_workers, policy,
+                                      prepare=prepare, budget=budget)
+    if backend == 'async':
+        fetcher = AsyncFetcher(timeout=timeout, max_connections=max_workers,
+                               per_host_limit=per_host_limit, cache=cache)
+        return AsyncCrawlEngine(fetcher, max_depth, max_pages, max_workers, policy, prepare, frontier, budget)
+    if backend != 'thread':
+        raise ValueError(f"不明なフェッチバックエンド: {backend}")
+    fetcher = RequestsFetcher(timeout=timeout, max_connections=max_workers, session=session,
+                              cache=cache)
+    return CrawlEngine(fetcher, max_depth, max_pages, max_workers, policy, prepare, frontier, budget)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+# MinHashのビン数と、LSHのバンド数（1バンドあたりNUM_BINS // BANDS行）
+NUM_BINS = 128
+BANDS = 32
+ROWS = NUM_BINS // BANDS
+_BIN_SHIFT = 64 - (NUM_BINS.bit_length() - 1)
+_VALUE_MASK = (1 << _BIN_SHIFT) - 1
+# 単語が1つも入らなかったビン（どの値よりも大きい）
+EMPTY = _VALUE_MASK + 1
+
+
+def words(text):
+    """類似度の計算に使う単語の集合（小文字化して空白で分割）"""
+    return set(text.lower().split())
+
+
+def minhash(text):
+    """単語集合のMinHash署名（1回のハッシュをビンに振り分けるone permutation hashing）
+
+    単語ごとにハッシュを1回計算するだけなので、ページの大きさに比例した時間で作れる。
+    """
+    signature = [EMPTY] * NUM_BINS
+    for word in words(text):
+        h = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'big')
+        index, value = h >> _BIN_SHIFT, h & _VALUE_MASK
+        if value < signature[index]:
+            signature[index] = value
+    return signature
+
+
+def similarity(signature1, signature2):
+    """2つの署名から単語集合のJaccard係数を推定"""
+    matches = total = 0
+    for a, b in zip(signature1, signature2):
+        if a == EMPTY and b == EMPTY:
+            continue
+        total += 1
+        if a == b:
+            matches += 1
+    return matches / total if total else 0
+
+
+def _bands(signature):
+    """LSHのバンドごとのキー（全て空のバンドは除く）"""
+    for band in range(BANDS):
+        rows = tuple(signature[band * ROWS:(band + 1) * ROWS])
+        if any(value != EMPTY for value in rows):
+            yield band, rows
+
+
+class NearDuplicateIndex:
+    """MinHash署名とLSHバンディングによる重複ページの判定
+
+    バンドのどれかが一致したページだけを候補にして類似度を確かめるので、
+    1ページあたりの判定は登録済みのページ数によらずほぼ一定の時間で済む。
+    同じURLの署名は置き換えるため、同じサイトを再クロールしても自分自身とは重複しない。
+    storeを渡すと署名をサイトごとに保存し、次のクロールでも使う。
+    """
+
+    def __init__(self, threshold, store=None, site=None):
+        self.threshold = threshold
+        self.store = store
+        self.site = site
+        self._lock = threading.Lock()
+        self._signatures = {}
+        self._buckets = defaultdict(set)
+        if store is not None and site is not None:
+            for url, signature in store.load(site):
+                self._index(url, signature)
+
+    def find(self, signature, url=None):
+        """類似度がthresholdを超える登録済みページのURL（無ければNone）"""
+        with self._lock:
+            checked = set()
+            for key in _bands(signature):
+                for other in self._buckets.get(key, ()):
+                    if other == url or other in checked:
+                        continue
+                    checked.add(other)
+                    if similarity(signature, self._signatures[other]) > self.threshold:
+                        return other
+        return None
+
+    def add(self, url, signature):
+        with self._lock:
+            self._index(url, signature)
+        if self.store is not None and self.site is not None:
+            self.store.save(self.site, url, signature)
+
+    def _index(self, url, signature):
+        old = self._signatures.pop(url, None)
+        if old is not None:
+            for key in _bands(old):
+                self._buckets[key].discard(url)
+        self._signatures[url] = signature
+        for key in _bands(signature):
+            self._buckets[key].add(url)
+
+    def __len__(self):
+        return len(self._signatures)
+
+
+class SketchStore:
+    """サイトごとのMinHash署名を保存するSQLiteのストア"""
+
+    def __init__(self, path, max_per_site=10000):
+        self.path = path
+        self.max_per_site = max_per_site
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS sketches (
+                site TEXT NOT NULL,
+                url TEXT NOT NULL,
+                signature BLOB NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (site, url)
+            );
+        ''')
+        self._conn.commit()
+
+    def load(self, site):
+        """サイトの署名を返す（古いものはmax_per_site件を超えた分を削除）"""
+        with self._lock:
+            self._conn.execute(
+                'DELETE FROM sketches WHERE site = ? AND url NOT IN '
+                '(SELECT url FROM sketches WHERE site = ? ORDER BY updated_at DESC LIMIT ?)',
+                (site, site, self.max_per_site)
+            )
+            self._conn.commit()
+            rows = self._conn.execute('SELECT url, signature FROM sketches WHERE site = ?',
+                                      (site,)).fetchall()
+        sketches = []
+        for url, blob in rows:
+            signature = array('Q')
+            signature.frombytes(blob)
+            sketches.append((url, list(signature)))
+        return sketches
+
+    def save(self, site, url, signature):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO sketches VALUES (?, ?, ?, ?)',
+                (site, url, array('Q', signature).tobytes(), time.time())
+            )
+            self._conn.commit()
+
+
+_sketch_store = None
+_sketch_store_lock = threading.Lock()
+
+
+def get_sketch_store():
+    """環境変数の設定で共有の署名ストアを返す（SKETCH_STORE_PATHが空なら保存しない）"""
+    global _sketch_store
+    path = os.environ.get('SKETCH_STORE_PATH', 'sketches.sqlite3')
+    if not path:
+        return None
+    with _sketch_store_lock:
+        if _sketch_store is None:
+            _sketch_store = SketchStore(
+                path, max_per_site=int(os.environ.get('SKETCH_STORE_MAX_PER_SITE', 10000))
+            )
+        return _sketch_store
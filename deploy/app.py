@@ -7,8 +7,11 @@ import re
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 import base64
+import logging
 
 app = Flask(__name__)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(levelname)s] %(name)s %(message)s')
+logger = logging.getLogger(__name__)
 
 # レート制限の設定
 limiter = Limiter(
@@ -37,7 +40,7 @@ class WebTextSearcher:
 
     def search(self, url, search_text, auth=None):
         """指定されたURLから検索を開始"""
-        print(f"検索開始: URL={url}, 検索テキスト={search_text}")
+        logger.info("検索開始: URL=%s, 検索テキスト=%s", url, search_text)
         self.visited_urls = set()
         results = []
         
@@ -48,7 +51,7 @@ class WebTextSearcher:
                 'results': results
             }
         except Exception as e:
-            print(f"検索中にエラー: {str(e)}")
+            logger.exception("検索中にエラー: %s", e)
             return {
                 'success': False,
                 'error': str(e)
@@ -63,7 +66,7 @@ class WebTextSearcher:
             return
             
         self.visited_urls.add(url)
-        print(f"ページを検索中: {url} (深さ: {depth})")
+        logger.debug("ページを検索中: %s (深さ: %s)", url, depth)
         
         try:
             # ページを取得
@@ -133,7 +136,7 @@ class WebTextSearcher:
                             'page_url': url
                         })
                 except Exception as e:
-                    print(f"リンクの処理中にエラー: {href} - {str(e)}")
+                    logger.debug("リンクの処理中にエラー: %s - %s", href, e)
                     continue
             
             # マッチがある場合のみ結果に追加
@@ -149,11 +152,11 @@ class WebTextSearcher:
                         if self._is_same_domain(full_url, url) and full_url not in self.visited_urls:
                             self._search_page(full_url, search_text, depth + 1, results, auth)
                     except Exception as e:
-                        print(f"リンクの処理中にエラー: {href} - {str(e)}")
+                        logger.debug("リンクの処理中にエラー: %s - %s", href, e)
                         continue
                         
         except Exception as e:
-            print(f"ページの検索中にエラー: {url} - {str(e)}")
+            logger.warning("ページの検索中にエラー: %s - %s", url, e)
 
 @app.route('/')
 def index():
@@ -162,16 +165,16 @@ def index():
 @app.route('/search', methods=['POST'])
 @limiter.limit("10 per minute")  # エンドポイントごとの制限
 def search():
-    print("検索リクエストを受信")
+    logger.debug("検索リクエストを受信")
     url = request.form.get('url')
     search_text = request.form.get('search_text')
     username = request.form.get('username')
     password = request.form.get('password')
     
-    print(f"リクエストパラメータ: URL={url}, 検索テキスト={search_text}")
+    logger.debug("リクエストパラメータ: URL=%s, 検索テキスト=%s", url, search_text)
     
     if not url or not search_text:
-        print("パラメータが不足")
+        logger.info("パラメータが不足")
         return jsonify({
             'success': False,
             'error': 'URLと検索テキストを入力してください'
@@ -186,7 +189,8 @@ def search():
     
     searcher = WebTextSearcher()
     result = searcher.search(url, search_text, auth)
-    print(f"検索結果: {result}")
+    # 結果の全体はページ数に比例して大きいので、件数だけ記録する
+    logger.info("検索結果: success=%s, 件数=%d", result.get('success'), len(result.get('results', [])))
     return jsonify(result)
 
 @app.errorhandler(429)
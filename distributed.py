@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import redis
+
+from fetchers import RequestsFetcher
+from frontier import split_link
+from logs import in_current_context
+from metrics import FETCH_ERRORS
+from snippets import json_default
+from urls import SeenSet, canonicalize
+
+# 協調クロール中のジョブIDの集合
+ACTIVE_JOBS_KEY = 'crawl:jobs'
+
+logger = logging.getLogger(__name__)
+
+
+def _item(url, depth):
+    return json.dumps([url, depth])
+
+
+def _parse_item(item):
+    if isinstance(item, bytes):
+        item = item.decode('utf-8')
+    url, depth = json.loads(item)
+    return url, depth
+
+
+class LocalCrawlCoordinator:
+    """1つのプロセス内で完結するフロンティア・訪問済み集合・結果の置き場（REDIS_URLが無い場合）
+
+    RedisCrawlCoordinatorと同じ操作を持つので、クロールエンジンはどちらでも同じように動く。
+    """
+
+    def __init__(self, job_id, max_pages=100, lease_seconds=120, spec=None):
+        self.job_id = job_id
+        self.max_pages = max_pages
+        self.lease_seconds = lease_seconds
+        self.token = uuid.uuid4().hex
+        self._lock = threading.Lock()
+        self._spec = spec
+        self._frontier = []
+        self._seen = SeenSet()
+        self._admitted = 0
+        self._leases = {}  # {item: (期限, token)}
+        self._results = []
+        self._cancelled = False
+
+    def start(self, urls, skip=()):
+        """最初のURLを積む（skipの正規化したURLは積んだものとして扱う）"""
+        with self._lock:
+            for url in skip:
+                self._seen.add(url)
+            self._push([(url, 0) for url in urls])
+
+    def spec(self):
+        return self._spec
+
+    def _push(self, entries):
+        for url, depth in entries:
+            if self._admitted >= self.max_pages:
+                break
+            # 同じページかは正規化したURLで判定し、取得はリンクのURLのまま行う
+            if self._seen.add(canonicalize(url)):
+                self._admitted += 1
+                self._frontier.append(_item(url, depth))
+
+    def claim(self, count):
+        """フロンティアから最大count件をリースして[(url, depth), ...]を返す"""
+        with self._lock:
+            items, self._frontier = self._frontier[:count], self._frontier[count:]
+            expires = time.time() + self.lease_seconds
+            for item in items:
+                self._leases[item] = (expires, self.token)
+        return [_parse_item(item) for item in items]
+
+    def complete(self, url, depth, result, links, link_depth):
+        """リース中のページの結果を保存し、リンクを積む（リースを失っていればFalse）"""
+        item = _item(url, depth)
+        with self._lock:
+            lease = self._leases.get(item)
+            if lease is None or lease[1] != self.token:
+                return False
+            del self._leases[item]
+            self._results.append(json.dumps({'url': url, 'depth': depth, 'result': result}, default=json_default))
+            self._push([(link, link_depth) for link in links])
+            return True
+
+    def requeue_expired(self):
+        """期限切れのリースをフロンティアに戻す（処理中に落ちたワーカーの分）"""
+        now = time.time()
+        with self._lock:
+            expired = [item for item, (expires, _) in self._leases.items() if expires <= now]
+            for item in expired:
+                del self._leases[item]
+                self._frontier.append(item)
+        return len(expired)
+
+    def finished(self):
+        with self._lock:
+            return not self._frontier and not self._leases
+
+    def cancel(self):
+        """ジョブを打ち切る（ワーカーはリース中のページを処理したら終える）"""
+        self._cancelled = True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def results_since(self, cursor):
+        """cursor件目以降の結果と次のcursorを返す"""
+        with self._lock:
+            entries = self._results[cursor:]
+        return [json.loads(entry) for entry in entries], cursor + len(entries)
+
+    def close(self):
+        pass
+
+
+class RedisCrawlCoordinator:
+    """Redisで共有するフロンティア・訪問済み集合・結果の置き場
+
+    複数のワーカープロセス（別のマシンでもよい）が同じジョブのページをリースして
+    処理する。リースの確認・結果の保存・リンクの追加は1つのトランザクション
+    （WATCH/MULTI）で行うため、各ページの結果はちょうど1回だけ保存される。
+    期限までに完了しなかったリースはrequeue_expiredでフロンティアに戻る。
+    """
+
+    def __init__(self, client, job_id, max_pages=100, lease_seconds=120, spec=None, ttl=3600):
+        self.client = client
+        self.job_id = job_id
+        self.max_pages = max_pages
+        self.lease_seconds = lease_seconds
+        self.ttl = ttl
+        self._spec = spec
+        self.token = uuid.uuid4().hex
+        prefix = f"crawl:{job_id}"
+        self.keys = {name: f"{prefix}:{name}"
+                     for name in ('spec', 'frontier', 'seen', 'admitted', 'leases', 'owners', 'results',
+                                  'cancelled')}
+
+    def start(self, urls, skip=()):
+        """ジョブの設定を保存して最初のURLを積み、他のワーカーから見えるようにする"""
+        self.client.set(self.keys['spec'], json.dumps(dict(self._spec or {}, max_pages=self.max_pages)),
+                        ex=self.ttl)
+        skip = list(skip)
+        if skip:
+            self.client.sadd(self.keys['seen'], *skip)
+        self._transaction(lambda pipe: self._push(pipe, [(url, 0) for url in urls], []))
+        self.client.sadd(ACTIVE_JOBS_KEY, self.job_id)
+
+    def spec(self):
+        if self._spec is None:
+            data = self.client.get(self.keys['spec'])
+            self._spec = json.loads(data) if data else None
+        return self._spec
+
+    def _transaction(self, func):
+        return self.client.transaction(func, self.keys['seen'], self.keys['admitted'],
+                                       self.keys['owners'], value_from_callable=True)
+
+    def _push(self, pipe, entries, commands):
+        """WATCH中に積むURLを決め、MULTIの後でcommandsと一緒に実行する"""
+        admitted = int(pipe.get(self.keys['admitted']) or 0)
+        urls = {}  # {正規化したURL: (URL, 深さ)}
+        for url, depth in entries:
+            if admitted + len(urls) >= self.max_pages:
+                break
+            key = canonicalize(url)
+            if key not in urls and not pipe.sismember(self.keys['seen'], key):
+                urls[key] = (url, depth)
+        pipe.multi()
+        for command in commands:
+            command(pipe)
+        if urls:
+            pipe.sadd(self.keys['seen'], *urls)
+            pipe.incrby(self.keys['admitted'], len(urls))
+            pipe.rpush(self.keys['frontier'], *[_item(url, depth) for url, depth in urls.values()])
+        for name in ('seen', 'admitted', 'frontier'):
+            pipe.expire(self.keys[name], self.ttl)
+        return True
+
+    def claim(self, count):
+        expires = time.time() + self.lease_seconds
+
+        def claim(pipe):
+            items = pipe.lrange(self.keys['frontier'], 0, count - 1)
+            pipe.multi()
+            if items:
+                pipe.ltrim(self.keys['frontier'], len(items), -1)
+                pipe.zadd(self.keys['leases'], {item: expires for item in items})
+                pipe.hset(self.keys['owners'], mapping={item: self.token for item in items})
+                pipe.expire(self.keys['leases'], self.ttl)
+                pipe.expire(self.keys['owners'], self.ttl)
+            return items
+
+        items = self.client.transaction(claim, self.keys['frontier'], value_from_callable=True)
+        return [_parse_item(item) for item in items]
+
+    def complete(self, url, depth, result, links, link_depth):
+        item = _item(url, depth)
+        entry = json.dumps({'url': url, 'depth': depth, 'result': result}, default=json_default)
+
+        def complete(pipe):
+            owner = pipe.hget(self.keys['owners'], item)
+            if owner is None or owner.decode('utf-8') != self.token:
+                pipe.multi()
+                return False
+            commands = [
+                lambda p: p.zrem(self.keys['leases'], item),
+                lambda p: p.hdel(self.keys['owners'], item),
+                lambda p: p.rpush(self.keys['results'], entry),
+                lambda p: p.expire(self.keys['results'], self.ttl),
+            ]
+            return self._push(pipe, [(link, link_depth) for link in links], commands)
+
+        return self._transaction(complete)
+
+    def requeue_expired(self):
+        def requeue(pipe):
+            expired = pipe.zrangebyscore(self.keys['leases'], 0, time.time())
+            pipe.multi()
+            if expired:
+                pipe.zrem(self.keys['leases'], *expired)
+                pipe.hdel(self.keys['owners'], *expired)
+                pipe.rpush(self.keys['frontier'], *expired)
+            return len(expired)
+
+        return self.client.transaction(requeue, self.keys['leases'], self.keys['owners'],
+                                       value_from_callable=True)
+
+    def finished(self):
+        pipe = self.client.pipeline()
+        pipe.llen(self.keys['frontier'])
+        pipe.zcard(self.keys['leases'])
+        frontier, leases = pipe.execute()
+        return frontier == 0 and leases == 0
+
+    def cancel(self):
+        """ジョブを打ち切る（手伝っているワーカーもリース中のページを処理したら終える）"""
+        self.client.set(self.keys['cancelled'], 1, ex=self.ttl)
+
+    def cancelled(self):
+        return bool(self.client.exists(self.keys['cancelled']))
+
+    def results_since(self, cursor):
+        entries = self.client.lrange(self.keys['results'], cursor, -1)
+        return [json.loads(entry) for entry in entries], cursor + len(entries)
+
+    def close(self):
+        """ジョブを協調クロール中の一覧から外す（キーはttl秒後に消える）"""
+        self.client.srem(ACTIVE_JOBS_KEY, self.job_id)
+
+
+class DistributedCrawlEngine:
+    """共有のフロンティアからページをリースして処理するクロールエンジン
+
+    runはジョブを開始し、他のワーカーが処理したページも含めて(url, depth, result)を
+    返す。workはすでに開始されたジョブを手伝うだけで、結果は返さない。resultは
+    JSONにできる値でなければならない（他のワーカーへ渡すため）。budget（crawler.CrawlBudget）を
+    渡すと、上限に達したところでこのワーカーは取得をやめ、runはジョブを打ち切って
+    （手伝っているワーカーも止めて）終える。
+    """
+
+    def __init__(self, coordinator, fetcher=None, max_depth=3, max_workers=8, policy=None,
+                 poll_interval=0.2, prepare=None, budget=None):
+        self.coordinator = coordinator
+        self.fetcher = fetcher or RequestsFetcher(max_connections=max_workers)
+        self.budget = budget
+        if budget is not None:
+            self.fetcher.deadline = budget.expires_at
+        self.max_depth = max_depth
+        self.max_workers = max_workers
+        self.policy = policy
+        self.poll_interval = poll_interval
+        self.prepare = prepare
+
+    def run(self, start_url, process, visited=None, headers=None, seeds=None):
+        if visited is None:
+            visited = set()
+        self.coordinator.start([start_url], [canonicalize(url) for url in visited])
+        seed_urls = list(seeds or [])
+        cursor = 0
+        try:
+            for _ in self._work(process, headers, seed_urls):
+                entries, cursor = self.coordinator.results_since(cursor)
+                for entry in entries:
+                    visited.add(canonicalize(entry['url']))
+                    yield entry['url'], entry['depth'], entry['result']
+                if self._exhausted():
+                    return
+            entries, cursor = self.coordinator.results_since(cursor)
+            for entry in entries:
+                visited.add(canonicalize(entry['url']))
+                yield entry['url'], entry['depth'], entry['result']
+        finally:
+            # 上限に達したか呼び出し元がやめた場合は、手伝っているワーカーにも打ち切りを知らせる
+            if not self.coordinator.finished():
+                self.coordinator.cancel()
+            self.coordinator.close()
+
+    def work(self, process, headers=None):
+        for _ in self._work(process, headers):
+            pass
+
+    def _work(self, process, headers=None, seeds=None):
+        """ジョブが終わるまでページをリースして処理する（1回処理するごとにyieldする）"""
+        fetch = in_current_context(lambda url, depth: self._prepare(url, depth, self._fetch(url, headers)))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                if self.coordinator.cancelled():
+                    return
+                self.coordinator.requeue_expired()
+                items = self.coordinator.claim(self.max_workers)
+                if not items:
+                    if self.coordinator.finished():
+                        return
+                    yield
+                    time.sleep(self.poll_interval)
+                    continue
+
+                pages = executor.map(fetch, *zip(*items))
+                for (url, depth), page in zip(items, pages):
+                    result, links = None, []
+                    if page is not None:
+                        result, links = process(url, depth, page)
+                    if depth == 0 and seeds:
+                        links = list(links) + seeds
+                    if depth >= self.max_depth:
+                        links = []
+                    # 共有のフロンティアは幅優先なので、リンクの優先度は使わない
+                    links = [split_link(link)[0] for link in links]
+                    if self.policy is not None:
+                        links = [link for link in links if self.policy.allowed(link)]
+                    self.coordinator.complete(url, depth, result, links, depth + 1)
+                yield
+
+    def _exhausted(self):
+        return self.budget is not None and self.budget.exhausted() is not None
+
+    def _delay(self, url):
+        """ホストの間隔（Crawl-delay）で待つ秒数（期限までに取得を始められなければNone）"""
+        if self.policy is None:
+            return 0
+        delay = self.policy.delay(url, self.budget.remaining() if self.budget is not None else None)
+        if delay is None:
+            # 期限を過ぎるまで待つ必要があるページは取得しない（結果は期限で打ち切ったものになる）
+            self.budget.skip()
+        return delay
+
+    def _fetch(self, url, headers):
+        try:
+            delay = self._delay(url)
+            if delay is None:
+                return None
+            time.sleep(delay)
+            if self._exhausted():
+                return None
+            page = self.fetcher.fetch(url, headers=headers)
+            if self.budget is not None and not page.not_modified:
+                self.budget.add_bytes(len(page.content))
+            return page
+        except Exception as e:
+            if self._exhausted():
+                # 期限で打ち切ったリクエストはエラーとして数えない
+                return None
+            FETCH_ERRORS.inc(type=type(e).__name__)
+            logger.warning("ページの取得中にエラー: %s - %s", url, e)
+            return None
+
+    def _prepare(self, url, depth, page):
+        if page is not None and self.prepare is not None:
+            try:
+                page.prepared = self.prepare(url, depth, page)
+            except Exception as e:
+                logger.warning("ページの解析の投入中にエラー: %s - %s", url, e)
+        return page
+
+
+_redis_client = None
+_redis_lock = threading.Lock()
+
+
+def get_redis_client():
+    """協調クロールに使うRedisクライアント（REDIS_URLが無いか接続できなければNone）"""
+    global _redis_client
+    redis_url = os.environ.get('REDIS_URL')
+    if not redis_url:
+        return None
+    with _redis_lock:
+        if _redis_client is None:
+            try:
+                client = redis.from_url(redis_url)
+                client.ping()
+                _redis_client = client
+            except redis.exceptions.ConnectionError as e:
+                logger.warning("Redis connection failed for distributed crawl: %s", e)
+                return None
+        return _redis_client
+
+
+def distributed_enabled():
+    """環境変数DISTRIBUTED_CRAWLが1なら、クロールを複数のワーカーで分担する"""
+    return os.environ.get('DISTRIBUTED_CRAWL', '0') == '1'
+
+
+def create_coordinator(job_id=None, max_pages=100, spec=None, client=None):
+    """Redisがあれば共有の、無ければプロセス内のコーディネーターを作る
+
+    specはジョブを手伝うワーカーがページの処理を組み立てるための設定（JSONにできる値）。
+    """
+    job_id = job_id or uuid.uuid4().hex
+    lease_seconds = int(os.environ.get('CRAWL_LEASE_SECONDS', 120))
+    client = client or get_redis_client()
+    if client is None:
+        return LocalCrawlCoordinator(job_id, max_pages, lease_seconds, spec)
+    return RedisCrawlCoordinator(client, job_id, max_pages, lease_seconds, spec)
+
+
+class CrawlHelper:
+    """協調クロール中のジョブを見つけて手伝うバックグラウンドスレッド
+
+    handle(coordinator)はジョブの設定（coordinator.spec()）からページの処理を
+    組み立て、DistributedCrawlEngine.workを呼ぶ関数。
+    """
+
+    def __init__(self, client, handle, poll_interval=1.0):
+        self.client = client
+        self.handle = handle
+        self.poll_interval = poll_interval
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while True:
+            try:
+                for job_id in self.client.smembers(ACTIVE_JOBS_KEY):
+                    coordinator = create_coordinator(job_id.decode('utf-8'), client=self.client)
+                    spec = coordinator.spec()
+                    if spec is None:
+                        # 期限切れなどで設定が消えたジョブは一覧から外す
+                        coordinator.close()
+                        continue
+                    coordinator.max_pages = spec.get('max_pages', coordinator.max_pages)
+                    if not coordinator.finished() and not coordinator.cancelled():
+                        self.handle(coordinator)
+            except Exception as e:
+                logger.exception("協調クロールの手伝い中にエラー: %s", e)
+            time.sleep(self.poll_interval)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class DocumentStore:
+    """クロールで抽出したページのテキストとリンクを保存するストア
+
+    1回のクロールで本文・headのテキスト・(href, リンクテキスト)を保存しておけば、
+    検索語をいくつ変えてもネットワークアクセスやHTMLの解析なしで検索できる。
+    """
+
+    def __init__(self, path, max_crawls=50):
+        self.path = path
+        self.max_crawls = max_crawls
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS crawls (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                base_url TEXT NOT NULL,
+                max_depth INTEGER,
+                max_pages INTEGER,
+                created_at REAL NOT NULL,
+                total_pages INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                crawl_id INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                title TEXT,
+                depth INTEGER NOT NULL,
+                body_text TEXT NOT NULL,
+                head_text TEXT NOT NULL,
+                links TEXT NOT NULL,
+                PRIMARY KEY (crawl_id, url)
+            );
+        ''')
+        self._conn.commit()
+
+    def create_crawl(self, base_url, max_depth, max_pages):
+        """クロールを登録してIDを返す"""
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT INTO crawls (base_url, max_depth, max_pages, created_at) VALUES (?, ?, ?, ?)',
+                (base_url, max_depth, max_pages, time.time())
+            )
+            self._conn.commit()
+            return cursor.lastrowid
+
+    def prune(self):
+        """古いクロールを新しいものからmax_crawls件だけ残して削除する
+
+        削除したクロールにしか無かったページのURLを返す（索引からも削除するため）。
+        """
+        with self._lock:
+            row = self._conn.execute('SELECT MAX(id) FROM crawls').fetchone()
+            if row[0] is None:
+                return set()
+            oldest = row[0] - self.max_crawls
+            if self._conn.execute('SELECT 1 FROM crawls WHERE id <= ? LIMIT 1', (oldest,)).fetchone() is None:
+                return set()
+            removed = {url for url, in self._conn.execute(
+                'SELECT DISTINCT url FROM documents WHERE crawl_id <= ? '
+                'AND url NOT IN (SELECT url FROM documents WHERE crawl_id > ?)',
+                (oldest, oldest)
+            )}
+            self._conn.execute('DELETE FROM documents WHERE crawl_id <= ?', (oldest,))
+            self._conn.execute('DELETE FROM crawls WHERE id <= ?', (oldest,))
+            self._conn.commit()
+            return removed
+
+    def finish_crawl(self, crawl_id, total_pages):
+        with self._lock:
+            self._conn.execute('UPDATE crawls SET total_pages = ? WHERE id = ?', (total_pages, crawl_id))
+            self._conn.commit()
+
+    def add_document(self, crawl_id, document):
+        """抽出済みのページを保存"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (crawl_id, document['url'], document['title'], document['depth'],
+                 document['body_text'], document['head_text'],
+                 json.dumps(document['links'], ensure_ascii=False))
+            )
+            self._conn.commit()
+
+    def get_crawl(self, crawl_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT id, base_url, max_depth, max_pages, created_at, total_pages FROM crawls WHERE id = ?',
+                (crawl_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'base_url', 'max_depth', 'max_pages', 'created_at', 'total_pages')
+        return dict(zip(keys, row))
+
+    def get_document(self, crawl_id, url):
+        """クロールの1ページ分の文書（無ければNone）"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT url, title, depth, body_text, head_text, links FROM documents '
+                'WHERE crawl_id = ? AND url = ?',
+                (crawl_id, url)
+            ).fetchone()
+        return _document(row) if row is not None else None
+
+    def iter_documents(self, crawl_id):
+        """クロールの文書を浅い階層から順に返す"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT url, title, depth, body_text, head_text, links FROM documents '
+                'WHERE crawl_id = ? ORDER BY depth, rowid',
+                (crawl_id,)
+            ).fetchall()
+        for row in rows:
+            yield _document(row)
+
+
+def _document(row):
+    url, title, depth, body_text, head_text, links = row
+    return {
+        'url': url,
+        'title': title,
+        'depth': depth,
+        'body_text': body_text,
+        'head_text': head_text,
+        'links': [tuple(link) for link in json.loads(links)],
+    }
+
+
+_document_store = None
+_document_store_lock = threading.Lock()
+
+
+def get_document_store():
+    """環境変数の設定で共有の文書ストアを返す（DOCUMENT_STORE_PATHが空なら無効）"""
+    global _document_store
+    path = os.environ.get('DOCUMENT_STORE_PATH', 'documents.sqlite3')
+    if not path:
+        return None
+    with _document_store_lock:
+        if _document_store is None:
+            _document_store = DocumentStore(
+                path, max_crawls=int(os.environ.get('DOCUMENT_STORE_MAX_CRAWLS', 50))
+            )
+        return _document_store
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+import codecs
+import logging
+import re
+from urllib.parse import urljoin
+
+from lxml import etree
+
+# テキストとして扱わない要素（BeautifulSoupのget_textと同じ）
+SKIP_TAGS = {'script', 'style', 'template'}
+CHUNK_SIZE = 64 * 1024
+CHARSET_RE = re.compile(r'charset=["\']?([\w.:-]+)', re.IGNORECASE)
+# metaタグの文字コード指定を探す本文の先頭のバイト数（<meta charset>・http-equivの両方）
+SNIFF_BYTES = 4096
+META_CHARSET_RE = re.compile(rb'<meta[^>]*?charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+logger = logging.getLogger(__name__)
+BOMS = ((codecs.BOM_UTF8, 'utf-8-sig'), (codecs.BOM_UTF16_LE, 'utf-16'), (codecs.BOM_UTF16_BE, 'utf-16'))
+
+
+class _DocumentTarget:
+    """lxmlのパーサーイベントからタイトル・head・本文・リンクを1回で集めるターゲット
+
+    木を作らずにイベントを受け取るだけなので、大きなページでもメモリを抑えられる。
+    """
+
+    def __init__(self):
+        self.title = None
+        self.text_parts = []
+        self.head_parts = []
+        self.links = []  # [href, [リンクテキスト...]]
+        self._open_links = []
+        self._in_head = 0
+        self._in_title = 0
+        self._title_parts = []
+        self._skip = 0
+
+    def start(self, tag, attrib):
+        if tag in SKIP_TAGS:
+            self._skip += 1
+        elif tag == 'head':
+            self._in_head += 1
+        elif tag == 'title' and self.title is None:
+            self._in_title += 1
+        elif tag == 'a':
+            href = attrib.get('href')
+            link = [href, []] if href is not None else None
+            if link is not None:
+                # find_all('a')と同じく開始タグの順に並べる
+                self.links.append(link)
+            self._open_links.append(link)
+
+    def end(self, tag):
+        if tag in SKIP_TAGS:
+            self._skip = max(self._skip - 1, 0)
+        elif tag == 'head':
+            self._in_head = max(self._in_head - 1, 0)
+        elif tag == 'title' and self._in_title:
+            self._in_title = 0
+            self.title = ''.join(self._title_parts)
+        elif tag == 'a' and self._open_links:
+            self._open_links.pop()
+
+    def data(self, data):
+        if self._skip:
+            return
+        self.text_parts.append(data)
+        if self._in_head:
+            self.head_parts.append(data)
+        if self._in_title:
+            self._title_parts.append(data)
+        for link in self._open_links:
+            if link is not None:
+                link[1].append(data)
+
+    def comment(self, text):
+        pass
+
+    def close(self):
+        if self.title is None and self._title_parts:
+            self.title = ''.join(self._title_parts)
+        return self
+
+
+def declared_encoding(headers):
+    """Content-Typeヘッダーで明示されている文字コード（無ければNone）"""
+    match = CHARSET_RE.search(headers.get('Content-Type') or '')
+    return match.group(1) if match else None
+
+
+def sniff_encoding(content):
+    """本文の先頭SNIFF_BYTESバイトのBOM・metaタグから文字コードを判定する（無ければNone）"""
+    for bom, encoding in BOMS:
+        if content.startswith(bom):
+            return encoding
+    match = META_CHARSET_RE.search(content[:SNIFF_BYTES])
+    if match is None:
+        return None
+    encoding = match.group(1).decode('ascii')
+    try:
+        return codecs.lookup(encoding).name
+    except LookupError:
+        return None
+
+
+def extract_document(url, depth, page):
+    """ページを1回だけ解析し、検索に使うテキストと(リンク先URL, リンクテキスト)を取り出す
+
+    本文は分割して逐次パーサーに流し込む。文字コードはFetchedPage.encoding（ヘッダー、
+    無ければBOM・metaタグから判定したもの）を使う。相対リンクはレスポンスのURL
+    （page.url。リダイレクト後）を基準に解決し、文書のURLはクロールしたurlのままにする。
+    """
+    target = _DocumentTarget()
+    try:
+        parser = etree.HTMLParser(target=target, encoding=page.encoding)
+    except LookupError:
+        parser = etree.HTMLParser(target=target)
+
+    content = page.content
+    for start in range(0, len(content), CHUNK_SIZE):
+        parser.feed(content[start:start + CHUNK_SIZE])
+    try:
+        parser.close()
+    except etree.XMLSyntaxError:
+        # 空のページなど、解析できる内容が無い場合
+        target.close()
+
+    base_url = page.url or url
+    links = []
+    for href, text_parts in target.links:
+        try:
+            # 相対URLを絶対URLに変換
+            links.append((urljoin(base_url, href), ''.join(text_parts).strip()))
+        except Exception as e:
+            logger.debug("リンクの処理中にエラー: %s - %s", href, e)
+            continue
+
+    return {
+        'url': url,
+        'title': target.title if target.title is not None else url,
+        'depth': depth,
+        'body_text': ' '.join(''.join(target.text_parts).split()),
+        'head_text': ''.join(target.head_parts),
+        'links': links
+    }
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+import codecs
+import os
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.compat import chardet
+from requests.utils import get_encoding_from_headers
+
+from extraction import declared_encoding, sniff_encoding
+from metrics import BYTES_FETCHED, PAGES_FETCHED, StageTimings
+from page_cache import CacheStats, PageCache, cache_key
+
+DEFAULT_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+# 1ページから読み込む本文の上限（バイト、0なら無制限）。超えた分は読まずに接続を閉じる
+MAX_PAGE_BYTES = int(os.environ.get('FETCH_MAX_BYTES', 5 * 1024 * 1024))
+# 本文を取得するContent-Type（Content-Typeの無いページは取得する）
+CONTENT_TYPES = tuple(content_type.strip().lower() for content_type in os.environ.get(
+    'FETCH_CONTENT_TYPES', 'text/html,application/xhtml+xml,text/plain').split(',') if content_type.strip())
+READ_CHUNK_SIZE = 64 * 1024
+# 文字コードが分からないときにchardetで判定する本文の先頭のバイト数
+APPARENT_BYTES = 64 * 1024
+
+
+class UnsupportedContent(Exception):
+    """本文を取得しないページ（PDF・画像・アーカイブなど、CONTENT_TYPES以外のContent-Type）"""
+
+
+def check_content_type(url, headers):
+    """本文を読み込む前にContent-Typeを確かめる（対象外ならUnsupportedContent）"""
+    content_type = (headers.get('Content-Type') or '').split(';', 1)[0].strip().lower()
+    if content_type and CONTENT_TYPES and content_type not in CONTENT_TYPES:
+        raise UnsupportedContent(f"対象外のContent-Type: {content_type} ({url})")
+
+
+class LimitedBody:
+    """本文のチャンクをmax_bytesまで溜める（同期・asyncioのバックエンドで共通）
+
+    addがFalseを返したら上限に達しているので、それ以上読み込まない。
+    """
+
+    def __init__(self, max_bytes=MAX_PAGE_BYTES):
+        self.max_bytes = max_bytes
+        self.parts = []
+        self.size = 0
+        self.truncated = False
+
+    def add(self, chunk):
+        if self.max_bytes and self.size + len(chunk) > self.max_bytes:
+            self.parts.append(chunk[:self.max_bytes - self.size])
+            self.size = self.max_bytes
+            self.truncated = True
+            return False
+        self.parts.append(chunk)
+        self.size += len(chunk)
+        return True
+
+    def result(self):
+        """(本文, 途中で打ち切ったか)"""
+        return b''.join(self.parts), self.truncated
+
+
+def read_limited(chunks, max_bytes=MAX_PAGE_BYTES):
+    """本文のチャンクをmax_bytesまで読み込み、(本文, 途中で打ち切ったか)を返す"""
+    body = LimitedBody(max_bytes)
+    for chunk in chunks:
+        if not body.add(chunk):
+            break
+    return body.result()
+
+
+class FetchedPage:
+    """フェッチバックエンドに依存しない取得済みページ"""
+
+    def __init__(self, url, status, headers, content, not_modified=False, truncated=False, encoding=None):
+        # レスポンスのURL（リダイレクト後。相対リンクはこのURLを基準に解決する）
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.content = content
+        # ヘッダーで明示されていなければ本文の先頭（BOM・metaタグ）から判定する（判定済みなら渡されたもの）
+        self.encoding = encoding or (declared_encoding(headers) or sniff_encoding(content)
+                                     or get_encoding_from_headers(headers))
+        # 本文がMAX_PAGE_BYTESで打ち切られているか
+        self.truncated = truncated
+        # キャッシュの本文を返した（前回の取得から変わっていない）ページか
+        self.not_modified = not_modified
+        # クロールエンジンのprepareの戻り値（解析プールのFutureなど）
+        self.prepared = None
+
+    @property
+    def apparent_encoding(self):
+        """本文から推定したエンコーディング（BOM・metaタグが無ければ先頭APPARENT_BYTESをchardetで判定）"""
+        return sniff_encoding(self.content) or chardet.detect(self.content[:APPARENT_BYTES])['encoding']
+
+    def iter_text(self, chunk_size=READ_CHUNK_SIZE):
+        """本文をチャンクごとに逐次デコードする（マルチバイト文字がチャンクをまたいでも壊れない）"""
+        encoding = self.encoding or self.apparent_encoding or 'utf-8'
+        try:
+            decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        except LookupError:
+            decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        for start in range(0, len(self.content), chunk_size):
+            yield decoder.decode(self.content[start:start + chunk_size])
+        yield decoder.decode(b'', final=True)
+
+    @property
+    def text(self):
+        """本文をデコードした文字列"""
+        return ''.join(self.iter_text())
+
+
+class CachingFetcherMixin:
+    """ページキャッシュによる条件付きリクエストの共通処理"""
+
+    def _init_cache(self, cache):
+        self.cache = cache
+        self.cache_stats = CacheStats()
+        # サイトマップのlastmod（{cache_key(url): UNIX時刻}）。これより後に取得済みなら再検証しない
+        self.lastmod = {}
+        # 段階ごとの所要時間（検索側が自分のStageTimingsに差し替えて集計する）
+        self.timings = StageTimings()
+        # クロールの期限（time.monotonic()の値）。各リクエストのタイムアウトを期限までに縮める
+        self.deadline = None
+
+    def _request_timeout(self):
+        """このリクエストのタイムアウト秒数（期限を過ぎていれば例外）"""
+        if self.deadline is None:
+            return self.timeout
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError('クロールの期限を過ぎました')
+        return min(self.timeout, remaining)
+
+    def _until_deadline(self, chunks):
+        """本文のチャンクを返し、受信中に期限を過ぎたら例外にする"""
+        for chunk in chunks:
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                raise TimeoutError('クロールの期限を過ぎました')
+            yield chunk
+
+    def _prepare(self, url, headers):
+        """キャッシュを引き、検証子を付けたヘッダーを返す"""
+        entry = self.cache.get(url) if self.cache else None
+        if entry is not None:
+            headers = self.cache.conditional_headers(entry, headers)
+        return entry, headers
+
+    def _fresh_page(self, url, entry):
+        """サイトマップで前回の取得以降に更新されていないページならキャッシュの本文を返す"""
+        if entry is None:
+            return None
+        lastmod = self.lastmod.get(cache_key(url))
+        if lastmod is None or lastmod > entry['fetched_at']:
+            return None
+        self.cache_stats.hit_fresh()
+        return FetchedPage(url, 200, PageCache.cached_headers(entry), entry['content'], not_modified=True)
+
+    def _complete(self, url, entry, status, headers, content, truncated=False, response_url=None):
+        """304ならキャッシュの本文を、それ以外は保存してから取得した本文を返す
+
+        キャッシュはリクエストしたurlで引き、ページのURLはresponse_url（リダイレクト後）にする。
+        """
+        response_url = response_url or url
+        PAGES_FETCHED.inc()
+        BYTES_FETCHED.inc(len(content))
+        if entry is not None and status == 304:
+            self.cache.touch(url)
+            self.cache_stats.hit()
+            return FetchedPage(response_url, 200, PageCache.cached_headers(entry), entry['content'], not_modified=True)
+        if self.cache:
+            self.cache_stats.miss()
+            # 途中で打ち切った本文は保存しない（304で返すと打ち切られたことが分からなくなる）
+            if not truncated:
+                self.cache.put(url, headers, content)
+        return FetchedPage(response_url, status, headers, content, truncated=truncated)
+
+
+class RequestsFetcher(CachingFetcherMixin):
+    """requests.Sessionによるブロッキングのフェッチバックエンド"""
+
+    def __init__(self, timeout=10, max_connections=8, session=None, cache=None):
+        self.timeout = timeout
+        self._init_cache(cache)
+        if session is None:
+            session = requests.Session()
+            session.headers.update({'User-Agent': DEFAULT_USER_AGENT})
+            # 並列ワーカー数に合わせてコネクションプールを広げる
+            adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+
+    def fetch(self, url, headers=None):
+        """URLを取得してFetchedPageを返す（4xx/5xxは例外）"""
+        entry, headers = self._prepare(url, headers)
+        page = self._fresh_page(url, entry)
+        if page is not None:
+            return page
+        # 本文はContent-Typeを確かめてからMAX_PAGE_BYTESまで読む
+        # （requestではDNS・接続・TLSを区別できないので、レスポンスヘッダーまでをまとめて計る）
+        with self.timings.stage('request'):
+            response = self.session.get(url, timeout=self._request_timeout(), headers=headers, stream=True)
+        with response:
+            response.raise_for_status()
+            if response.status_code == 304:
+                return self._complete(url, entry, 304, response.headers, b'', response_url=response.url)
+            check_content_type(url, response.headers)
+            with self.timings.stage('download'):
+                content, truncated = read_limited(self._until_deadline(response.iter_content(READ_CHUNK_SIZE)))
+        return self._complete(url, entry, response.status_code, response.headers, content, truncated, response.url)
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncFetcher(CachingFetcherMixin):
+    """aiohttpによるasyncioのフェッチバックエンド
+
+    1つのClientSessionでkeep-aliveのコネクションを使い回し、全体の同時接続数と
+    ホストごとの同時接続数をコネクタで制限する。セッションは最初のfetchで
+    実行中のイベントループ上に作られる。
+    """
+
+    def __init__(self, timeout=10, max_connections=100, per_host_limit=8, keepalive_timeout=15,
+                 cache=None):
+        self.timeout = timeout
+        self._init_cache(cache)
+        self.max_connections = max_connections
+        self.per_host_limit = per_host_limit
+        self.keepalive_timeout = keepalive_timeout
+        self._session = None
+
+    def _get_session(self):
+        # aiohttpはオプション依存なので、asyncバックエンドを選んだときだけ読み込む
+        import aiohttp
+
+        if self._session is None:
+            # DNSの解決と新しい接続（TCP・TLS）の所要時間を計る
+            trace = aiohttp.TraceConfig()
+            trace.on_dns_resolvehost_start.append(self._trace_start)
+            trace.on_dns_resolvehost_end.append(lambda *args: self._trace_end('dns', *args))
+            trace.on_connection_create_start.append(self._trace_start)
+            trace.on_connection_create_end.append(lambda *args: self._trace_end('connect', *args))
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.per_host_limit,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={'User-Agent': DEFAULT_USER_AGENT},
+                raise_for_status=True,
+                trace_configs=[trace],
+            )
+        return self._session
+
+    async def _trace_start(self, session, context, params):
+        context.started = time.perf_counter()
+
+    async def _trace_end(self, stage, session, context, params):
+        self.timings.add(stage, time.perf_counter() - context.started)
+
+    async def fetch(self, url, headers=None):
+        """URLを取得してFetchedPageを返す（4xx/5xxは例外）"""
+        session = self._get_session()
+        entry, headers = self._prepare(url, headers)
+        page = self._fresh_page(url, entry)
+        if page is not None:
+            return page
+        options = {}
+        if self.deadline is not None:
+            import aiohttp
+
+            # 本文の受信も含めて期限までに終える
+            options['timeout'] = aiohttp.ClientTimeout(total=self._request_timeout())
+        started = time.perf_counter()
+        async with session.get(url, headers=headers, **options) as response:
+            self.timings.add('request', time.perf_counter() - started)
+            started = time.perf_counter()
+            if response.status == 304:
+                return self._complete(url, entry, 304, response.headers, b'', response_url=str(response.url))
+            check_content_type(url, response.headers)
+            body = LimitedBody()
+            async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+                if not body.add(chunk):
+                    break
+            self.timings.add('download', time.perf_counter() - started)
+            content, truncated = body.result()
+            return self._complete(url, entry, response.status, response.headers, content, truncated,
+                                  str(response.url))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
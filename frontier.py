@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import os
+from urllib.parse import unquote, urlparse
+
+from matcher import normalize
+from urls import canonicalize
+
+
+def anchor_text_rule(url, text, search_texts):
+    """リンクテキストに検索語が含まれるか"""
+    text = normalize(text or '')
+    return 1.0 if any(search_text in text for search_text in search_texts) else 0.0
+
+
+def url_path_rule(url, text, search_texts):
+    """URLのパス・クエリ（デコード済み）に検索語が含まれるか（数字の検索語はjournal_ruleで扱う）"""
+    parsed = urlparse(url)
+    path = normalize(unquote(parsed.path + '?' + parsed.query))
+    return 1.0 if any(search_text in path for search_text in search_texts if not search_text.isdigit()) else 0.0
+
+
+def journal_rule(url, text, search_texts):
+    """数字の検索語は/journal/{数字}のページを優先する（snippetsのリンクの一致と同じ判定）"""
+    normalized_url = url.rstrip('/')
+    return 1.0 if any(f"/journal/{search_text}" in normalized_url
+                      for search_text in search_texts if search_text.isdigit()) else 0.0
+
+
+# (規則, 重み)。規則はrule(url, リンクテキスト, 正規化した検索語のリスト)で0〜1を返す関数
+DEFAULT_RULES = (
+    (anchor_text_rule, 3.0),
+    (url_path_rule, 2.0),
+    (journal_rule, 5.0),
+)
+
+
+def match_density(match_count, text_length):
+    """ページの1000文字あたりの一致数（1で頭打ち）"""
+    return min(1.0, match_count * 1000 / max(text_length, 1000))
+
+
+class LinkScorer:
+    """リンク先のURLを、検索語に関係がありそうな順に並べるための優先度
+
+    優先度は規則ごとの値×重みの合計に、リンク元のページの一致の密度×parent_weightと
+    リンク元のページ自身の優先度×inheritを加えたもの（関係がありそうなリンクの先の
+    リンクも優先する）。rulesに規則を足せば、サイトに合わせた判定を追加できる。
+    1回のクロールで1つ作り、クロールを実行するスレッドから使う。
+    """
+
+    def __init__(self, search_texts, rules=DEFAULT_RULES, parent_weight=1.0, inherit=0.5):
+        self.search_texts = [normalize(search_text) for search_text in search_texts if search_text]
+        self.rules = rules
+        self.parent_weight = parent_weight
+        self.inherit = inherit
+        self._priorities = {}  # {正規化したURL: 優先度}
+
+    def score(self, url, text, parent_density=0.0):
+        return (sum(weight * rule(url, text, self.search_texts) for rule, weight in self.rules)
+                + self.parent_weight * parent_density)
+
+    def score_links(self, links, parent_density=0.0, parent_url=None):
+        """リンク元parent_urlのページの[(URL, リンクテキスト)]を[(URL, 優先度)]にする"""
+        inherited = self.inherit * self._priorities.get(canonicalize(parent_url), 0.0) if parent_url else 0.0
+        scored = []
+        for url, text in links:
+            priority = self.score(url, text, parent_density) + inherited
+            key = canonicalize(url)
+            self._priorities[key] = max(priority, self._priorities.get(key, priority))
+            scored.append((url, priority))
+        return scored
+
+
+def split_link(link):
+    """エンジンに返すリンク（URLか(URL, 優先度)）を(URL, 優先度)にする"""
+    if isinstance(link, str):
+        return link, 0.0
+    return link
+
+
+class PriorityFrontier:
+    """優先度の高い順にURLを取り出すフロンティア（同じ優先度なら浅い順、積んだ順）
+
+    取り出す前のURLがより浅い階層や高い優先度で再び見つかったら、よい方に更新する。
+    同じURLかは正規化したURLで判定し、取り出すのは最初に積んだときのURL。
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._pending = {}  # {正規化したURL: (深さ, 優先度, URL)}（取り出す前のURLだけ）
+        self._order = itertools.count()
+
+    def __bool__(self):
+        return bool(self._pending)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def push(self, url, depth, priority=0.0):
+        key = canonicalize(url)
+        self._pending[key] = (depth, priority, url)
+        heapq.heappush(self._heap, (-priority, depth, next(self._order), key))
+
+    def update(self, url, depth, priority=0.0):
+        """取り出す前のURLなら、深さ・優先度のよい方で積み直す（取り出し済みなら何もしない）"""
+        current = self._pending.get(canonicalize(url))
+        if current is None:
+            return
+        better = (min(current[0], depth), max(current[1], priority))
+        if better != current[:2]:
+            self.push(current[2], *better)
+
+    def pop(self):
+        """(URL, 深さ)を返す（更新前の古いエントリは読み飛ばす）"""
+        while self._heap:
+            priority, depth, _, key = heapq.heappop(self._heap)
+            current = self._pending.get(key)
+            if current is not None and current[:2] == (depth, -priority):
+                del self._pending[key]
+                return current[2], depth
+        raise IndexError('pop from an empty frontier')
+
+
+def frontier_strategy():
+    """環境変数CRAWL_FRONTIERのフロンティアの種類（'bfs'（既定）または'best'）"""
+    return os.environ.get('CRAWL_FRONTIER', 'bfs')
@@ -1,22 +1,34 @@
 import os
 
+from dotenv import load_dotenv
+
+# .envのLOG_LEVELなども使う
+load_dotenv()
+
 # 環境変数からポート番号を取得
 port = os.environ.get('PORT', '8000')
 bind = f"0.0.0.0:{port}"
 
 # ワーカー設定
-workers = int(os.environ.get('WEB_CONCURRENCY', 2))  # ワーカー数を減らす
+# 検索ジョブのキュー（jobsモジュール）はプロセス内にあるため、ワーカーは1つにして
+# スレッドで処理する。複数にすると、ジョブを登録したワーカー以外に届いた
+# /jobs/<id>・SSEのリクエストがジョブを見つけられない
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
 timeout = int(os.environ.get('TIMEOUT', 120))
-worker_class = "sync"
+# SSEの配信中もワーカーを占有しないようにスレッドワーカーを使う
+worker_class = "gthread"
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
 keepalive = 5
-max_requests = 1000
-max_requests_jitter = 50
+# リクエスト数でのワーカーの再起動はしない。ワーカーが1つなので、再起動すると
+# キューで待機中・実行中のジョブとそのSSEの配信が黙って失われる
+max_requests = 0
 
 # ログ設定
-loglevel = "debug"
+loglevel = os.environ.get('LOG_LEVEL', 'info').lower()
 accesslog = "-"
 errorlog = "-"
-capture_output = True
+# アプリのログはlogsモジュールが直接標準出力に書くので、printの取り込みは不要
+capture_output = False
 enable_stdio_inheritance = True
 
 # デバッグ設定
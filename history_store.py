@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import redis
+
+from snippets import json_default
+
+
+class SQLiteHistoryStore:
+    """SQLite（WALモード）に保存する検索履歴
+
+    履歴は1件ずつ追記し、検索テキスト・ベースURL・日時の索引で引く。
+    max_entriesを超えた古い履歴は追記のたびに削除する。
+    """
+
+    def __init__(self, path, max_entries=100):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                search_text TEXT NOT NULL,
+                base_url TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_search_text ON entries (search_text, created_at);
+            CREATE INDEX IF NOT EXISTS entries_base_url ON entries (base_url, created_at);
+            CREATE INDEX IF NOT EXISTS entries_created_at ON entries (created_at);
+            CREATE TABLE IF NOT EXISTS visited (
+                search_text TEXT NOT NULL,
+                url TEXT NOT NULL,
+                PRIMARY KEY (search_text, url)
+            ) WITHOUT ROWID;
+        ''')
+        self._conn.commit()
+
+    def add(self, entry):
+        """履歴を1件追記"""
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO entries (search_text, base_url, created_at, data) VALUES (?, ?, ?, ?)',
+                (entry['search_text'], entry['base_url'], time.time(),
+                 json.dumps(entry, ensure_ascii=False, default=json_default))
+            )
+            self._conn.execute(
+                'DELETE FROM entries WHERE id NOT IN '
+                '(SELECT id FROM entries ORDER BY created_at DESC, id DESC LIMIT ?)',
+                (self.max_entries,)
+            )
+            self._conn.commit()
+
+    def recent(self, page=1, per_page=10, search_text=None, base_url=None):
+        """新しい順に1ページ分の履歴と総件数を返す"""
+        where, params = self._where(search_text, base_url)
+        with self._lock:
+            total = self._conn.execute(f'SELECT COUNT(*) FROM entries {where}', params).fetchone()[0]
+            rows = self._conn.execute(
+                f'SELECT data FROM entries {where} ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?',
+                params + [per_page, (page - 1) * per_page]
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows], total
+
+    def latest(self, search_text=None, base_url=None):
+        """条件に合う最新の履歴（無ければNone）"""
+        entries, _ = self.recent(1, 1, search_text, base_url)
+        return entries[0] if entries else None
+
+    def add_visited(self, search_text, urls):
+        """検索テキストごとに検索済みのURLを記録"""
+        with self._lock:
+            self._conn.executemany('INSERT OR IGNORE INTO visited VALUES (?, ?)',
+                                   ((search_text, url) for url in urls))
+            self._conn.commit()
+
+    def visited_urls(self, search_text):
+        with self._lock:
+            rows = self._conn.execute('SELECT url FROM visited WHERE search_text = ?',
+                                      (search_text,)).fetchall()
+        return {row[0] for row in rows}
+
+    def is_empty(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM entries').fetchone()[0] == 0
+
+    @staticmethod
+    def _where(search_text, base_url):
+        clauses, params = [], []
+        if search_text is not None:
+            clauses.append('search_text = ?')
+            params.append(search_text)
+        if base_url is not None:
+            clauses.append('base_url = ?')
+            params.append(base_url)
+        return ('WHERE ' + ' AND '.join(clauses) if clauses else ''), params
+
+
+class RedisHistoryStore:
+    """Redisに保存する検索履歴（REDIS_URLが設定されている場合）
+
+    履歴本体はハッシュ、並び順と検索テキスト・ベースURLごとの索引はソート済みセットで持つ。
+    """
+
+    def __init__(self, client, prefix='history', max_entries=100):
+        self.client = client
+        self.prefix = prefix
+        self.max_entries = max_entries
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def add(self, entry):
+        entry_id = str(self.client.incr(self._key('next_id')))
+        score = time.time()
+        pipe = self.client.pipeline()
+        pipe.hset(self._key('entries'), entry_id, json.dumps(entry, ensure_ascii=False, default=json_default))
+        pipe.zadd(self._key('by_time'), {entry_id: score})
+        pipe.zadd(self._key('by_text', entry['search_text']), {entry_id: score})
+        pipe.zadd(self._key('by_base', entry['base_url']), {entry_id: score})
+        pipe.execute()
+
+        # 古い履歴を削除
+        expired = self.client.zrange(self._key('by_time'), 0, -self.max_entries - 1)
+        if expired:
+            entries = self.client.hmget(self._key('entries'), expired)
+            pipe = self.client.pipeline()
+            for entry_id, data in zip(expired, entries):
+                if data:
+                    old = json.loads(data)
+                    pipe.zrem(self._key('by_text', old['search_text']), entry_id)
+                    pipe.zrem(self._key('by_base', old['base_url']), entry_id)
+            pipe.hdel(self._key('entries'), *expired)
+            pipe.zrem(self._key('by_time'), *expired)
+            pipe.execute()
+
+    def recent(self, page=1, per_page=10, search_text=None, base_url=None):
+        if search_text is not None and base_url is not None:
+            # 2つの索引の共通部分を一時キーに作る
+            index = self._key('tmp', os.urandom(8).hex())
+            pipe = self.client.pipeline()
+            pipe.zinterstore(index, [self._key('by_text', search_text), self._key('by_base', base_url)],
+                             aggregate='MAX')
+            pipe.expire(index, 10)
+            pipe.execute()
+        elif search_text is not None:
+            index = self._key('by_text', search_text)
+        elif base_url is not None:
+            index = self._key('by_base', base_url)
+        else:
+            index = self._key('by_time')
+
+        total = self.client.zcard(index)
+        start = (page - 1) * per_page
+        entry_ids = self.client.zrevrange(index, start, start + per_page - 1)
+        if not entry_ids:
+            return [], total
+        entries = self.client.hmget(self._key('entries'), entry_ids)
+        return [json.loads(data) for data in entries if data], total
+
+    def latest(self, search_text=None, base_url=None):
+        entries, _ = self.recent(1, 1, search_text, base_url)
+        return entries[0] if entries else None
+
+    def add_visited(self, search_text, urls):
+        urls = list(urls)
+        if urls:
+            self.client.sadd(self._key('visited', search_text), *urls)
+
+    def visited_urls(self, search_text):
+        return {url.decode('utf-8') if isinstance(url, bytes) else url
+                for url in self.client.smembers(self._key('visited', search_text))}
+
+    def is_empty(self):
+        return self.client.zcard(self._key('by_time')) == 0
+
+
+def import_json_history(store, path):
+    """以前のsearch_history.json（リスト形式・辞書形式の両方）を取り込む"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            history = json.load(f)
+    except (OSError, ValueError):
+        return
+    if isinstance(history, list):
+        # 新しい順に保存されているので古いものから追記する
+        for entry in reversed(history):
+            if isinstance(entry, dict) and 'search_text' in entry and 'base_url' in entry:
+                store.add(entry)
+    elif isinstance(history, dict):
+        for search_text, record in history.items():
+            if isinstance(record, dict):
+                store.add_visited(search_text, record.get('urls', []))
+
+
+_history_store = None
+_history_store_lock = threading.Lock()
+
+
+def get_history_store():
+    """検索履歴のストアを返す（REDIS_URLがあればRedis、無ければSQLite）"""
+    global _history_store
+    with _history_store_lock:
+        if _history_store is not None:
+            return _history_store
+
+        max_entries = int(os.environ.get('HISTORY_MAX_ENTRIES', 100))
+        redis_url = os.environ.get('REDIS_URL')
+        if redis_url:
+            try:
+                client = redis.from_url(redis_url)
+                client.ping()
+                _history_store = RedisHistoryStore(client, max_entries=max_entries)
+            except redis.exceptions.ConnectionError as e:
+                logging.warning(f"Redis connection failed for history store: {str(e)}")
+        if _history_store is None:
+            _history_store = SQLiteHistoryStore(
+                os.environ.get('HISTORY_DB_PATH', 'search_history.sqlite3'), max_entries=max_entries
+            )
+
+        # 以前のJSONファイルの履歴を最初の1回だけ取り込む
+        legacy_path = 'search_history.json'
+        if os.path.exists(legacy_path) and _history_store.is_empty():
+            import_json_history(_history_store, legacy_path)
+        return _history_store
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SearchJob:
+    """バックグラウンドで実行される1件の検索ジョブ"""
+
+    def __init__(self, params):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = 'queued'  # queued / running / done / failed
+        self.events = []
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._condition = threading.Condition()
+
+    def publish(self, event_type, data):
+        """イベントを追加し、待機中の購読者を起こす"""
+        with self._condition:
+            self.events.append({'type': event_type, 'data': data})
+            self._condition.notify_all()
+
+    def finish(self, status, data):
+        """終了状態と最後のイベントを同時に反映する（購読者が取りこぼさないように）"""
+        with self._condition:
+            self.status = status
+            self.finished_at = time.time()
+            self.events.append({'type': status, 'data': data})
+            self._condition.notify_all()
+
+    def wait_events(self, start, timeout=15):
+        """start番目以降のイベントを返す（無ければtimeout秒まで待つ）"""
+        with self._condition:
+            if len(self.events) <= start and not self.finished:
+                self._condition.wait(timeout)
+            return self.events[start:]
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def partial_results(self):
+        """ここまでに見つかった検索結果"""
+        with self._condition:
+            return [e['data'] for e in self.events if e['type'] == 'result']
+
+    def to_dict(self):
+        """状態取得API用の辞書（完了前は部分結果を返す）"""
+        data = {
+            'job_id': self.id,
+            'status': self.status,
+            'pages_searched': sum(1 for e in self.events if e['type'] == 'progress'),
+            'results': self.partial_results(),
+            'error': self.error,
+        }
+        if self.result:
+            data.update(self.result)
+        return data
+
+
+class JobQueue:
+    """検索ジョブをローカルのワーカープールで実行するキュー
+
+    run(params, progress_callback)は検索を実行して結果の辞書を返す関数。
+    progress_callback(event_type, data)でページごとの進捗と部分結果を通知する。
+    終了したジョブはttl秒後に破棄する。
+    """
+
+    def __init__(self, run, max_workers=2, ttl=3600):
+        self.run = run
+        self.ttl = ttl
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit(self, params):
+        """ジョブを登録してすぐに返す"""
+        self._cleanup()
+        job = SearchJob(params)
+        with self._lock:
+            self.jobs[job.id] = job
+        self._executor.submit(self._execute, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def counts(self):
+        """{状態: ジョブ数}（queuedの数がキューの深さ）"""
+        counts = {'queued': 0, 'running': 0, 'done': 0, 'failed': 0}
+        with self._lock:
+            for job in self.jobs.values():
+                counts[job.status] += 1
+        return counts
+
+    def _execute(self, job):
+        job.status = 'running'
+        job.publish('status', {'status': 'running'})
+        try:
+            result = self.run(job.params, job.publish)
+        except Exception as e:
+            result = {'error': str(e)}
+        
+        if result.get('error'):
+            job.error = result['error']
+            job.finish('failed', {'error': job.error})
+        else:
+            job.result = result
+            job.finish('done', result)
+
+    def _cleanup(self):
+        """保持期限を過ぎた終了済みジョブを削除"""
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job.finished_at and now - job.finished_at > self.ttl]
+            for job_id in expired:
+                del self.jobs[job_id]
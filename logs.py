@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import atexit
+import contextvars
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import threading
+import uuid
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+# 実行中の検索のID（ログのレコードにsearch_idとして付ける）
+_search_id = contextvars.ContextVar('search_id', default=None)
+
+# LogRecordの標準の属性（これ以外はextraで渡された構造化フィールドとして出力する）
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'search_id'}
+
+
+def current_search_id():
+    return _search_id.get()
+
+
+@contextmanager
+def search_context(search_id=None):
+    """ブロック内で記録するログにsearch_idを付ける（省略すると新しいIDを作る）"""
+    token = _search_id.set(search_id or uuid.uuid4().hex[:12])
+    try:
+        yield _search_id.get()
+    finally:
+        _search_id.reset(token)
+
+
+def in_current_context(func):
+    """呼び出し元のcontextvars（search_idなど）を引き継いで、別のスレッドでfuncを実行する関数を返す"""
+    context = contextvars.copy_context()
+    # 同じContextには複数のスレッドから同時に入れないので、呼び出しごとに複製する
+    return lambda *args, **kwargs: context.copy().run(func, *args, **kwargs)
+
+
+class SearchIdFilter(logging.Filter):
+    """レコードを作ったスレッドのsearch_idをレコードに付ける"""
+
+    def filter(self, record):
+        record.search_id = _search_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコードを1行のJSONにする（extraで渡したフィールドもそのまま含める）"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'search_id', None):
+            entry['search_id'] = record.search_id
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """開発用の1行のテキスト形式"""
+
+    def __init__(self):
+        super().__init__('%(asctime)s [%(levelname)s] %(name)s %(search_id)s %(message)s')
+
+    def format(self, record):
+        if getattr(record, 'search_id', None) is None:
+            record.search_id = '-'
+        return super().format(record)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """レコードを整形せずにキューに入れるハンドラー
+
+    QueueHandlerは既定でキューに入れる前にメッセージを整形するが、同じプロセス内の
+    キューなので整形はリスナーのスレッドに任せ、ログを出すスレッドでは行わない。
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class SampledLogger:
+    """ページごとのように件数の多いイベントを、rateの割合だけ記録するロガー
+
+    レベルで除外されるときや間引くときは、LogRecordもメッセージも作らない。
+    """
+
+    def __init__(self, logger, rate=1.0):
+        self.logger = logger
+        self.rate = rate
+
+    def log(self, level, msg, *args, **kwargs):
+        if not self.logger.isEnabledFor(level):
+            return
+        if self.rate < 1 and random.random() >= self.rate:
+            return
+        self.logger.log(level, msg, *args, **kwargs)
+
+    def debug(self, msg, *args, **kwargs):
+        self.log(logging.DEBUG, msg, *args, **kwargs)
+
+    def info(self, msg, *args, **kwargs):
+        self.log(logging.INFO, msg, *args, **kwargs)
+
+
+def page_logger(name):
+    """ページごとのイベント用のロガー（LOG_PAGE_SAMPLE_RATEの割合だけ記録する）"""
+    return SampledLogger(logging.getLogger(name), float(os.environ.get('LOG_PAGE_SAMPLE_RATE', 0.1)))
+
+
+_listener = None
+_configure_lock = threading.Lock()
+
+
+def configure_logging():
+    """ルートロガーを、キュー経由でバックグラウンドのスレッドが書き出すように設定する
+
+    LOG_LEVEL（既定INFO）・LOG_LEVELS（"crawler=DEBUG,urllib3=WARNING"のような
+    ロガーごとのレベル）・LOG_FORMAT（json・text）で設定する。2回目以降は何もしない。
+    """
+    global _listener
+    with _configure_lock:
+        if _listener is not None:
+            return
+        output = logging.StreamHandler(sys.stdout)
+        output.setFormatter(TextFormatter() if os.environ.get('LOG_FORMAT', 'json') == 'text' else JsonFormatter())
+
+        records = queue.SimpleQueue()
+        handler = _DeferredQueueHandler(records)
+        handler.addFilter(SearchIdFilter())
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+        for item in os.environ.get('LOG_LEVELS', 'urllib3=WARNING').split(','):
+            if '=' in item:
+                name, level = item.split('=', 1)
+                logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+        _listener = QueueListener(records, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from collections import deque
+from functools import lru_cache
+
+
+def normalize(text):
+    """大文字小文字を区別しないための小文字化（文字数を変えない）"""
+    lowered = text.lower()
+    if len(lowered) == len(text):
+        return lowered
+    return ''.join(c.lower() if len(c.lower()) == 1 else c for c in text)
+
+
+class MultiPatternMatcher:
+    """複数の検索語を1回の走査で探すAho-Corasickオートマトン
+
+    大文字小文字は区別しない。scanは検索語ごとの一致開始位置（文字オフセット、
+    重なりも含む）を返す。
+    """
+
+    def __init__(self, patterns):
+        self.patterns = []
+        # 小文字化すると同じになる検索語はまとめて扱う
+        self._originals = {}
+        for pattern in patterns:
+            key = normalize(pattern)
+            if not key:
+                continue
+            if key not in self._originals:
+                self._originals[key] = []
+                self.patterns.append(key)
+            if pattern not in self._originals[key]:
+                self._originals[key].append(pattern)
+
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        for key in self.patterns:
+            self._add(key)
+        self._build_failure_links()
+
+    def _add(self, key):
+        state = 0
+        for char in key:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][char] = next_state
+            state = next_state
+        self._output[state].append(key)
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def scan(self, text):
+        """{元の検索語: [一致開始位置, ...]}を返す（一致しない検索語は含まない）"""
+        found = {}
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for i, char in enumerate(normalize(text)):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for key in output[state]:
+                found.setdefault(key, []).append(i - len(key) + 1)
+
+        results = {}
+        for key, offsets in found.items():
+            for pattern in self._originals[key]:
+                results[pattern] = offsets
+        return results
+
+    def contains(self, text):
+        """textに含まれる検索語の集合"""
+        return set(self.scan(text))
+
+
+@lru_cache(maxsize=128)
+def _cached_matcher(patterns):
+    return MultiPatternMatcher(patterns)
+
+
+def get_matcher(patterns):
+    """検索語の組み合わせごとにオートマトンをキャッシュして返す（ページ・リクエスト間で再利用）"""
+    return _cached_matcher(tuple(patterns))
+
+
+def non_overlapping(offsets, length):
+    """重なる一致を左から順に除いた一致位置（re.findallと同じ数え方）"""
+    starts = []
+    last = 0
+    for start in offsets:
+        if start >= last:
+            starts.append(start)
+            last = start + length
+    return starts
+
+
+def highlight(text, offsets, length):
+    """一致位置を<mark>で囲む（重なる一致は左から順に採用し、re.subと同じ結果にする）"""
+    parts = []
+    last = 0
+    for start in non_overlapping(offsets, length):
+        parts.append(text[last:start])
+        parts.append(f'<mark>{text[start:start + length]}</mark>')
+        last = start + length
+    parts.append(text[last:])
+    return ''.join(parts)
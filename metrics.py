@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# 所要時間のヒストグラムのバケット（秒）
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """ラベルの組ごとに値を持つメトリクスの共通部分"""
+
+    kind = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    """増えるだけの値（取得したページ数など）"""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        super().__init__(name, help_text)
+        self._values = defaultdict(int)
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            self._values[self._key(labels)] += amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            return [f'{self.name}{_labels(key)} {_number(value)}' for key, value in sorted(self._values.items())]
+
+
+class Gauge(_Metric):
+    """現在の値。funcを渡すと出力のたびにfunc()（{ラベルの辞書のタプル: 値}または値）を呼ぶ"""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, func=None):
+        super().__init__(name, help_text)
+        self._values = {}
+        self.func = func
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def _samples(self):
+        if self.func is not None:
+            values = self.func()
+            if not isinstance(values, dict):
+                values = {(): values}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f'{self.name}{_labels(key)} {_number(value)}' for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    """所要時間などの分布（バケットごとの件数・合計・件数）"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}  # {ラベル: [バケットごとの件数, 合計, 件数]}
+
+    def observe(self, value, **labels):
+        with self._lock:
+            entry = self._values.setdefault(self._key(labels), [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def _samples(self):
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{_labels(key + (("le", _number(bound)),))} {cumulative}')
+                lines.append(f'{self.name}_sum{_labels(key)} {_number(total)}')
+                lines.append(f'{self.name}_count{_labels(key)} {count}')
+        return lines
+
+
+class MetricsRegistry:
+    """プロセス内のメトリクスをまとめ、Prometheusのテキスト形式で出力する"""
+
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name, help_text, func=None):
+        return self._register(Gauge(name, help_text, func))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+PAGES_FETCHED = REGISTRY.counter('crawl_pages_fetched_total', 'レスポンスを受け取ったページ数（304を含む）')
+BYTES_FETCHED = REGISTRY.counter('crawl_bytes_fetched_total', '受信した本文のバイト数')
+FETCH_ERRORS = REGISTRY.counter('crawl_fetch_errors_total', '取得に失敗したページ数（例外の種類ごと）')
+PAGE_CACHE = REGISTRY.counter('crawl_page_cache_total', 'ページキャッシュの結果（hit・fresh・miss）')
+RESULT_CACHE = REGISTRY.counter('search_result_cache_total', '検索結果のキャッシュの結果（hit・miss・coalesced）')
+STAGE_SECONDS = REGISTRY.histogram('search_stage_seconds', '検索の段階ごとの所要時間（秒）')
+SEARCHES = REGISTRY.counter('searches_total', '実行した検索の数（結果ごと）')
+SEARCHES_IN_PROGRESS = REGISTRY.gauge('searches_in_progress', '実行中の検索の数')
+
+
+class StageTimings:
+    """1回の検索の段階（取得・解析・検索・履歴など）ごとの所要時間と回数
+
+    記録した時間はプロセス全体のsearch_stage_secondsにも加える。複数のスレッドから
+    記録できる（フェッチはワーカースレッドで、解析は呼び出し元のスレッドで記録する）。
+    """
+
+    def __init__(self):
+        self._seconds = defaultdict(float)
+        self._counts = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._seconds[stage] += seconds
+            self._counts[stage] += 1
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+    @contextmanager
+    def stage(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def to_dict(self):
+        """{段階: {'seconds': 合計秒数, 'count': 回数}}"""
+        with self._lock:
+            return {stage: {'seconds': round(seconds, 4), 'count': self._counts[stage]}
+                    for stage, seconds in self._seconds.items()}
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+from requests.structures import CaseInsensitiveDict
+
+from metrics import PAGE_CACHE
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def cache_key(url):
+    """キャッシュのキーにするURL（スキーム・ホストの小文字化、既定ポートとフラグメントの除去）"""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    return urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+
+
+class CacheStats:
+    """1回の検索でのキャッシュヒット数・ミス数"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.fresh = 0  # サイトマップのlastmodから未更新と分かり、リクエストしなかった数
+        self._lock = threading.Lock()
+
+    def hit(self):
+        with self._lock:
+            self.hits += 1
+        PAGE_CACHE.inc(result='hit')
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+        PAGE_CACHE.inc(result='miss')
+
+    def hit_fresh(self):
+        with self._lock:
+            self.hits += 1
+            self.fresh += 1
+        PAGE_CACHE.inc(result='fresh')
+
+    def to_dict(self):
+        return {'hits': self.hits, 'misses': self.misses, 'fresh': self.fresh}
+
+
+class PageCache:
+    """SQLiteに保存するHTTPページキャッシュ
+
+    正規化したURLをキーに本文・Content-Type・ETag・Last-Modifiedを保存し、
+    次回の取得時にIf-None-Match/If-Modified-Sinceで再検証する。
+    保存期間（ttl秒）と合計サイズ（max_bytes）を超えた分は古いものから削除する。
+    """
+
+    def __init__(self, path, max_bytes=200 * 1024 * 1024, ttl=24 * 3600):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                content BLOB NOT NULL,
+                content_type TEXT,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER NOT NULL,
+                fetched_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        ''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)')
+        self._conn.commit()
+
+    def get(self, url):
+        """キャッシュされたページを返す（無ければNone）"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT content, content_type, etag, last_modified, fetched_at FROM pages WHERE url = ?',
+                (cache_key(url),)
+            ).fetchone()
+        if row is None or time.time() - row[4] > self.ttl:
+            return None
+        content, content_type, etag, last_modified, fetched_at = row
+        return {
+            'content': content,
+            'content_type': content_type,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched_at': fetched_at,
+        }
+
+    def conditional_headers(self, entry, headers=None):
+        """キャッシュの検証子を付けたリクエストヘッダーを返す"""
+        headers = dict(headers or {})
+        if entry is not None:
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def put(self, url, headers, content):
+        """取得したページを保存（検証子が無いページは再検証できないので保存しない）"""
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (cache_key(url), content, headers.get('Content-Type'), etag, last_modified,
+                 len(content), now, now)
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def touch(self, url):
+        """再検証できたページの最終利用時刻を更新"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?',
+                               (now, now, cache_key(url)))
+            self._conn.commit()
+
+    def _evict(self, now):
+        """期限切れと、合計サイズの上限を超えた分を古い順に削除"""
+        self._conn.execute('DELETE FROM pages WHERE fetched_at < ?', (now - self.ttl,))
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute('SELECT url, size FROM pages ORDER BY accessed_at').fetchall()
+        for url, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute('DELETE FROM pages WHERE url = ?', (url,))
+            total -= size
+
+    @staticmethod
+    def cached_headers(entry):
+        """キャッシュから返すページのレスポンスヘッダー"""
+        headers = CaseInsensitiveDict()
+        if entry['content_type']:
+            headers['Content-Type'] = entry['content_type']
+        return headers
+
+
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+
+def get_page_cache():
+    """環境変数の設定で共有のページキャッシュを返す（PAGE_CACHE_PATHが空なら無効）"""
+    global _page_cache
+    path = os.environ.get('PAGE_CACHE_PATH', 'page_cache.sqlite3')
+    if not path:
+        return None
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = PageCache(
+                path,
+                max_bytes=int(os.environ.get('PAGE_CACHE_MAX_MB', 200)) * 1024 * 1024,
+                ttl=int(os.environ.get('PAGE_CACHE_TTL', 24 * 3600)),
+            )
+        return _page_cache
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from requests.structures import CaseInsensitiveDict
+
+from extraction import extract_document
+from fetchers import FetchedPage
+from snippets import match_document
+
+
+def portable_page(page):
+    """ワーカープロセスに送れる形のページ（ヘッダーはContent-Typeだけ。文字コードは判定済みのものを渡す）"""
+    headers = CaseInsensitiveDict()
+    content_type = page.headers.get('Content-Type')
+    if content_type is not None:
+        headers['Content-Type'] = content_type
+    return FetchedPage(page.url, page.status, headers, page.content, page.not_modified, encoding=page.encoding)
+
+
+def parse_and_match(url, page, depth, search_texts):
+    """ワーカープロセスで文書を抽出して検索し、(文書, {検索語: 検索結果})を返す"""
+    document = extract_document(url, depth, page)
+    return document, (match_document(document, search_texts) if search_texts else {})
+
+
+class ParsePool:
+    """HTMLの解析・検索をワーカープロセスで行うプール
+
+    フェッチ（スレッド・asyncio）とは別のプロセスで解析するので、GILに妨げられずに
+    全てのコアを使える。ワーカーには本文のバイト列を渡し、抽出した文書と検索結果だけを
+    受け取る。ページごとの受け渡しの分だけ遅くなるので、速くなるのは解析・検索にCPUを
+    多く使うページの場合だけ。
+    """
+
+    def __init__(self, max_workers=None):
+        # スレッドのあるプロセス（gunicornのgthreadワーカーなど）からforkしないようにspawnで起動する
+        self._executor = ProcessPoolExecutor(max_workers or os.cpu_count(),
+                                             mp_context=multiprocessing.get_context('spawn'))
+
+    def submit(self, func, url, page, *args):
+        """func(url, page, *args)をワーカープロセスで実行し、Futureを返す"""
+        return self._executor.submit(func, url, portable_page(page), *args)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    """環境変数PARSE_WORKERSのプロセス数で共有の解析プールを返す
+
+    0（既定）ならNoneで、解析はクロールを実行するスレッドで行う。autoならCPUのコア数。
+    """
+    global _parse_pool
+    workers = os.environ.get('PARSE_WORKERS', '0')
+    if workers == '0':
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ParsePool(None if workers == 'auto' else int(workers))
+        return _parse_pool
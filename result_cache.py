@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+from matcher import normalize
+from metrics import RESULT_CACHE
+from page_cache import cache_key
+from snippets import json_default
+
+logger = logging.getLogger(__name__)
+
+
+def result_key(base_url, search_text, *settings):
+    """検索結果のキャッシュのキー（正規化したベースURL・検索語とクロールの設定から作る）"""
+    parts = [cache_key(base_url), normalize(search_text.strip())] + list(settings)
+    return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class _Call:
+    """実行中の検索（同じキーの検索はこれの完了を待つ）"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """検索のレスポンスのキャッシュの共通部分
+
+    同じキーの検索が同時に来た場合は1つだけ実行し、他はその結果を待つ（シングルフライト）。
+    キャッシュするのは最後までクロールして成功したレスポンスだけで、ttl秒を過ぎたら捨てる。
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, base_url, compute):
+        """(レスポンス, このスレッドで実行したか)を返す
+
+        キャッシュに無ければcompute()を実行してキャッシュに入れる。他のスレッド・ワーカーが
+        同じ検索を実行中ならその完了を待ち、結果を受け取る。
+        """
+        value = self.get(key)
+        if value is not None:
+            RESULT_CACHE.inc(result='hit')
+            return value, False
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            RESULT_CACHE.inc(result='coalesced')
+            return dict(call.value), False
+
+        try:
+            call.value, computed = self._compute_once(key, base_url, compute)
+            return dict(call.value), computed
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _compute_once(self, key, base_url, compute):
+        """プロセス内で1つのスレッドだけが呼ぶ。検索を実行してキャッシュに入れる"""
+        RESULT_CACHE.inc(result='miss')
+        value = compute()
+        self.put(key, base_url, value)
+        return value, True
+
+    def put(self, key, base_url, value):
+        """最後までクロールして成功したレスポンスだけをキャッシュに入れる"""
+        if value.get('success') and not value.get('partial'):
+            self.set(key, base_url, value)
+
+
+class MemoryResultCache(ResultCache):
+    """プロセス内のLRUキャッシュ（REDIS_URLが無い場合）"""
+
+    def __init__(self, max_entries=256, ttl=300):
+        super().__init__(ttl)
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # {キー: (ベースURL, 保存した時刻, レスポンス)}
+        self._entries_lock = threading.Lock()
+
+    def get(self, key):
+        with self._entries_lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[1] > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            # 呼び出し元がレスポンスにsearch_idなどを加えても、キャッシュは変わらないようにする
+            return dict(entry[2])
+
+    def set(self, key, base_url, value):
+        with self._entries_lock:
+            self._entries[key] = (cache_key(base_url), time.time(), dict(value))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, base_url=None):
+        """base_url（省略すると全て）の検索結果を削除し、削除した数を返す"""
+        with self._entries_lock:
+            if base_url is None:
+                count = len(self._entries)
+                self._entries.clear()
+                return count
+            base = cache_key(base_url)
+            keys = [key for key, entry in self._entries.items() if entry[0] == base]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+
+class RedisResultCache(ResultCache):
+    """Redisに保存する、ワーカー間で共有のキャッシュ（REDIS_URLが設定されている場合）
+
+    レスポンスはJSONでキーごとに保存し、ベースURLごとのキーの集合で削除できるようにする。
+    同じ検索を実行中かはロックのキーで共有し、他のワーカーはロックが外れるまで結果を待つ。
+    """
+
+    def __init__(self, client, prefix='results', ttl=300, lock_seconds=600, poll_interval=0.5):
+        super().__init__(ttl)
+        self.client = client
+        self.prefix = prefix
+        self.lock_seconds = lock_seconds
+        self.poll_interval = poll_interval
+
+    def _key(self, *parts):
+        return ':'.join((self.prefix,) + parts)
+
+    def get(self, key):
+        data = self.client.get(self._key('entry', key))
+        return json.loads(data) if data else None
+
+    def set(self, key, base_url, value):
+        base_key = self._key('base', cache_key(base_url))
+        pipe = self.client.pipeline()
+        pipe.set(self._key('entry', key), json.dumps(value, ensure_ascii=False, default=json_default), ex=self.ttl)
+        pipe.sadd(base_key, key)
+        pipe.expire(base_key, self.ttl)
+        pipe.execute()
+
+    def invalidate(self, base_url=None):
+        """base_url（省略すると全て）の検索結果を削除し、削除した数を返す"""
+        if base_url is None:
+            entries = list(self.client.scan_iter(match=self._key('entry', '*')))
+            keys = entries + list(self.client.scan_iter(match=self._key('base', '*')))
+            if keys:
+                self.client.delete(*keys)
+            return len(entries)
+        base_key = self._key('base', cache_key(base_url))
+        keys = [key.decode('utf-8') if isinstance(key, bytes) else key for key in self.client.smembers(base_key)]
+        pipe = self.client.pipeline()
+        for key in keys:
+            pipe.delete(self._key('entry', key))
+        pipe.delete(base_key)
+        results = pipe.execute()
+        return sum(results[:-1])
+
+    def _compute_once(self, key, base_url, compute):
+        lock_key = self._key('lock', key)
+        token = os.urandom(8).hex()
+        while not self.client.set(lock_key, token, nx=True, ex=self.lock_seconds):
+            # 他のワーカーが同じ検索を実行中なので、結果がキャッシュに入るのを待つ
+            time.sleep(self.poll_interval)
+            value = self.get(key)
+            if value is not None:
+                RESULT_CACHE.inc(result='coalesced')
+                return value, False
+        try:
+            # ロックを待つ間に他のワーカーの検索が終わっていればそれを使う
+            value = self.get(key)
+            if value is not None:
+                RESULT_CACHE.inc(result='hit')
+                return value, False
+            return super()._compute_once(key, base_url, compute)
+        finally:
+            # 自分のロックのときだけ外す（期限切れの後に他のワーカーが取ったロックは残す）
+            if self.client.get(lock_key) == token.encode('utf-8'):
+                self.client.delete(lock_key)
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """検索結果のキャッシュを返す（REDIS_URLがあればRedis、無ければプロセス内のLRU）
+
+    RESULT_CACHE_TTL（秒、既定300）が0ならNoneで、キャッシュしない。
+    """
+    global _result_cache
+    ttl = int(os.environ.get('RESULT_CACHE_TTL', 300))
+    if ttl <= 0:
+        return None
+    with _result_cache_lock:
+        if _result_cache is not None:
+            return _result_cache
+
+        redis_url = os.environ.get('REDIS_URL')
+        if redis_url:
+            try:
+                client = redis.from_url(redis_url)
+                client.ping()
+                _result_cache = RedisResultCache(client, ttl=ttl)
+            except redis.exceptions.ConnectionError as e:
+                logger.warning("Redis connection failed for result cache: %s", e)
+        if _result_cache is None:
+            _result_cache = MemoryResultCache(int(os.environ.get('RESULT_CACHE_SIZE', 256)), ttl=ttl)
+        return _result_cache
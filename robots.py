@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from urllib.parse import urljoin, urlparse
+from urllib.robotparser import RobotFileParser
+
+from fetchers import DEFAULT_USER_AGENT
+from sitemap import default_sitemap_url, fetch_sitemaps, lastmods
+
+logger = logging.getLogger(__name__)
+
+# Crawl-delayが無いホストへの既定の1秒あたりのリクエスト数（0は制限なし。CRAWL_HOST_RATEで変えられる）
+# 1回のクロールは同じホストへのリクエストばかりなので、制限すると同時取得の意味が無くなる。
+# 既定ではCrawl-delayだけで間隔を空け、同時接続数はCRAWL_PER_HOSTで抑える
+DEFAULT_HOST_RATE = 0.0
+# robots.txtへのアクセスが拒否された（401・403）サイトに使う、全て禁止の規則
+DISALLOW_ALL = ['User-agent: *', 'Disallow: /']
+
+
+def parse_crawl_delays(lines):
+    """robots.txtのUser-agentごとのCrawl-delay（秒）
+
+    urllib.robotparserは整数しか扱わないため、小数（Crawl-delay: 0.5など）はここで読む。
+    """
+    delays = {}
+    agents = []
+    in_rules = False
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if ':' not in line:
+            continue
+        key, value = (part.strip() for part in line.split(':', 1))
+        key = key.lower()
+        if key == 'user-agent':
+            if in_rules:
+                agents, in_rules = [], False
+            agents.append(value.lower())
+        elif key == 'crawl-delay':
+            in_rules = True
+            try:
+                delay = float(value)
+            except ValueError:
+                continue
+            for agent in agents:
+                delays.setdefault(agent, delay)
+        else:
+            in_rules = True
+    return delays
+
+
+class HostInfo:
+    """1つのホストのrobots.txtとサイトマップ"""
+
+    def __init__(self, host, robots=None, sitemap_entries=None, user_agent=DEFAULT_USER_AGENT,
+                 crawl_delays=None):
+        self.host = host
+        self.robots = robots
+        self.sitemap_entries = sitemap_entries or []
+        self.crawl_delays = crawl_delays or {}
+        self.user_agent = user_agent
+        self.fetched_at = time.time()
+        self._lastmods = None
+
+    def allowed(self, url):
+        """robots.txtのDisallowで禁止されていないか（robots.txtが無ければ全て許可）"""
+        if self.robots is None:
+            return True
+        return self.robots.can_fetch(self.user_agent, url)
+
+    @property
+    def crawl_delay(self):
+        """robots.txtのCrawl-delay（秒、指定が無ければNone）"""
+        # User-Agentの製品名（Mozillaなど）に一致するグループ、無ければ*のグループ
+        product = self.user_agent.split('/')[0].lower()
+        for agent, delay in self.crawl_delays.items():
+            if agent != '*' and agent in product:
+                return delay
+        return self.crawl_delays.get('*')
+
+    @property
+    def sitemap_urls(self):
+        return [url for url, _ in self.sitemap_entries]
+
+    @property
+    def lastmods(self):
+        """{cache_key(URL): lastmod}"""
+        if self._lastmods is None:
+            self._lastmods = lastmods(self.sitemap_entries)
+        return self._lastmods
+
+
+class HostRegistry:
+    """ホストごとにrobots.txtとサイトマップを取得してキャッシュする
+
+    同じホストを同時に調べる場合も取得は1回だけにする。ttl秒を過ぎたら取得し直す。
+    """
+
+    def __init__(self, ttl=3600, user_agent=DEFAULT_USER_AGENT):
+        self.ttl = ttl
+        self.user_agent = user_agent
+        self._hosts = {}
+        self._host_locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, session, url, timeout=10, headers=None, max_age=None):
+        """URLのホストのHostInfoを返す（キャッシュが無いか、max_age秒（既定はttl）より古ければ取得する）"""
+        parsed = urlparse(url)
+        host = f"{parsed.scheme}://{parsed.netloc}"
+        max_age = self.ttl if max_age is None else max_age
+        requested_at = time.time()
+        with self._lock:
+            info = self._hosts.get(host)
+            if info is not None and requested_at - info.fetched_at <= max_age:
+                return info
+            host_lock = self._host_locks.setdefault(host, threading.Lock())
+
+        with host_lock:
+            # 待っている間に別のスレッドが取得していればそれを使う
+            info = self._hosts.get(host)
+            if info is not None and info.fetched_at >= requested_at - max_age:
+                return info
+            info = self._fetch(session, host, timeout, headers)
+            with self._lock:
+                self._hosts[host] = info
+            return info
+
+    def _fetch(self, session, host, timeout, headers):
+        lines = self._fetch_robots(session, host, timeout, headers)
+        robots = None
+        if lines is not None:
+            robots = RobotFileParser(urljoin(host, '/robots.txt'))
+            robots.parse(lines)
+        sitemap_urls = robots.site_maps() if robots is not None else None
+        entries = fetch_sitemaps(session, sitemap_urls or [default_sitemap_url(host)], timeout, headers)
+        return HostInfo(host, robots, entries, self.user_agent, parse_crawl_delays(lines or []))
+
+    def _fetch_robots(self, session, host, timeout, headers):
+        """robots.txtの行を返す
+
+        無い・取得できない場合はNoneで全て許可する。401・403はサイトにアクセスできない
+        ものとして、全て禁止する。
+        """
+        robots_url = urljoin(host, '/robots.txt')
+        try:
+            response = session.get(robots_url, timeout=timeout, headers=headers)
+        except Exception as e:
+            logger.warning("robots.txtの取得中にエラー: %s - %s", robots_url, e)
+            return None
+        if response.status_code in (401, 403):
+            logger.info("robots.txtへのアクセスが拒否されたので全て禁止として扱う: %s (%d)",
+                        robots_url, response.status_code)
+            return DISALLOW_ALL
+        if response.status_code != 200:
+            return None
+        return response.text.splitlines()
+
+
+class HostScheduler:
+    """ホストごとのトークンバケットでリクエストの間隔を空ける
+
+    reserveは次のリクエストまでに待つ秒数を返し、その分の枠を予約する（スレッドからは
+    time.sleep、asyncioからはasyncio.sleepで待つ）。max_wait秒より長く待つ必要が
+    あれば予約せずにNoneを返す（クロールの期限までに取得を始められない場合）。
+    Crawl-delayがあるホストはその間隔で1件ずつ、無いホストはdefault_rate件/秒
+    （0なら制限なし）で送る。
+    """
+
+    def __init__(self, default_rate=DEFAULT_HOST_RATE, burst=1):
+        self.default_rate = default_rate
+        self.burst = burst
+        self._buckets = {}  # {ホスト: (トークン数, 最後に補充した時刻)}
+        self._lock = threading.Lock()
+
+    def reserve(self, url, crawl_delay=None, max_wait=None):
+        if max_wait is not None and max_wait <= 0:
+            return None
+        if crawl_delay:
+            rate, burst = 1 / crawl_delay, 1
+        elif self.default_rate:
+            rate, burst = self.default_rate, self.burst
+        else:
+            return 0
+
+        host = urlparse(url).netloc
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(host, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate) - 1
+            wait = -tokens / rate if tokens < 0 else 0
+            if max_wait is not None and wait >= max_wait:
+                return None
+            self._buckets[host] = (tokens, now)
+        return wait
+
+
+class CrawlPolicy:
+    """クロールエンジンに渡すrobots.txt・サイトマップ・ホストごとの間隔の判定"""
+
+    def __init__(self, session, timeout=10, headers=None, registry=None, scheduler=None):
+        self.session = session
+        self.timeout = timeout
+        self.headers = headers
+        self.registry = registry or get_host_registry()
+        self.scheduler = scheduler or get_host_scheduler()
+
+    def host_info(self, url, max_age=None):
+        return self.registry.get(self.session, url, self.timeout, self.headers, max_age)
+
+    def allowed(self, url):
+        return self.host_info(url).allowed(url)
+
+    def delay(self, url, max_wait=None):
+        """urlを取得する前に待つ秒数（max_wait秒以内に取得を始められなければNone）"""
+        return self.scheduler.reserve(url, self.host_info(url).crawl_delay, max_wait)
+
+    def seeds(self, start_url):
+        """サイトマップにある、開始URLと同じホストでrobots.txtに禁止されていないURL"""
+        info = self.host_info(start_url)
+        netloc = urlparse(start_url).netloc
+        return [url for url in info.sitemap_urls
+                if urlparse(url).netloc == netloc and info.allowed(url)]
+
+    def lastmods(self, start_url):
+        """差分クロールに使うlastmod（古いサイトマップでは更新を見落とすので取得し直す）"""
+        return self.host_info(start_url, max_age=0).lastmods
+
+
+_host_registry = None
+_host_scheduler = None
+_policy_lock = threading.Lock()
+
+
+def get_host_registry():
+    """プロセスで共有のHostRegistry（ROBOTS_CACHE_TTL秒キャッシュする）"""
+    global _host_registry
+    with _policy_lock:
+        if _host_registry is None:
+            _host_registry = HostRegistry(ttl=int(os.environ.get('ROBOTS_CACHE_TTL', 3600)))
+        return _host_registry
+
+
+def get_host_scheduler():
+    """プロセスで共有のHostScheduler（同時に実行される検索の間でもホストごとの間隔を守る）"""
+    global _host_scheduler
+    with _policy_lock:
+        if _host_scheduler is None:
+            _host_scheduler = HostScheduler(
+                default_rate=float(os.environ.get('CRAWL_HOST_RATE', DEFAULT_HOST_RATE)),
+                burst=int(os.environ.get('CRAWL_HOST_BURST', 1)),
+            )
+        return _host_scheduler
+
+
+def create_policy(session, timeout=10, headers=None):
+    """環境変数RESPECT_ROBOTSが0ならNone（robots.txt・サイトマップを使わない）"""
+    if os.environ.get('RESPECT_ROBOTS', '1') == '0':
+        return None
+    return CrawlPolicy(session, timeout, headers)
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import defaultdict
+
+from matcher import normalize
+
+# 文字列の末尾に付ける番兵（1文字の検索語も2-gramの前方一致で引けるようにする）
+END_MARK = '\x00'
+FIELDS = ('body', 'head', 'links')
+
+
+def bigrams(text):
+    """文字2-gramごとの出現位置（分かち書きの無い日本語もそのまま扱える）"""
+    positions = defaultdict(lambda: array('I'))
+    padded = normalize(text) + END_MARK
+    for i in range(len(padded) - 1):
+        positions[padded[i:i + 2]].append(i)
+    return positions
+
+
+def link_field(links):
+    """リンク（URLとリンクテキスト）を索引用の1つの文字列にまとめる"""
+    return '\n'.join(f"{url}\t{text}" for url, text in links)
+
+
+class SearchIndex:
+    """クロールしたページの文字2-gram転置インデックス（位置情報付き）
+
+    本文・head・リンクのフィールドごとに2-gramの出現位置を保存する。検索語の
+    2-gramの位置が連続しているかを確かめるので、部分一致の結果は線形検索と同じで、
+    一致した位置（文字オフセット）もそのままハイライトに使える。ページはURLごとに
+    保存し、再クロールで内容が変わったページだけ索引を更新する。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS pages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                url TEXT NOT NULL UNIQUE,
+                title TEXT,
+                content_hash TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL,
+                page_id INTEGER NOT NULL,
+                field TEXT NOT NULL,
+                positions BLOB NOT NULL,
+                PRIMARY KEY (term, page_id, field)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_page_id ON postings (page_id);
+        ''')
+        self._conn.commit()
+
+    @staticmethod
+    def _fields(document):
+        return {
+            'body': document['body_text'],
+            'head': document['head_text'],
+            'links': link_field(document['links']),
+        }
+
+    @staticmethod
+    def content_hash(document):
+        """索引に使うフィールドのハッシュ（索引が文書と同じ内容かの確認に使う）"""
+        fields = SearchIndex._fields(document)
+        return hashlib.sha1(
+            '\x01'.join(fields[field] for field in FIELDS).encode('utf-8')
+        ).hexdigest()
+
+    def page_hashes(self):
+        """索引済みページの{URL: 内容のハッシュ}"""
+        with self._lock:
+            return dict(self._conn.execute('SELECT url, content_hash FROM pages').fetchall())
+
+    def add_document(self, document):
+        """文書を索引に追加（内容が前回と同じなら何もしない）。更新したらTrueを返す"""
+        fields = self._fields(document)
+        content_hash = self.content_hash(document)
+
+        with self._lock:
+            row = self._conn.execute('SELECT id, content_hash FROM pages WHERE url = ?',
+                                     (document['url'],)).fetchone()
+            if row is not None and row[1] == content_hash:
+                return False
+
+            if row is None:
+                page_id = self._conn.execute(
+                    'INSERT INTO pages (url, title, content_hash, updated_at) VALUES (?, ?, ?, ?)',
+                    (document['url'], document['title'], content_hash, time.time())
+                ).lastrowid
+            else:
+                page_id = row[0]
+                self._conn.execute(
+                    'UPDATE pages SET title = ?, content_hash = ?, updated_at = ? WHERE id = ?',
+                    (document['title'], content_hash, time.time(), page_id)
+                )
+                self._conn.execute('DELETE FROM postings WHERE page_id = ?', (page_id,))
+
+            self._conn.executemany(
+                'INSERT INTO postings VALUES (?, ?, ?, ?)',
+                ((term, page_id, field, positions.tobytes())
+                 for field in FIELDS
+                 for term, positions in bigrams(fields[field]).items())
+            )
+            self._conn.commit()
+            return True
+
+    def remove_pages(self, urls):
+        """ページとその索引を削除する（文書ストアから消えたページに使う）"""
+        urls = list(urls)
+        if not urls:
+            return
+        with self._lock:
+            for start in range(0, len(urls), 500):
+                chunk = urls[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                self._conn.execute(
+                    f'DELETE FROM postings WHERE page_id IN (SELECT id FROM pages WHERE url IN ({placeholders}))',
+                    chunk
+                )
+                self._conn.execute(f'DELETE FROM pages WHERE url IN ({placeholders})', chunk)
+            self._conn.commit()
+
+    def search(self, search_text, url_prefix=None):
+        """検索語を含むページを返す
+
+        [{'url', 'title', 'positions': {フィールド: [一致した文字オフセット, ...]}}]
+        """
+        query = normalize(search_text)
+        if not query:
+            return []
+
+        with self._lock:
+            if len(query) == 1:
+                matches = self._search_char(query)
+            else:
+                matches = self._search_ngrams(query)
+            if not matches:
+                return []
+
+            placeholders = ','.join('?' * len(matches))
+            pages = self._conn.execute(
+                f'SELECT id, url, title FROM pages WHERE id IN ({placeholders}) ORDER BY id',
+                list(matches)
+            ).fetchall()
+
+        return [
+            {'url': url, 'title': title, 'positions': matches[page_id]}
+            for page_id, url, title in pages
+            if url_prefix is None or url.startswith(url_prefix)
+        ]
+
+    def _postings(self, term):
+        rows = self._conn.execute('SELECT page_id, field, positions FROM postings WHERE term = ?',
+                                  (term,)).fetchall()
+        return {(page_id, field): _unpack(blob) for page_id, field, blob in rows}
+
+    def _search_ngrams(self, query):
+        """検索語の2-gramが連続して現れる位置を求める"""
+        terms = [(offset, query[offset:offset + 2]) for offset in range(len(query) - 1)]
+        postings = [(offset, self._postings(term)) for offset, term in terms]
+        # 出現数の少ない2-gramから絞り込む
+        postings.sort(key=lambda item: len(item[1]))
+
+        base_offset, base = postings[0]
+        matches = defaultdict(dict)
+        for key, base_positions in base.items():
+            starts = {p - base_offset for p in base_positions}
+            for offset, other in postings[1:]:
+                if key not in other:
+                    starts = set()
+                    break
+                positions = set(other[key])
+                starts = {s for s in starts if s + offset in positions}
+                if not starts:
+                    break
+            if starts:
+                page_id, field = key
+                matches[page_id][field] = sorted(starts)
+        return matches
+
+    def _search_char(self, query):
+        """1文字の検索語は、その文字で始まる2-gramの位置を集める"""
+        rows = self._conn.execute(
+            'SELECT page_id, field, positions FROM postings WHERE term >= ? AND term < ?',
+            (query, query + '\U0010ffff')
+        ).fetchall()
+        matches = defaultdict(lambda: defaultdict(list))
+        for page_id, field, blob in rows:
+            matches[page_id][field].extend(_unpack(blob))
+        return {page_id: {field: sorted(positions) for field, positions in fields.items()}
+                for page_id, fields in matches.items()}
+
+
+def _unpack(blob):
+    positions = array('I')
+    positions.frombytes(blob)
+    return positions
+
+
+_search_index = None
+_search_index_lock = threading.Lock()
+
+
+def get_search_index():
+    """環境変数の設定で共有の検索インデックスを返す（SEARCH_INDEX_PATHが無ければ無効）
+
+    索引の書き込みはクロールの各ページで行われ、文書の何倍もの大きさになるので、
+    使う場合だけSEARCH_INDEX_PATHを設定する。
+    """
+    global _search_index
+    path = os.environ.get('SEARCH_INDEX_PATH', '')
+    if not path:
+        return None
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex(path)
+        return _search_index
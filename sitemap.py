@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import logging
+import zlib
+from datetime import datetime, timezone
+from urllib.parse import urljoin, urlparse
+
+from lxml import etree
+
+from fetchers import READ_CHUNK_SIZE, read_limited
+from page_cache import cache_key
+
+# サイトマップインデックスからたどる子サイトマップの上限と、1つのサイトマップの大きさの上限
+MAX_SITEMAPS = 20
+MAX_SITEMAP_BYTES = 50 * 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+def parse_lastmod(value):
+    """W3C Datetime形式のlastmodをUNIX時刻にする（解釈できなければNone）"""
+    value = (value or '').strip()
+    if not value:
+        return None
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def parse_sitemap(content):
+    """サイトマップを解析し、([(URL, lastmod), ...], [子サイトマップのURL, ...])を返す"""
+    parser = etree.XMLParser(recover=True, resolve_entities=False, no_network=True)
+    try:
+        root = etree.fromstring(content, parser)
+    except etree.XMLSyntaxError:
+        return [], []
+    if root is None:
+        return [], []
+
+    urls, sitemaps = [], []
+    for element in root:
+        if not isinstance(element.tag, str):
+            continue
+        fields = {etree.QName(child).localname: (child.text or '').strip()
+                  for child in element if isinstance(child.tag, str)}
+        if not fields.get('loc'):
+            continue
+        kind = etree.QName(element).localname
+        if kind == 'url':
+            urls.append((fields['loc'], parse_lastmod(fields.get('lastmod'))))
+        elif kind == 'sitemap':
+            sitemaps.append(fields['loc'])
+    return urls, sitemaps
+
+
+def decompress(content):
+    """gzipのサイトマップ（.xml.gz）を展開する（展開後の大きさはMAX_SITEMAP_BYTESまで）
+
+    拡張子ではなく先頭のマジックバイトで判定する（Content-Encoding: gzipで配信された
+    .xml.gzは、requestsが展開済みの本文を返すため）。
+    """
+    if content[:2] == b'\x1f\x8b':
+        try:
+            return zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(content, MAX_SITEMAP_BYTES)
+        except zlib.error:
+            return b''
+    return content
+
+
+def fetch_sitemaps(session, sitemap_urls, timeout=10, headers=None):
+    """サイトマップ（インデックス・gzipも含む）をたどり、[(URL, lastmod), ...]を返す
+
+    lastmodが無いURLはNoneになる。取得できないサイトマップは飛ばす。本文はページと同じく
+    逐次読み込み、MAX_SITEMAP_BYTESを超えた分は読まない。
+    """
+    queue = list(sitemap_urls)
+    seen = set()
+    entries = []
+    while queue and len(seen) < MAX_SITEMAPS:
+        sitemap_url = queue.pop(0)
+        if sitemap_url in seen:
+            continue
+        seen.add(sitemap_url)
+        try:
+            with session.get(sitemap_url, timeout=timeout, headers=headers, stream=True) as response:
+                response.raise_for_status()
+                content, truncated = read_limited(response.iter_content(READ_CHUNK_SIZE), MAX_SITEMAP_BYTES)
+        except Exception as e:
+            # サイトマップの無いサイトは多いので、警告にはしない
+            logger.info("サイトマップの取得中にエラー: %s - %s", sitemap_url, e)
+            continue
+        if truncated:
+            logger.info("サイトマップが大きすぎるので途中まで使う: %s", sitemap_url)
+        urls, sitemaps = parse_sitemap(decompress(content))
+        entries.extend(urls)
+        queue.extend(sitemaps)
+    return entries
+
+
+def default_sitemap_url(url):
+    """robots.txtにSitemapが無いときに使うサイトの/sitemap.xml"""
+    parsed = urlparse(url)
+    return urljoin(f"{parsed.scheme}://{parsed.netloc}", '/sitemap.xml')
+
+
+def lastmods(entries):
+    """サイトマップのエントリーから{cache_key(URL): lastmod}を作る（lastmodの無いURLは除く）"""
+    return {cache_key(url): lastmod for url, lastmod in entries if lastmod is not None}
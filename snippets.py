@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+from matcher import get_matcher, highlight, non_overlapping
+
+# 1ページあたりのスニペット数と、一致箇所の前後に含める文字数
+MAX_SNIPPETS = int(os.environ.get('SNIPPETS_PER_PAGE', 5))
+CONTEXT_LENGTH = int(os.environ.get('SNIPPET_CONTEXT', 100))
+# 1ページあたりに返すリンクの一致数
+MAX_LINK_MATCHES = int(os.environ.get('LINK_MATCHES_PER_PAGE', 20))
+
+
+def intern_url(url):
+    """URLの文字列を1つにまとめる（同じURLが多くのページ・検索語の結果に現れるため）"""
+    return sys.intern(url) if isinstance(url, str) else url
+
+
+class Snippet:
+    """一致箇所の前後の文脈と、その中の一致位置（<mark>はJSONにするときに付ける）"""
+
+    __slots__ = ('text', 'offsets', 'length')
+
+    def __init__(self, text, offsets, length):
+        self.text = text
+        self.offsets = tuple(offsets)
+        self.length = length
+
+    def __reduce__(self):
+        return Snippet, (self.text, self.offsets, self.length)
+
+    def to_json(self):
+        return f"...{highlight(self.text, self.offsets, self.length).strip()}..."
+
+
+class LinkMatch:
+    """検索語に一致したリンク（リンク先のURL・リンクテキストと、それぞれの一致位置）"""
+
+    __slots__ = ('url', 'text', 'url_offsets', 'text_offsets', 'length')
+
+    def __init__(self, url, text, url_offsets=(), text_offsets=(), length=0):
+        self.url = intern_url(url)
+        self.text = text
+        self.url_offsets = tuple(url_offsets)
+        self.text_offsets = tuple(text_offsets)
+        self.length = length
+
+    def __reduce__(self):
+        # ワーカープロセスから受け取ったときもURLをまとめる
+        return LinkMatch, (self.url, self.text, self.url_offsets, self.text_offsets, self.length)
+
+    def to_json(self):
+        """{'text': リンクテキスト（一致があればハイライト、無ければハイライトしたURL）, 'url': リンク先}"""
+        if self.text_offsets:
+            text = highlight(self.text, self.text_offsets, self.length)
+        else:
+            text = self.text or highlight(self.url, self.url_offsets, self.length)
+        return {'text': text, 'url': self.url}
+
+
+class PageResult:
+    """1ページ・1検索語の検索結果
+
+    スニペット・リンクは一致位置だけを持ち、ハイライトした文字列はto_json()で
+    レスポンス・履歴に書き出すときに作る。一致数は返すスニペット・リンクの数ではなく、
+    ページ内の一致の総数。
+    """
+
+    __slots__ = ('url', 'title', 'depth', 'body_matches', 'head_matches', 'href_matches',
+                 'body_count', 'head_count', 'link_count')
+
+    def __init__(self, url, title='', depth=0, body_matches=(), head_matches=(), href_matches=(),
+                 body_count=0, head_count=0, link_count=0):
+        self.url = intern_url(url)
+        self.title = title
+        self.depth = depth
+        self.body_matches = list(body_matches)
+        self.head_matches = list(head_matches)
+        self.href_matches = list(href_matches)
+        self.body_count = body_count
+        self.head_count = head_count
+        self.link_count = link_count
+
+    def __reduce__(self):
+        return PageResult, (self.url, self.title, self.depth, self.body_matches, self.head_matches,
+                            self.href_matches, self.body_count, self.head_count, self.link_count)
+
+    @property
+    def matches(self):
+        return self.body_count + self.head_count + self.link_count
+
+    @property
+    def match_counts(self):
+        return {'body': self.body_count, 'head': self.head_count, 'links': self.link_count}
+
+    def to_json(self):
+        """レスポンス・履歴の形式の辞書"""
+        body_matches = [_snippet_json(snippet) for snippet in self.body_matches]
+        head_matches = [_snippet_json(snippet) for snippet in self.head_matches]
+        return {
+            'url': self.url,
+            'title': self.title or self.url,
+            'depth': self.depth,
+            'matches': self.matches,
+            'body_matches': body_matches,
+            'head_matches': head_matches,
+            'href_matches': [link.to_json() for link in self.href_matches],
+            'snippets': (body_matches + head_matches)[:MAX_SNIPPETS],
+            'match_counts': self.match_counts
+        }
+
+    @classmethod
+    def from_json(cls, data):
+        """辞書の検索結果（履歴・前回の検索結果・Redisから読んだもの）から作る
+
+        スニペットは整形済みの文字列のまま持つ。一致数が無い古い形式では
+        スニペット・リンクの数を一致数とする。
+        """
+        body_matches = data.get('body_matches', [])
+        head_matches = data.get('head_matches', [])
+        href_matches = []
+        for link in data.get('href_matches', []):
+            if isinstance(link, dict):
+                # 整形済みの結果は'url'に、古い形式は'original_url'にリンク先を持つ
+                href_matches.append(LinkMatch(link.get('original_url', link.get('url', link.get('href', ''))),
+                                              link.get('text', '')))
+            elif isinstance(link, str):
+                href_matches.append(LinkMatch(link, link))
+        counts = data.get('match_counts') or {
+            'body': len(body_matches), 'head': len(head_matches), 'links': len(href_matches)}
+        return cls(data.get('url', ''), data.get('title', ''), data.get('depth', 0),
+                   body_matches, head_matches, href_matches,
+                   counts.get('body', 0), counts.get('head', 0), counts.get('links', 0))
+
+
+def _snippet_json(snippet):
+    return snippet if isinstance(snippet, str) else snippet.to_json()
+
+
+def json_default(value):
+    """json.dumpsのdefault（検索結果のレコードをto_json()の辞書にする）"""
+    if isinstance(value, (PageResult, LinkMatch, Snippet)):
+        return value.to_json()
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+def extract_snippets(text, offsets, length, context_length=CONTEXT_LENGTH, max_snippets=MAX_SNIPPETS):
+    """一致箇所の前後の文脈をスニペット（JSONではWebTextSearcher._extract_contextと同じ形式）にする
+
+    同じ窓に収まる一致は1つのスニペットにまとめる。スニペットの数と長さに
+    上限があるので、ページがどれだけ大きくても結果の大きさは変わらない。
+    """
+    offsets = non_overlapping(offsets, length)
+    snippets = []
+    i = 0
+    while i < len(offsets) and len(snippets) < max_snippets:
+        start = max(offsets[i] - context_length, 0)
+        end = min(offsets[i] + length + context_length, len(text))
+        window_offsets = []
+        while i < len(offsets) and offsets[i] + length <= end:
+            window_offsets.append(offsets[i] - start)
+            i += 1
+        snippets.append(Snippet(text[start:end], window_offsets, length))
+    return snippets
+
+
+def match_document(document, search_texts):
+    """抽出済みの文書を検索し、{検索語: 検索結果}を返す（マッチした検索語のみ）
+
+    検索語はまとめてAho-Corasickオートマトンにし、本文・head・リンクを
+    それぞれ1回だけ走査する。オートマトンはページ・リクエスト間で再利用する。
+    本文・headは一致箇所の前後だけをスニペットにし、一致数は別に数える
+    （全文のハイライトはWebTextSearcher.highlight_documentで取得する）。
+    検索結果はPageResultで、ハイライトはJSONにするときに付ける。
+    検索状態を持たないので、ワーカープロセス（parse_pool）でも実行できる。
+    """
+    matcher = get_matcher(search_texts)
+    url = intern_url(document['url'])
+    body_text = document['body_text']
+    head_text = document['head_text']
+    body_hits = matcher.scan(body_text)
+    head_hits = matcher.scan(head_text) if head_text else {}
+
+    # ページの検索結果を格納
+    results = {}
+    def page_results(search_text):
+        if search_text not in results:
+            results[search_text] = PageResult(url, document['title'], document['depth'])
+        return results[search_text]
+
+    # 本文の検索
+    for search_text, offsets in body_hits.items():
+        offsets = non_overlapping(offsets, len(search_text))
+        result = page_results(search_text)
+        result.body_matches = extract_snippets(body_text, offsets, len(search_text))
+        result.body_count = len(offsets)
+
+    # headタグ内の検索
+    for search_text, offsets in head_hits.items():
+        offsets = non_overlapping(offsets, len(search_text))
+        result = page_results(search_text)
+        result.head_matches = extract_snippets(head_text, offsets, len(search_text))
+        result.head_count = len(offsets)
+
+    # href属性の検索
+    for full_url, link_text in document['links']:
+        normalized_url = full_url.rstrip('/')
+        url_hits = matcher.scan(full_url)
+        text_hits = matcher.scan(link_text) if link_text else {}
+
+        for search_text in set(url_hits) | set(text_hits):
+            # 検索テキストが数字の場合の特別な処理
+            if search_text.isdigit():
+                if f"/journal/{search_text}" not in normalized_url:
+                    continue
+            # 通常のテキスト検索（URLは末尾のスラッシュを除いて判定）
+            elif search_text not in text_hits and not any(
+                    offset + len(search_text) <= len(normalized_url)
+                    for offset in url_hits[search_text]):
+                continue
+
+            result = page_results(search_text)
+            result.link_count += 1
+            # 一致数は全て数え、返すリンクは上限まで
+            if len(result.href_matches) >= MAX_LINK_MATCHES:
+                continue
+            result.href_matches.append(LinkMatch(full_url, link_text, url_hits.get(search_text, ()),
+                                                 text_hits.get(search_text, ()), len(search_text)))
+
+    return results
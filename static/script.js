@@ -20,6 +20,129 @@ document.addEventListener('DOMContentLoaded', function () {
     // 検索履歴を読み込む
     loadSearchHistory();
 
+    // 1ページ分の検索結果のHTMLを作成
+    function renderResultHtml(result) {
+        return `
+            <div class="result-item">
+                <h4><a href="${result.url}" target="_blank">${result.title}</a></h4>
+                <p class="url">${result.url}</p>
+                <div class="matches-section">
+                    <p class="matches">マッチ数: ${result.matches}</p>
+                    <div class="matches-details">
+                        ${result.body_matches.length > 0 ? `
+                            <div class="match-section">
+                                <h5>本文の一致</h5>
+                                ${result.body_matches.map(match => `<div class="match">${match}</div>`).join('')}
+                            </div>
+                        ` : ''}
+                        ${result.head_matches.length > 0 ? `
+                            <div class="match-section">
+                                <h5>ヘッダーの一致</h5>
+                                ${result.head_matches.map(match => `<div class="match">${match}</div>`).join('')}
+                            </div>
+                        ` : ''}
+                        ${result.href_matches.length > 0 ? `
+                            <div class="match-section">
+                                <h5>リンクの一致</h5>
+                                ${result.href_matches.map(match => `
+                                    <div class="match">
+                                        <a href="${match.url}" target="_blank">${match.text}</a>
+                                    </div>
+                                `).join('')}
+                            </div>
+                        ` : ''}
+                    </div>
+                </div>
+            </div>
+        `;
+    }
+
+    // 検索結果を階層ごとのセクションに追加する（セクションは階層の順に並べる）
+    function appendResult(container, result) {
+        const depth = result.depth || 0;
+        let grid = container.querySelector(`.depth-section[data-depth="${depth}"] .results-grid`);
+        if (!grid) {
+            const section = document.createElement('div');
+            section.className = 'depth-section';
+            section.dataset.depth = depth;
+            section.innerHTML = `<h3>階層 ${depth}</h3><div class="results-grid"></div>`;
+            const next = Array.from(container.querySelectorAll('.depth-section'))
+                .find(other => Number(other.dataset.depth) > depth);
+            container.insertBefore(section, next || null);
+            grid = section.querySelector('.results-grid');
+        }
+        grid.insertAdjacentHTML('beforeend', renderResultHtml(result));
+    }
+
+    // 検索完了時の統計情報を表示（結果は受信のたびに表示済み）
+    function showFinalResults(data, resultCount) {
+        let html = '';
+        
+        if (resultCount === 0) {
+            html += '<div class="no-results">検索結果が見つかりませんでした。</div>';
+        }
+        
+        // 検索統計情報を表示
+        html += `
+            <div class="search-stats">
+                <p>検索対象URL数: ${data.total_pages}件</p>
+                <p>検索結果数: ${resultCount}件</p>
+                ${data.cache ? `<p>キャッシュ: ヒット ${data.cache.hits}件 / ミス ${data.cache.misses}件</p>` : ''}
+                ${data.changes ? `<p>差分クロール: 変更 ${data.changes.changed}件 / 新規 ${data.changes.new}件 / 未変更 ${data.changes.unchanged}件</p>` : ''}
+            </div>
+        `;
+        
+        if (data.is_research && data.skipped_count > 0) {
+            html = `<div class="info">前回マッチした${data.skipped_count}件のURLが今回の結果に含まれていません。</div>` + html;
+        }
+        
+        // 上限に達してクロールを途中で終えた場合
+        if (data.partial && data.stop_reason) {
+            const reasons = {
+                deadline: '時間の上限',
+                max_matches: '一致したページ数の上限',
+                max_bytes: '受信量の上限'
+            };
+            html = `<div class="info">${reasons[data.stop_reason] || data.stop_reason}に達したため、途中までの結果です。</div>` + html;
+        }
+        
+        resultsDiv.insertAdjacentHTML('beforeend', html);
+        
+        // 検索ボタンのテキストを更新（再検索は変更されたページだけを取得する差分クロール）
+        if (data.is_research) {
+            searchBtn.textContent = '🔍 再検索';
+        } else {
+            searchBtn.textContent = '🔍 検索';
+        }
+    }
+
+    // /searchのNDJSONのレスポンスを1行ずつ読み、マッチしたページを受信した順に表示する
+    async function readSearchStream(response, onResult) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        for (;;) {
+            const { value, done } = await reader.read();
+            buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+            let newline;
+            while ((newline = buffer.indexOf('\n')) >= 0) {
+                const line = buffer.slice(0, newline).trim();
+                buffer = buffer.slice(newline + 1);
+                if (!line) {
+                    continue;
+                }
+                const record = JSON.parse(line);
+                if (record.type === 'summary') {
+                    return record.data;
+                }
+                onResult(record.data);
+            }
+            if (done) {
+                throw new Error('検索結果の受信が中断されました');
+            }
+        }
+    }
+
     searchForm.addEventListener('submit', async function (e) {
         e.preventDefault();
         
@@ -30,109 +153,40 @@ document.addEventListener('DOMContentLoaded', function () {
         // ローディング表示
         searchBtn.disabled = true;
         searchBtn.textContent = '検索中...';
-        resultsDiv.innerHTML = '<div class="loading">検索中...</div>';
+        resultsDiv.innerHTML = '<div class="progress">検索中... 0件一致</div><div class="streamed-results"></div>';
+        const progressDiv = resultsDiv.querySelector('.progress');
+        const streamedDiv = resultsDiv.querySelector('.streamed-results');
+        let resultCount = 0;
         
         try {
             const response = await fetch('/search', {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/x-www-form-urlencoded',
+                    'Accept': 'application/x-ndjson',
                 },
                 body: new URLSearchParams({
                     url: url,
                     search_text: searchText,
-                    is_research: isResearch
+                    is_research: isResearch,
+                    stream: true
                 })
             });
             
-            const data = await response.json();
+            // 入力エラー・レート制限などはJSONで返る
+            const data = (response.headers.get('Content-Type') || '').includes('application/x-ndjson')
+                ? await readSearchStream(response, (result) => {
+                    resultCount += 1;
+                    progressDiv.textContent = `検索中... ${resultCount}件一致`;
+                    appendResult(streamedDiv, result);
+                })
+                : await response.json();
             
+            progressDiv.remove();
             if (data.error) {
-                resultsDiv.innerHTML = `<div class="error">${data.error}</div>`;
+                resultsDiv.insertAdjacentHTML('afterbegin', `<div class="error">${data.error}</div>`);
             } else {
-                // 検索結果を表示
-                let html = '';
-                
-                if (data.is_research && data.skipped_count > 0) {
-                    html += `<div class="info">前回の検索でスキップされた${data.skipped_count}件のURLを検索しました。</div>`;
-                }
-                
-                if (data.results.length === 0) {
-                    html += '<div class="no-results">検索結果が見つかりませんでした。</div>';
-                } else {
-                    // 階層ごとに結果をグループ化
-                    const resultsByDepth = {};
-                    data.results.forEach(result => {
-                        const depth = result.depth || 0;
-                        if (!resultsByDepth[depth]) {
-                            resultsByDepth[depth] = [];
-                        }
-                        resultsByDepth[depth].push(result);
-                    });
-
-                    // 階層ごとに結果を表示
-                    Object.keys(resultsByDepth).sort((a, b) => Number(a) - Number(b)).forEach(depth => {
-                        const results = resultsByDepth[depth];
-                        html += `<div class="depth-section">
-                            <h3>階層 ${depth}</h3>
-                            <div class="results-grid">`;
-                        
-                        results.forEach(result => {
-                            html += `
-                                <div class="result-item">
-                                    <h4><a href="${result.url}" target="_blank">${result.title}</a></h4>
-                                    <p class="url">${result.url}</p>
-                                    <div class="matches-section">
-                                        <p class="matches">マッチ数: ${result.matches}</p>
-                                        <div class="matches-details">
-                                            ${result.body_matches.length > 0 ? `
-                                                <div class="match-section">
-                                                    <h5>本文の一致</h5>
-                                                    ${result.body_matches.map(match => `<div class="match">${match}</div>`).join('')}
-                                                </div>
-                                            ` : ''}
-                                            ${result.head_matches.length > 0 ? `
-                                                <div class="match-section">
-                                                    <h5>ヘッダーの一致</h5>
-                                                    ${result.head_matches.map(match => `<div class="match">${match}</div>`).join('')}
-                                                </div>
-                                            ` : ''}
-                                            ${result.href_matches.length > 0 ? `
-                                                <div class="match-section">
-                                                    <h5>リンクの一致</h5>
-                                                    ${result.href_matches.map(match => `
-                                                        <div class="match">
-                                                            <a href="${match.url}" target="_blank">${match.text}</a>
-                                                        </div>
-                                                    `).join('')}
-                                                </div>
-                                            ` : ''}
-                                        </div>
-                                    </div>
-                                </div>
-                            `;
-                        });
-                        
-                        html += `</div></div>`;
-                    });
-                }
-                
-                // 検索統計情報を表示
-                html += `
-                    <div class="search-stats">
-                        <p>検索対象URL数: ${data.total_pages}件</p>
-                        <p>検索結果数: ${data.results.length}件</p>
-                    </div>
-                `;
-                
-                resultsDiv.innerHTML = html;
-                
-                // 検索ボタンのテキストを更新
-                if (data.is_research) {
-                    searchBtn.textContent = '🔍 未検索ページを検索';
-                } else {
-                    searchBtn.textContent = '🔍 検索';
-                }
+                showFinalResults(data, resultCount);
             }
         } catch (error) {
             resultsDiv.innerHTML = `<div class="error">エラーが発生しました: ${error.message}</div>`;
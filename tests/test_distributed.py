@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""協調クロールのコーディネーター（プロセス内・Redis）のテスト
+
+Redisはfakeredisで置き換える。同じFakeServerにつないだクライアントは、別のワーカー
+（別のプロセス・マシン）のRedisクライアントと同じように同じデータを共有する。
+"""
+import threading
+
+import fakeredis
+import pytest
+
+from distributed import ACTIVE_JOBS_KEY, LocalCrawlCoordinator, RedisCrawlCoordinator, create_coordinator
+
+
+@pytest.fixture
+def server():
+    return fakeredis.FakeServer()
+
+
+def redis_coordinator(server, job_id='job', **kwargs):
+    return RedisCrawlCoordinator(fakeredis.FakeRedis(server=server), job_id, **kwargs)
+
+
+@pytest.fixture(params=['local', 'redis'])
+def make_coordinator(request, server):
+    """同じジョブのコーディネーターを作る関数（プロセス内のものは1つを共有する）"""
+    if request.param == 'local':
+        coordinators = {}
+        return lambda **kwargs: coordinators.setdefault('job', LocalCrawlCoordinator('job', **kwargs))
+    return lambda **kwargs: redis_coordinator(server, **kwargs)
+
+
+def drain(coordinator):
+    urls = []
+    while True:
+        items = coordinator.claim(10)
+        if not items:
+            return urls
+        for url, depth in items:
+            urls.append(url)
+            assert coordinator.complete(url, depth, {'depth': depth}, [], depth + 1)
+
+
+def test_start_and_links_are_queued_once(make_coordinator):
+    coordinator = make_coordinator()
+    coordinator.start(['http://example.com/'], skip=['http://example.com/skip'])
+    [(url, depth)] = coordinator.claim(10)
+    assert (url, depth) == ('http://example.com/', 0)
+    links = ['http://example.com/a', 'http://example.com/a', 'http://example.com/skip', 'http://example.com/b']
+    assert coordinator.complete(url, depth, {}, links, 1)
+    assert sorted(coordinator.claim(10)) == [('http://example.com/a', 1), ('http://example.com/b', 1)]
+
+
+def test_links_are_deduplicated_by_canonical_url_but_fetched_as_written(make_coordinator):
+    coordinator = make_coordinator()
+    coordinator.start(['http://example.com/docs/'])
+    url, depth = coordinator.claim(1)[0]
+    coordinator.complete(url, depth, {}, ['http://EXAMPLE.com/docs', 'http://example.com/docs/page.html'], 1)
+    assert url == 'http://example.com/docs/'
+    assert coordinator.claim(10) == [('http://example.com/docs/page.html', 1)]
+
+
+def test_max_pages_limits_admitted_urls(make_coordinator):
+    coordinator = make_coordinator(max_pages=3)
+    coordinator.start(['http://example.com/'])
+    url, depth = coordinator.claim(1)[0]
+    coordinator.complete(url, depth, {}, [f'http://example.com/{i}' for i in range(10)], 1)
+    assert len(drain(coordinator)) == 2
+    assert coordinator.finished()
+
+
+def test_complete_saves_each_result_exactly_once(make_coordinator):
+    coordinator = make_coordinator()
+    coordinator.start(['http://example.com/'])
+    url, depth = coordinator.claim(1)[0]
+    assert coordinator.complete(url, depth, {'n': 1}, [], 1)
+    # 同じリースを2回完了しても結果は1つ
+    assert not coordinator.complete(url, depth, {'n': 2}, [], 1)
+    entries, cursor = coordinator.results_since(0)
+    assert entries == [{'url': url, 'depth': 0, 'result': {'n': 1}}]
+    assert coordinator.results_since(cursor) == ([], cursor)
+    assert coordinator.finished()
+
+
+def test_requeue_expired_returns_lease_to_frontier(make_coordinator):
+    coordinator = make_coordinator(lease_seconds=0)
+    coordinator.start(['http://example.com/'])
+    url, depth = coordinator.claim(1)[0]
+    assert coordinator.claim(1) == []
+    assert not coordinator.finished()
+    assert coordinator.requeue_expired() == 1
+    # 期限切れで戻したページのリースは無効なので、元のワーカーは完了できない
+    assert not coordinator.complete(url, depth, {}, [], 1)
+    assert drain(coordinator) == [url]
+    assert len(coordinator.results_since(0)[0]) == 1
+
+
+def test_requeue_expired_keeps_live_leases(make_coordinator):
+    coordinator = make_coordinator(lease_seconds=60)
+    coordinator.start(['http://example.com/'])
+    coordinator.claim(1)
+    assert coordinator.requeue_expired() == 0
+    assert coordinator.claim(1) == []
+
+
+def test_cancel(make_coordinator):
+    coordinator = make_coordinator()
+    coordinator.start(['http://example.com/'])
+    assert not coordinator.cancelled()
+    coordinator.cancel()
+    assert coordinator.cancelled()
+
+
+def test_redis_lease_moved_to_another_worker(server):
+    first = redis_coordinator(server, lease_seconds=0)
+    first.start(['http://example.com/'])
+    url, depth = first.claim(1)[0]
+    first.requeue_expired()
+
+    second = redis_coordinator(server, lease_seconds=60)
+    assert second.claim(1) == [(url, depth)]
+    # 期限切れの後に他のワーカーがリースしたページは、元のワーカーからは完了できない
+    assert not first.complete(url, depth, {'worker': 1}, [], 1)
+    assert second.complete(url, depth, {'worker': 2}, [], 1)
+    assert [entry['result'] for entry in first.results_since(0)[0]] == [{'worker': 2}]
+
+
+def test_redis_workers_claim_and_complete_each_page_exactly_once(server):
+    links = [f'http://example.com/{i}' for i in range(50)]
+    coordinator = redis_coordinator(server, max_pages=100)
+    coordinator.start(['http://example.com/'])
+    url, depth = coordinator.claim(1)[0]
+    coordinator.complete(url, depth, {}, links, 1)
+
+    processed = []
+    lock = threading.Lock()
+
+    def work():
+        worker = redis_coordinator(server)
+        while True:
+            items = worker.claim(3)
+            if not items:
+                return
+            for item_url, item_depth in items:
+                assert worker.complete(item_url, item_depth, {}, [], item_depth + 1)
+                with lock:
+                    processed.append(item_url)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(processed) == sorted(links)
+    entries = coordinator.results_since(0)[0]
+    assert len(entries) == len(links) + 1
+    assert len({entry['url'] for entry in entries}) == len(entries)
+    assert coordinator.finished()
+
+
+def test_redis_spec_is_shared_and_job_is_listed(server):
+    coordinator = redis_coordinator(server, spec={'url': 'http://example.com/', 'search_texts': ['a']},
+                                    max_pages=7)
+    coordinator.start(['http://example.com/'])
+    client = fakeredis.FakeRedis(server=server)
+    assert client.smembers(ACTIVE_JOBS_KEY) == {b'job'}
+
+    helper = create_coordinator('job', client=client)
+    assert helper.spec() == {'url': 'http://example.com/', 'search_texts': ['a'], 'max_pages': 7}
+    coordinator.close()
+    assert client.smembers(ACTIVE_JOBS_KEY) == set()
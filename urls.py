@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import re
+from array import array
+from bisect import bisect_left
+from urllib.parse import urlsplit, urlunsplit
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+PERCENT_RE = re.compile(r'%([0-9a-fA-F]{2})')
+# パーセントエンコードする必要の無い文字（RFC 3986のunreserved）
+UNRESERVED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+
+
+def _normalize_percent(text):
+    """%xxの16進数を大文字にし、エンコード不要な文字は元の文字に戻す"""
+    def replace(match):
+        char = chr(int(match.group(1), 16))
+        return char if char in UNRESERVED else '%' + match.group(1).upper()
+    return PERCENT_RE.sub(replace, text)
+
+
+def canonicalize(url):
+    """同じページを指すURLを1つの形にそろえる
+
+    スキーム・ホストの小文字化、既定ポートとフラグメントの除去、パスの末尾の
+    スラッシュの除去（ルート以外）、クエリパラメータの並べ替え、パーセント
+    エンコードの正規化を行う。http(s)以外のURLはそのまま返す。
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS:
+        return url
+
+    host = (parts.hostname or '').lower()
+    if port and port != DEFAULT_PORTS[scheme]:
+        host = f"{host}:{port}"
+    if parts.username is not None:
+        userinfo = parts.username + (f":{parts.password}" if parts.password is not None else '')
+        host = f"{userinfo}@{host}"
+
+    path = _normalize_percent(parts.path) or '/'
+    if len(path) > 1 and path.endswith('/'):
+        path = path.rstrip('/') or '/'
+    query = '&'.join(sorted(_normalize_percent(param) for param in parts.query.split('&') if param))
+    return urlunsplit((scheme, host, path, query, ''))
+
+
+def fingerprint(url):
+    """URLの64ビットのフィンガープリント"""
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class SeenSet:
+    """URLを64ビットのフィンガープリントで持つ集合（文字列を保持しないので省メモリ）
+
+    フィンガープリントはソート済みのarray('Q')（1件8バイト）に入れ、新しく追加した
+    分だけを小さなsetに持つ。setが大きくなったらarrayにマージする。
+    """
+
+    MIN_BUFFER = 4096
+
+    def __init__(self, urls=()):
+        self._sorted = array('Q')
+        self._recent = set()
+        for url in urls:
+            self.add(url)
+
+    def __contains__(self, url):
+        value = fingerprint(url)
+        return value in self._recent or self._in_sorted(value)
+
+    def _in_sorted(self, value):
+        index = bisect_left(self._sorted, value)
+        return index < len(self._sorted) and self._sorted[index] == value
+
+    def add(self, url):
+        """URLを追加する（新しく追加したらTrue、既にあればFalse）"""
+        value = fingerprint(url)
+        if value in self._recent or self._in_sorted(value):
+            return False
+        self._recent.add(value)
+        if len(self._recent) > max(self.MIN_BUFFER, len(self._sorted) // 8):
+            self._merge()
+        return True
+
+    def _merge(self):
+        # ソート済みの部分はtimsortがそのまま使うので、実質的には線形時間のマージになる
+        merged = self._sorted.tolist()
+        merged.extend(self._recent)
+        merged.sort()
+        self._sorted = array('Q', merged)
+        self._recent = set()
+
+    def __len__(self):
+        return len(self._sorted) + len(self._recent)
@@ -1,12 +1,22 @@
+import logging
+import os
 import requests
 from bs4 import BeautifulSoup
 from urllib.parse import urljoin, urlparse
 import re
-import time
-from concurrent.futures import ThreadPoolExecutor
 import threading
 from collections import defaultdict
 
+from crawler import create_engine
+from frontier import LinkScorer, frontier_strategy, match_density
+from robots import create_policy
+from page_cache import get_page_cache
+from matcher import get_matcher, non_overlapping
+from dedup import NearDuplicateIndex, get_sketch_store, minhash
+from parse_pool import get_parse_pool
+
+logger = logging.getLogger(__name__)
+
 class WebTextSearcher:
     def __init__(self):
         self.session = requests.Session()
@@ -19,37 +29,49 @@ class WebTextSearcher:
         self.max_depth = 4
         self.max_urls = 100
         self.timeout = 20
-        self.batch_size = 10
-        self.common_content = set()  # 共通コンテンツを保存するセット
+        self.batch_size = 10  # 同時に取得するページ数
+        self.max_links = 15  # 1ページからたどるリンクの数（検索語に関係がありそうな順に選ぶ）
+        self.frontier = frontier_strategy()  # 'bfs'（幅優先）または'best'（最良優先）
+        # フェッチバックエンド（'thread' または 'async'）とホストごとの同時接続数
+        self.fetch_backend = os.environ.get('FETCH_BACKEND', 'thread')
+        self.per_host_limit = int(os.environ.get('CRAWL_PER_HOST', 8))
+        self.page_cache = get_page_cache()  # ページキャッシュ（PAGE_CACHE_PATHが空なら無効）
+        self.common_content = None  # 共通コンテンツのMinHash索引（検索ごとにサイト単位で作る）
         self.common_content_threshold = 0.7  # 共通コンテンツと判定する閾値
+        self.sketch_store = get_sketch_store()  # 署名をサイトごとに保存（SKETCH_STORE_PATHが空なら保存しない）
         
     def search(self, base_url, search_text, progress_callback=None):
         """メインの検索関数"""
         self.visited_urls.clear()
         self.results.clear()
         self.progress_callback = progress_callback
+        self.common_content = NearDuplicateIndex(self.common_content_threshold, self.sketch_store,
+                                                 urlparse(base_url).netloc)
         
         try:
-            # バッチ処理でクロール
-            urls_to_crawl = [base_url]
-            current_depth = 0
-            
-            while urls_to_crawl and current_depth <= self.max_depth:
-                batch = urls_to_crawl[:self.batch_size]
-                urls_to_crawl = urls_to_crawl[self.batch_size:]
-                
-                for url in batch:
-                    if len(self.visited_urls) >= self.max_urls:
-                        break
-                    self._crawl_and_search(url, search_text, current_depth, base_url)
-                
-                current_depth += 1
-                time.sleep(1)  # バッチ間の待機時間
+            # robots.txtの禁止・Crawl-delayを守り、サイトマップのURLもクロール対象に加える
+            policy = create_policy(self.session, self.timeout)
+            # 解析プール（PARSE_WORKERS）があれば、HTMLの解析と署名の計算をワーカープロセスで行う
+            prepare = None
+            parse_pool = get_parse_pool()
+            if parse_pool is not None:
+                prepare = lambda url, depth, page: parse_pool.submit(WebTextSearcher._parse_page, url, page)
+            engine = create_engine(self.fetch_backend, self.max_depth, self.max_urls,
+                                   self.batch_size, self.timeout, self.per_host_limit,
+                                   session=self.session, cache=self.page_cache, policy=policy,
+                                   prepare=prepare, frontier=self.frontier)
+            seeds = policy.seeds(base_url) if policy is not None else None
+            scorer = LinkScorer([search_text])
+            process = lambda url, depth, page: self._crawl_and_search(url, search_text, depth, base_url, page,
+                                                                      scorer)
+            for _ in engine.run(base_url, process, self.visited_urls, seeds=seeds):
+                pass
             
             return {
                 'success': True,
                 'results': self.results,
-                'total_pages': len(self.visited_urls)
+                'total_pages': len(self.visited_urls),
+                'cache': engine.fetcher.cache_stats.to_dict()
             }
         except Exception as e:
             return {
@@ -59,80 +81,99 @@ class WebTextSearcher:
                 'total_pages': len(self.visited_urls)
             }
     
-    def _crawl_and_search(self, url, search_text, depth, base_domain):
-        """再帰的にページをクロールして検索"""
-        if (url in self.visited_urls or
-            not self._is_same_domain(url, base_domain)):
-            return
-        
-        self.visited_urls.add(url)
+    def _crawl_and_search(self, url, search_text, depth, base_domain, page, scorer=None):
+        """取得済みのページを検索し、(検索結果, 次の階層の(リンク, 優先度))を返す"""
+        result = None
+        links = []
         
         if self.progress_callback:
             self.progress_callback(f"クロール中: {url}")
         
         try:
-            # ページを取得
-            response = self.session.get(url, timeout=self.timeout)
-            response.raise_for_status()
+            parsed = None
+            if page.prepared is not None:
+                try:
+                    parsed = page.prepared.result()
+                except Exception as e:
+                    logger.warning("Error parsing %s in worker: %s", url, e)
+            if parsed is None:
+                parsed = self._parse_page(url, page)
+            if parsed['text'] is None:
+                return None, links
+            clean_text = parsed['text']
             
-            # エンコーディングを適切に設定
-            if response.encoding == 'ISO-8859-1':
-                response.encoding = response.apparent_encoding
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # ヘッダー、フッター、サイドバーなどの共通コンテンツを除去
-            for tag in soup.find_all(['header', 'footer', 'nav', 'aside']):
-                tag.decompose()
-            
-            # JavaScriptやCSSを除去
-            for script in soup(["script", "style"]):
-                script.decompose()
-            
-            # メインコンテンツを抽出
-            main_content = self._extract_main_content(soup)
-            if not main_content:
-                return
-                
-            # テキストを抽出
-            text_content = main_content.get_text()
-            clean_text = re.sub(r'\s+', ' ', text_content).strip()
-            
-            # 共通コンテンツかどうかをチェック
-            if self._is_common_content(clean_text):
-                return
-                
-            # 新しい共通コンテンツとして保存
-            self.common_content.add(clean_text)
+            # 共通コンテンツかどうかをチェック（そうでなければ署名を登録）
+            if self._is_common_content(clean_text, url, parsed['signature']):
+                return None, links
             
             # 検索テキストをチェック
             matches = self._find_matches(clean_text, search_text)
             
             if matches:
                 # ページタイトルを取得
-                title = soup.find('title')
-                page_title = title.get_text() if title else "タイトルなし"
+                page_title = parsed['title'] if parsed['title'] is not None else "タイトルなし"
                 
                 # マッチした文脈を抽出
                 context_snippets = self._extract_context(clean_text, search_text)
                 
-                self.results.append({
+                result = {
                     'url': url,
                     'title': page_title.strip(),
                     'matches': int(len(matches)) if matches is not None else 0,
                     'snippets': context_snippets[:3]
-                })
+                }
+                self.results.append(result)
             
-            # 次の階層のリンクを取得
+            # 次の階層のリンクを取得（同じドメインのみ、優先度の高いものからmax_links件）
             if depth < self.max_depth:
-                links = self._extract_links(soup, url)
-                for link in links[:15]:
-                    if len(self.visited_urls) < self.max_urls:
-                        time.sleep(0.1)
-                        self._crawl_and_search(link, search_text, depth + 1, base_domain)
+                links = [(link, text) for link, text in parsed['links']
+                         if self._is_same_domain(link, base_domain)]
+                scorer = scorer or LinkScorer([search_text])
+                density = match_density(len(matches), len(clean_text))
+                links = sorted(scorer.score_links(links, density, url),
+                               key=lambda link: -link[1])[:self.max_links]
         
         except Exception as e:
-            print(f"Error crawling {url}: {str(e)}")
+            logger.warning("Error crawling %s: %s", url, e)
+        
+        return result, links
+    
+    @staticmethod
+    def _parse_page(url, page):
+        """ページを解析し、本文・タイトル・リンク・MinHash署名を返す（メインコンテンツが無ければtextはNone）
+
+        検索の状態を使わないので、解析プールのワーカープロセスでも実行できる。
+        """
+        # エンコーディングを適切に設定
+        if page.encoding == 'ISO-8859-1':
+            page.encoding = page.apparent_encoding
+        
+        soup = BeautifulSoup(page.text, 'lxml')
+        
+        # ヘッダー、フッター、サイドバーなどの共通コンテンツを除去
+        for tag in soup.find_all(['header', 'footer', 'nav', 'aside']):
+            tag.decompose()
+        
+        # JavaScriptやCSSを除去
+        for script in soup(["script", "style"]):
+            script.decompose()
+        
+        # メインコンテンツを抽出
+        main_content = WebTextSearcher._extract_main_content(soup)
+        if not main_content:
+            return {'text': None, 'title': None, 'links': [], 'signature': None}
+        
+        # テキストを抽出
+        text_content = main_content.get_text()
+        clean_text = re.sub(r'\s+', ' ', text_content).strip()
+        title = soup.find('title')
+        return {
+            'text': clean_text,
+            'title': title.get_text() if title else None,
+            # 相対リンクはレスポンスのURL（リダイレクト後）を基準に解決する
+            'links': WebTextSearcher._extract_links(soup, page.url or url),
+            'signature': minhash(clean_text) if clean_text.strip() else None
+        }
     
     def _is_same_domain(self, url, base_url):
         """同じドメインかチェック"""
@@ -142,9 +183,10 @@ class WebTextSearcher:
             return False
     
     def _find_matches(self, text, search_text):
-        """テキスト内の一致を検索"""
-        pattern = re.compile(re.escape(search_text), re.IGNORECASE)
-        return pattern.findall(text)
+        """テキスト内の一致を検索（オートマトンはページ間で再利用する）"""
+        offsets = get_matcher([search_text]).scan(text).get(search_text, [])
+        return [text[start:start + len(search_text)]
+                for start in non_overlapping(offsets, len(search_text))]
     
     def _extract_context(self, text, search_text, context_length=100):
         """マッチした箇所の前後の文脈を抽出"""
@@ -158,45 +200,41 @@ class WebTextSearcher:
         
         return snippets
     
-    def _extract_links(self, soup, base_url):
-        """ページからリンクを抽出"""
-        links = []
+    @staticmethod
+    def _extract_links(soup, base_url):
+        """ページから(リンク先URL, リンクテキスト)を出現順に抽出（同じURLは最初のものだけ）"""
+        links = {}
         for link in soup.find_all('a', href=True):
             href = link['href']
             full_url = urljoin(base_url, href)
             
             # 有効なHTTP/HTTPSリンクのみ
-            if full_url.startswith(('http://', 'https://')):
-                links.append(full_url)
+            if full_url.startswith(('http://', 'https://')) and full_url not in links:
+                links[full_url] = link.get_text(' ', strip=True)
         
-        return list(set(links))  # 重複を除去
+        return list(links.items())
     
-    def _is_common_content(self, text):
-        """テキストが共通コンテンツかどうかを判定"""
+    def _is_common_content(self, text, url=None, signature=None):
+        """テキストが共通コンテンツかどうかを判定（そうでなければ署名を登録する）
+
+        単語集合のJaccard係数をMinHashで推定し、LSHで候補になったページとだけ比較する。
+        signatureを渡すと署名を計算し直さない。
+        """
         if not text.strip():
             return True
-            
+        if self.common_content is None:
+            self.common_content = NearDuplicateIndex(self.common_content_threshold)
+        
         # 既存の共通コンテンツと比較
-        for common in self.common_content:
-            if self._calculate_similarity(text, common) > self.common_content_threshold:
-                return True
+        if signature is None:
+            signature = minhash(text)
+        if self.common_content.find(signature, url) is not None:
+            return True
+        self.common_content.add(url or text, signature)
         return False
         
-    def _calculate_similarity(self, text1, text2):
-        """2つのテキストの類似度を計算（簡易版）"""
-        # テキストを単語に分割
-        words1 = set(text1.lower().split())
-        words2 = set(text2.lower().split())
-        
-        # 共通の単語数を計算
-        common_words = words1.intersection(words2)
-        
-        # 類似度を計算（Jaccard係数）
-        if not words1 or not words2:
-            return 0
-        return len(common_words) / len(words1.union(words2))
-        
-    def _extract_main_content(self, soup):
+    @staticmethod
+    def _extract_main_content(soup):
         """メインコンテンツを抽出"""
         # 一般的なメインコンテンツのセレクタ
         main_selectors = [